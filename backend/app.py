@@ -7,9 +7,10 @@ import cv2
 import base64
 import tempfile
 import subprocess
+from typing import Iterator
 
 
-from flask import Flask, jsonify, send_from_directory, request, send_file
+from flask import Flask, Response, jsonify, send_from_directory, request, send_file, stream_with_context
 from flask_cors import CORS
 import json
 import traceback
@@ -27,8 +28,13 @@ from video_effects_processor import VideoEffectsProcessor
 from video_animation_processor import VideoAnimationProcessor
 from video_compositor import *
 from sam2.build_sam import build_sam2
-from sam2_segmenter import SAM2Segmenter, VideoObjectData
+from sam2_segmenter import SAM2Segmenter, SAM2ModelRegistry, VideoObjectData
 from data_saver import DataSaver
+from segmentation_jobs import SegmentationJobs
+from project_renderer import render_project, preview_metadata, PreviewProjects
+from media_store import MediaStore
+from thumbnails import Thumbnails
+from clean_plate import CleanPlate
 from utils import *
 from text_generator import create_text_frame
 
@@ -129,49 +135,127 @@ def convert_image_to_video():
             if os.path.exists(path):
                 os.remove(path)
     
-@app.route('/video/basic_data', methods=['POST'])
-def get_basic_video_data():
-    file = request.files['video']
-
+@app.route('/media', methods=['POST'])
+def upload_media():
+    """
+    Guarda um vídeo (campo `video` ou o corpo do pedido em bruto) e devolve o `media_id` e os metadados.
+    Os outros endpoints aceitam o `media_id` em vez do ficheiro.
+    """
+    stream = request.files['video'].stream if 'video' in request.files else request.stream
+    media_id = MediaStore.put(stream)
+    return jsonify(MediaStore.probe(media_id))
+
+@app.route('/media/<media_id>', methods=['GET'])
+def get_media(media_id):
+    """Metadados de um vídeo já guardado; 404 indica que tem de ser enviado com POST /media"""
+    info = MediaStore.probe(media_id)
+    if info is None:
+        return jsonify({'error': 'Vídeo não encontrado'}), 404
+    return jsonify(info)
+
+def request_video_path(field: str = 'video') -> Tuple[Optional[str], bool]:
+    """
+    Vídeo do pedido: `media_id` (ver /media) ou o ficheiro enviado em `field`, guardado num temporário.
+    Retorna (caminho, temporário); o caminho é None se não houver vídeo ou o `media_id` não existir.
+    """
+    media_id = request.form.get('media_id')
+    if media_id:
+        return MediaStore.get_path(media_id), False
+    if field not in request.files:
+        return None, False
+    
     # Arquivo temporário com sufixo mp4 para o OpenCV abrir
     with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as tmp:
-        file.save(tmp.name)
-        temp_path = tmp.name
+        request.files[field].save(tmp.name)
+        return tmp.name, True
+
+def request_project_videos(metadata: Dict) -> List[Union[str, Any]]:
+    """
+    Vídeo de cada elemento do tipo 'video' do projeto, pela ordem dos elementos: o `media_id` do
+    elemento (ver /media) ou, se não tiver, o próximo de `media_ids[]` e depois de `videos[]`.
+    Retorna o `media_id` (str) ou o ficheiro enviado (FileStorage) de cada elemento.
+    """
+    pending = request.form.getlist('media_ids[]') + request.files.getlist('videos[]')
+    sources = []
+    for video_id, element in (metadata.get('elements_data') or {}).items():
+        if not element or element.get('type', 'video') != 'video':
+            continue
+        if element.get('media_id'):
+            sources.append(element['media_id'])
+        elif pending:
+            sources.append(pending.pop(0))
+        else:
+            raise ValueError(f'Nenhum vídeo enviado para o elemento {video_id}')
+    return sources
+
+def save_project_videos(sources: List[Union[str, Any]], folder: str) -> List[str]:
+    """Caminhos dos vídeos de `request_project_videos`: os guardados são lidos do MediaStore, sem cópia"""
+    video_paths = []
+    for i, source in enumerate(sources):
+        if isinstance(source, str):
+            video_paths.append(MediaStore.get_path(source))
+        else:
+            video_input = os.path.join(folder, f'input_{i}.mp4')
+            source.save(video_input)
+            video_paths.append(video_input)
+    return video_paths
+
+def missing_media_ids(sources: List[Union[str, Any]]) -> List[str]:
+    return [source for source in sources if isinstance(source, str) and MediaStore.get_path(source) is None]
 
-    processor = None
+@app.route('/video/basic_data', methods=['POST'])
+def get_basic_video_data():
+    """
+    FPS e miniaturas do vídeo (`video` ou `media_id`), descodificadas numa só passagem e em cache.
 
+    Com `sprite=true` devolve um único sprite sheet (data URL) e a posição de cada miniatura;
+    caso contrário uma data URL por miniatura. `count`, `width`, `columns` e `keyframes_only`
+    controlam o número, a largura, a grelha e se as miniaturas usam apenas keyframes.
+    """
     try:
-        processor = VideoProcessor(temp_path)
-        num_frames = processor.get_num_frames()
-        fps = processor.get_fps()
-
-        frames_indices = get_interpolated_numbers(0, num_frames - 1, 10)
-        frames = []
-
-        for i in frames_indices:
-            frame = processor.get_frame(i)
-            if frame is None:
-                continue
-            frame = resize_frame(frame, width=100)
-            _, buffer = cv2.imencode('.jpg', frame)
-            frame_base64 = base64.b64encode(buffer).decode('utf-8')
-            frames.append(f"data:image/jpeg;base64,{frame_base64}")
+        count = int(request.form.get('count', 10))
+        width = int(request.form.get('width', 100))
+        columns = int(request.form.get('columns', 10))
+        keyframes_only = request.form.get('keyframes_only', 'false').lower() in ('1', 'true')
+        sprite = request.form.get('sprite', 'false').lower() in ('1', 'true')
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    if count <= 0 or width <= 0 or columns <= 0:
+        return jsonify({'error': 'count, width e columns têm de ser positivos'}), 400
+
+    temp_path, is_temp_file = request_video_path()
+    if temp_path is None:
+        return jsonify({'error': 'No video file provided'}), 400 if 'media_id' not in request.form else 404
+
+    try:
+        # O media_id já é a hash do conteúdo
+        digest = request.form.get('media_id') or file_sha256(request.files['video'].stream)
+        if sprite:
+            image, table = Thumbnails.get(temp_path, digest, count, width, columns, keyframes_only)
+            sprite_base64 = base64.b64encode(image).decode('utf-8')
+            return jsonify({'sprite': f"data:image/jpeg;base64,{sprite_base64}", **table})
+
+        # Formato antigo: uma imagem por miniatura
+        table = Thumbnails.get_tiles(temp_path, digest, count, width, keyframes_only)
+        fps, frames = table['fps'], table['frames']
 
         print('Fps: ', fps)
         print('Frames: ', len(frames))
         return jsonify({'fps': fps, 'frames': frames})
 
     finally:
-        if processor:
-            processor.release()
         try:
-            os.remove(temp_path)
+            if is_temp_file:
+                os.remove(temp_path)
         except PermissionError:
             print(f"Não foi possível remover o arquivo: {temp_path}")
 
 @app.route('/video/frame/mask', methods=['POST'])
 def get_masks_of_frame():
     file = request.files['frame']
+    model_size = request.form.get('model_size', SAM2Segmenter.MODEL_SIZE_TINY)
+    if model_size not in SAM2Segmenter.MODEL_CONFIGS:
+        return jsonify({'error': f'Invalid model size: {model_size}'}), 400
 
     # Guardar imagem temporária
     with tempfile.NamedTemporaryFile(delete=False, suffix='.jpg') as tmp:
@@ -179,8 +263,8 @@ def get_masks_of_frame():
         temp_path = tmp.name
 
     try:
-        segmenter = SAM2Segmenter()
-        image_bgr, image_rgb, sam_result = segmenter.generate_mask_for_image(temp_path)
+        with SAM2ModelRegistry.use(model_size) as segmenter:
+            image_bgr, image_rgb, sam_result = segmenter.generate_mask_for_image(temp_path)
         #segmenter.show_sam_result(image_bgr, sam_result)
 
         # Codificar imagem original para base64
@@ -208,19 +292,80 @@ def get_masks_of_frame():
         except PermissionError:
             print(f"Não foi possível remover o arquivo: {temp_path}")
 
+def parse_video_objects(video_objects_json: List[Dict], scale_factor: float) -> List[VideoObjectData]:
+    """Valida os objetos anotados enviados pelo frontend e aplica o fator de escala aos pontos"""
+    video_objects: List[VideoObjectData] = []
+    for idx, obj in enumerate(video_objects_json):
+        points_raw = obj.get("points")
+        labels_raw = obj.get("labels")
+
+        # Validação
+        if not points_raw or not labels_raw:
+            raise ValueError(f'Points and labels cannot be empty (object index {idx})')
+
+        if len(points_raw) != len(labels_raw):
+            raise ValueError(f'Points and labels must have the same length (object index {idx})')
+
+        # Aplicar fator de escala aos pontos
+        points_scaled = np.array(points_raw, dtype=np.float32) * scale_factor
+        labels = np.array(labels_raw, dtype=np.int32)
+
+        vod = VideoObjectData(
+            points=points_scaled,
+            labels=labels,
+            ann_frame_idx=int(obj.get("ann_frame_idx", 0)),
+            ann_obj_id=int(obj.get("ann_obj_id", 1)),
+        )
+        video_objects.append(vod)
+
+        # Print de debug por objeto
+        print(f"\n[DEBUG] VideoObjectData #{idx}:")
+        print(f"  ann_frame_idx: {vod.ann_frame_idx}")
+        print(f"  ann_obj_id: {vod.ann_obj_id}")
+        print(f"  points.shape: {vod.points.shape if vod.points is not None else 'None'}")
+        print(f"  points (scaled):\n{vod.points}")
+        print(f"  labels:\n{vod.labels}")
+    
+    return video_objects
+
+def iter_serialized_video_masks(
+    video_path: str,
+    video_objects: List[VideoObjectData],
+    output_dir: str,
+    scale_factor: float,
+    start_frame: int,
+    end_frame: int,
+    model_size: str,
+    frame_feed: str,
+) -> Iterator[Tuple[int, Dict]]:
+    """Gera (frame_idx, máscaras serializadas) à medida que o SAM2 as propaga"""
+    # Marcado em uso enquanto a propagação corre (o registry não o descarrega a meio)
+    with SAM2ModelRegistry.use(model_size) as segmenter:
+        print('Gerando máscaras para o vídeo...')
+        for frame_idx, frame_data in segmenter.iter_masks_for_video(
+            video_path=video_path,
+            video_objects_data=video_objects,
+            output_dir=output_dir,
+            scale_factor=scale_factor,
+            start_frame=start_frame,
+            end_frame=end_frame if end_frame != -1 else None,
+            debug_points=False,
+            frame_feed=frame_feed,
+        ):
+            frame_idx = frame_idx + start_frame
+            yield frame_idx, serialize_frame_masks(frame_data, frame_idx)
+
 @app.route('/video/mask', methods=['POST'])
 def get_masks_of_video():
-    # Verificar se o vídeo foi enviado
-    if 'video' not in request.files:
+    # Vídeo enviado (ou já guardado, com `media_id`)
+    temp_path, is_temp_file = request_video_path()
+    if temp_path is None:
+        if 'media_id' in request.form:
+            return jsonify({'error': 'Vídeo não encontrado'}), 404
         return jsonify({'error': 'No video file provided'}), 400
     
-    # Obter o arquivo de vídeo
-    file = request.files['video']
-    
-    # Arquivo temporário com sufixo mp4 para o OpenCV abrir
-    with tempfile.NamedTemporaryFile(delete=False, suffix='.mp4') as tmp:
-        file.save(tmp.name)
-        temp_path = tmp.name
+    # Em modo streaming o ficheiro temporário só é removido no fim do stream
+    remove_temp_file = is_temp_file
         
     try:
         # Extrair parâmetros do JSON
@@ -228,6 +373,17 @@ def get_masks_of_video():
         start_frame = int(request.form.get('start_frame', 0))
         end_frame = int(request.form.get('end_frame', -1))  # -1 significa até o final
         scale_factor = float(request.form.get('scale_factor', 0.5))
+        model_size = request.form.get('model_size', SAM2Segmenter.MODEL_SIZE_TINY)
+        if model_size not in SAM2Segmenter.MODEL_CONFIGS:
+            return jsonify({'error': f'Invalid model size: {model_size}'}), 400
+        frame_feed = request.form.get('frame_feed', SAM2Segmenter.FRAME_FEED_MEMORY)
+        if frame_feed not in SAM2Segmenter.FRAME_FEEDS:
+            return jsonify({'error': f'Invalid frame feed: {frame_feed}'}), 400
+        stream = request.form.get('stream', 'false').lower() in ('1', 'true')
+        # Os stages guardam RLE; a resposta usa PNG por omissão (formato que o editor espera)
+        mask_format = request.form.get('mask_format', MASK_FORMAT_PNG)
+        if mask_format not in MASK_FORMATS:
+            return jsonify({'error': f'Invalid mask format: {mask_format}'}), 400
         
         #points = np.array(json.loads(request.form.get('points')), dtype=np.float32)
         #labels = np.array(json.loads(request.form.get('labels')), dtype=np.int32)
@@ -241,44 +397,20 @@ def get_masks_of_video():
         #if len(points) != len(labels):
         #    return jsonify({'error': 'Points and labels must have the same length'}), 400
         
-        video_objects_json = json.loads(request.form.get("video_objects"))
-        video_objects: List[VideoObjectData] = []
-        for idx, obj in enumerate(video_objects_json):
-            points_raw = obj.get("points")
-            labels_raw = obj.get("labels")
-
-            # Validação
-            if not points_raw or not labels_raw:
-                return jsonify({'error': f'Points and labels cannot be empty (object index {idx})'}), 400
-
-            if len(points_raw) != len(labels_raw):
-                return jsonify({'error': f'Points and labels must have the same length (object index {idx})'}), 400
-
-            # Aplicar fator de escala aos pontos
-            points_scaled = np.array(points_raw, dtype=np.float32) * scale_factor
-            labels = np.array(labels_raw, dtype=np.int32)
-
-            vod = VideoObjectData(
-                points=points_scaled,
-                labels=labels,
-                ann_frame_idx=int(obj.get("ann_frame_idx", 0)),
-                ann_obj_id=int(obj.get("ann_obj_id", 1)),
-            )
-            video_objects.append(vod)
-
-            # Print de debug por objeto
-            print(f"\n[DEBUG] VideoObjectData #{idx}:")
-            print(f"  ann_frame_idx: {vod.ann_frame_idx}")
-            print(f"  ann_obj_id: {vod.ann_obj_id}")
-            print(f"  points.shape: {vod.points.shape if vod.points is not None else 'None'}")
-            print(f"  points (scaled):\n{vod.points}")
-            print(f"  labels:\n{vod.labels}")
+        try:
+            video_objects = parse_video_objects(json.loads(request.form.get("video_objects")), scale_factor)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
                  
         # Obter as dimensões originais do vídeo para calcular o scaling
-        processor = VideoProcessor(temp_path)
-        original_width, original_height = processor.get_size()
-        processor.release()
+        if 'media_id' in request.form:
+            info = MediaStore.probe(request.form['media_id'])
+            original_width, original_height = info['width'], info['height']
+        else:
+            processor = VideoProcessor(temp_path)
+            original_width, original_height = processor.get_size()
+            processor.release()
                     
         print(f'Stage name: {stage_name}')
         print(f"Fator de escala: {scale_factor}")
@@ -287,60 +419,74 @@ def get_masks_of_video():
         print(f"Frame inicial: {start_frame}")
         print(f"Frame final: {end_frame}")
         print(f"Arquivo temporário: {temp_path}")
+        print(f"Frame feed: {frame_feed}")
                 
-        # Criar diretório temporário para os frames processados
+        # Criar diretório temporário para os frames processados (apenas usado com frame_feed='disk')
         output_dir = os.path.join('videos', 'frames', stage_name or 'reg_stage')
-        if stage_name is None:
+        if stage_name is None and frame_feed == SAM2Segmenter.FRAME_FEED_DISK:
             if os.path.exists(output_dir):
                 shutil.rmtree(output_dir)
         
         # Processar o vídeo com SAM2 #video2_test
         serialized_result = (DataSaver.get_stage(stage_name) or {}) if stage_name else {}
-        if not serialized_result:
-            segmenter = SAM2Segmenter()
-            print('Gerando máscaras para o vídeo...')
-            result = segmenter.generate_masks_for_video(
-                video_path=temp_path,
-                video_objects_data=video_objects,
-                output_dir=output_dir,
-                scale_factor=scale_factor,
-                start_frame=start_frame,
-                end_frame=end_frame if end_frame != -1 else None,
-                debug_points=False,
+        
+        def iter_serialized_frames() -> Iterator[Tuple[int, Dict]]:
+            return iter_serialized_video_masks(
+                temp_path, video_objects, output_dir, scale_factor,
+                start_frame, end_frame, model_size, frame_feed
             )
-            
-            print('Size:', len(result.items()))
-            # Converter o resultado para um formato que pode ser enviado por JSON
-            for frame_idx, frame_data in result.items():
-                frame_idx = frame_idx + start_frame
-                serialized_frame = {}
-                for obj_id, mask in frame_data.items():
+        
+        if stream:
+            def generate_ndjson():
+                """Envia uma linha JSON por frame e uma linha final com o track_id"""
+                track_id = stage_name
+                try:
+                    if serialized_result:
+                        for frame_idx, serialized_frame in serialized_result.items():
+                            masks = convert_frame_masks(serialized_frame, mask_format)
+                            yield json.dumps({'frame_idx': frame_idx, 'masks': masks}) + '\n'
+                    else:
+                        # Cada frame é escrito no stage assim que chega; nada fica acumulado em memória
+                        track_id = track_id or unique_filename('stages', prefix='track_masks_stage_', ext='')
+                        with DataSaver.mask_stage_writer(track_id) as writer:
+                            for frame_idx, serialized_frame in iter_serialized_frames():
+                                writer.add_frame(frame_idx, serialized_frame)
+                                masks = convert_frame_masks(serialized_frame, mask_format)
+                                yield json.dumps({'frame_idx': frame_idx, 'masks': masks}) + '\n'
+                        print('Máscaras geradas salvadas no stage:', track_id)
+                        create_clean_plate(temp_path, track_id)
+                    
+                    yield json.dumps({'track_id': track_id, 'done': True}) + '\n'
+                except Exception as e:
+                    traceback.print_exc()
+                    yield json.dumps({'error': str(e)}) + '\n'
+                finally:
                     try:
-                        # Verificação inicial
-                        if mask is None or mask.size == 0:
-                            print(f"Frame {frame_idx}: Máscara vazia")
-                            continue
-                            
-                        # Conversão e codificação
-                        mask_base64 = encode_mask(mask)
-                        
-                        serialized_frame[obj_id] = {
-                            "shape": mask.shape,
-                            "data": f"data:image/png;base64,{mask_base64}"
-                        }
-                                
-                    except Exception as e:
-                        print(f"ERRO no frame {frame_idx}: {str(e)}")
-                        continue
-                
-                serialized_result[frame_idx] = serialized_frame
+                        if is_temp_file:
+                            os.remove(temp_path)
+                    except PermissionError:
+                        print(f"Não foi possível remover o arquivo: {temp_path}")
             
+            remove_temp_file = False
+            return Response(stream_with_context(generate_ndjson()), mimetype='application/x-ndjson')
+        
+        if not serialized_result:
+            serialized_result = {}
             stage_name = stage_name or unique_filename('stages', prefix='track_masks_stage_', ext='')
+            with DataSaver.mask_stage_writer(stage_name) as writer:
+                # Converter o resultado para um formato que pode ser enviado por JSON
+                for frame_idx, serialized_frame in iter_serialized_frames():
+                    writer.add_frame(frame_idx, serialized_frame)
+                    serialized_result[frame_idx] = serialized_frame
+            print('Size:', len(serialized_result))
             print('Máscaras geradas salvadas no stage:', stage_name)
-            DataSaver.add_stage(stage_name, serialized_result)    
+            create_clean_plate(temp_path, stage_name)
         
         return jsonify({
-            'result': serialized_result,  # Enviar o resultado inteiro
+            'result': {  # Enviar o resultado inteiro
+                frame_idx: convert_frame_masks(serialized_frame, mask_format)
+                for frame_idx, serialized_frame in serialized_result.items()
+            },
             'track_id': stage_name
         })
         
@@ -350,10 +496,132 @@ def get_masks_of_video():
     
     finally:
         try:
-            os.remove(temp_path)
+            if remove_temp_file:
+                os.remove(temp_path)
         except PermissionError:
             print(f"Não foi possível remover o arquivo: {temp_path}")
 
+def create_clean_plate(video_path: str, stage_name: str) -> None:
+    """Calcula o clean plate de um stage novo enquanto o vídeo está disponível (o export só o lê)"""
+    try:
+        CleanPlate.create(video_path, stage_name)
+    except Exception as e:
+        print(f'Não foi possível calcular o clean plate do stage {stage_name}: {str(e)}')
+
+@app.route('/video/mask/jobs', methods=['POST'])
+def submit_mask_job():
+    """Recebe os mesmos campos que /video/mask e corre a propagação em background"""
+    if 'video' not in request.files and 'media_id' not in request.form:
+        return jsonify({'error': 'No video file provided'}), 400
+    
+    try:
+        stage_name = request.form.get('stage_name')
+        start_frame = int(request.form.get('start_frame', 0))
+        end_frame = int(request.form.get('end_frame', -1))  # -1 significa até o final
+        scale_factor = float(request.form.get('scale_factor', 0.5))
+        model_size = request.form.get('model_size', SAM2Segmenter.MODEL_SIZE_TINY)
+        frame_feed = request.form.get('frame_feed', SAM2Segmenter.FRAME_FEED_MEMORY)
+        video_objects = parse_video_objects(json.loads(request.form.get("video_objects")), scale_factor)
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if model_size not in SAM2Segmenter.MODEL_CONFIGS:
+        return jsonify({'error': f'Invalid model size: {model_size}'}), 400
+    if frame_feed not in SAM2Segmenter.FRAME_FEEDS:
+        return jsonify({'error': f'Invalid frame feed: {frame_feed}'}), 400
+    
+    # Máscaras já calculadas para este stage
+    if stage_name and DataSaver.get_stage(stage_name):
+        return jsonify({'job_id': None, 'track_id': stage_name, 'status': 'done'})
+    
+    # Um job para o mesmo vídeo e stage ainda na fila ou a correr: devolve-o em vez de repetir a propagação
+    job_key = (request.form.get('media_id'), stage_name) if stage_name else None
+    active_job = SegmentationJobs.active(job_key) if job_key else None
+    if active_job is not None:
+        return jsonify(active_job.to_dict()), 202
+    
+    # O vídeo tem de sobreviver ao pedido; um ficheiro temporário é removido quando o job termina
+    temp_path, is_temp_file = request_video_path()
+    if temp_path is None:
+        return jsonify({'error': 'Vídeo não encontrado'}), 404
+    
+    def remove_temp_file():
+        if not is_temp_file:
+            return
+        try:
+            os.remove(temp_path)
+        except (PermissionError, FileNotFoundError):
+            print(f"Não foi possível remover o arquivo: {temp_path}")
+    
+    try:
+        if is_temp_file:
+            processor = VideoProcessor(temp_path)
+            num_frames = processor.get_num_frames()
+            processor.release()
+        else:
+            num_frames = MediaStore.probe(request.form['media_id'])['frame_count']
+    except Exception as e:
+        remove_temp_file()
+        return jsonify({'error': f'Não foi possível ler o vídeo: {str(e)}'}), 400
+    
+    if num_frames <= 0:
+        remove_temp_file()
+        return jsonify({'error': 'Não foi possível ler o vídeo'}), 400
+    
+    last_frame = min(end_frame, num_frames) if end_frame != -1 else num_frames
+    track_id = stage_name or unique_filename('stages', prefix='track_masks_stage_', ext='')
+    output_dir = os.path.join('videos', 'frames', track_id)
+    
+    job = SegmentationJobs.submit(
+        track_id=track_id,
+        total_frames=max(last_frame - start_frame, 0),
+        frames_factory=lambda: iter_serialized_video_masks(
+            temp_path, video_objects, output_dir, scale_factor,
+            start_frame, end_frame, model_size, frame_feed
+        ),
+        on_finish=remove_temp_file,
+        on_done=lambda: create_clean_plate(temp_path, track_id),
+        key=job_key,
+    )
+    print(f'Job {job.job_id} submetido para o stage {track_id}')
+    return jsonify(job.to_dict()), 202
+
+@app.route('/video/mask/jobs/<job_id>', methods=['GET'])
+def get_mask_job(job_id):
+    """Estado do job: frames propagados, total e ETA em segundos"""
+    job = SegmentationJobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/video/mask/jobs/<job_id>/cancel', methods=['POST'])
+def cancel_mask_job(job_id):
+    job = SegmentationJobs.cancel(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    return jsonify(job.to_dict())
+
+@app.route('/video/mask/jobs/<job_id>/result', methods=['GET'])
+def get_mask_job_result(job_id):
+    """Devolve as máscaras de um job terminado, no mesmo formato que /video/mask"""
+    job = SegmentationJobs.get(job_id)
+    if job is None:
+        return jsonify({'error': 'Job não encontrado'}), 404
+    if job.status != 'done':
+        return jsonify({'error': f'Job ainda não terminou (estado: {job.status})', **job.to_dict()}), 409
+    
+    mask_format = request.args.get('mask_format', MASK_FORMAT_PNG)
+    if mask_format not in MASK_FORMATS:
+        return jsonify({'error': f'Invalid mask format: {mask_format}'}), 400
+    
+    return jsonify({
+        'result': {
+            frame_idx: convert_frame_masks(serialized_frame, mask_format)
+            for frame_idx, serialized_frame in (DataSaver.get_stage(job.track_id) or {}).items()
+        },
+        'track_id': job.track_id
+    })
+
 @app.route('/projects', methods=['POST'])
 def save_project():
     print("\nRota para salvar um projeto\n")
@@ -394,10 +662,19 @@ def save_project():
         traceback.print_exc()
         return jsonify({'error': str(e)}), 500
 
+def apply_preview_options(metadata: Dict) -> Dict:
+    """Aplica `preview_scale` e `preview_fps` do pedido (opcionais) aos metadados do projeto"""
+    preview_scale = request.form.get('preview_scale')
+    preview_fps = request.form.get('preview_fps')
+    if not preview_scale and not preview_fps:
+        return metadata
+    return preview_metadata(metadata, float(preview_scale or 1), float(preview_fps) if preview_fps else None)
+
 @app.route('/download', methods=['POST'])
 def download():
     print("\n=== INÍCIO DA REQUISIÇÃO DE DOWNLOAD ===")
     
+    temp_dir = None
     try:
         user_id = request.form.get('user_id')
 
@@ -411,22 +688,19 @@ def download():
         for key, value in request.headers.items():
             print(f"{key}: {value}")
 
-        # Verificar se há vídeos
-        if 'videos[]' not in request.files:
-            print("\n[ERRO] Nenhum vídeo encontrado nos arquivos enviados")
-            return jsonify({'error': 'Nenhum vídeo enviado'}), 400
-
-        # Obter todos os vídeos
+        # Vídeos enviados; os já guardados com /media vêm em media_ids[] ou no media_id de cada elemento
+        media_ids = request.form.getlist('media_ids[]')
         videos = request.files.getlist('videos[]')
-        print(f"\n[VIDEOS ENVIADOS] {len(videos)} vídeo(s) recebido(s)")
+        print(f"\n[VIDEOS ENVIADOS] {len(videos)} vídeo(s) recebido(s), {len(media_ids)} guardado(s)")
         
         for idx, video in enumerate(videos):
             print(f"\nVideo {idx + 1}:")
             print(f"Nome: {video.filename}")
             print(f"Tipo: {video.content_type}")
-            print(f"Tamanho: {len(video.read())} bytes")
-            video.seek(0)  # Volta ao início do arquivo após ler
-
+            video.stream.seek(0, os.SEEK_END)  # Tamanho sem ler o ficheiro para memória
+            print(f"Tamanho: {video.stream.tell()} bytes")
+            video.stream.seek(0)
+        
         # Obter metadados (se existirem)
         metadata = {}
         if 'metadata' in request.form:
@@ -436,208 +710,47 @@ def download():
         else:
             print("\n[AVISO] Nenhum metadado recebido")
 
-        fps = metadata.get('fps', None)
+        try:
+            video_sources = request_project_videos(metadata)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        missing = missing_media_ids(video_sources)
+        if missing:
+            return jsonify({'error': 'Vídeo não encontrado', 'missing_media_ids': missing}), 404
+
         width = metadata.get('width', None)
         height = metadata.get('height', None)
-        enable_transparency = metadata.get('enable_transparency', True)
         if not width or not height:
             print("\n[AVISO] Nenhuma largura ou altura especificada nos metadados")
             return jsonify({'error': 'Largura ou altura não especificada nos metadados'}), 400
 
+        # Pré-visualização rápida: resolução e fps reduzidos, preset ultrafast
+        try:
+            metadata = apply_preview_options(metadata)
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
         # Cria pasta de projetos para o user_id
         user_folder = os.path.join('projects', str(user_id))
         os.makedirs(user_folder, exist_ok=True)
 
         # Criar diretório temporário
         temp_dir = tempfile.mkdtemp()
-        compositor = VideoCompositor(
-            output_path=os.path.join(temp_dir, f'output.mp4'),
-            output_width=width,  # Ajuste conforme necessário
-            output_height=height,
-            fps=fps
-        )
-        effectProcessor = VideoEffectsProcessor()
-        animationProcessor = VideoAnimationProcessor()
-
-        elements_metadata = metadata.get('elements_data', {})
-        video_data = {}
-        count_video = 0
-        for idx, video_id in enumerate(elements_metadata.keys()):
-            element_metadata = elements_metadata.get(video_id, {})
-            if not element_metadata:
-                print(f"\n[AVISO] Nenhum metadado encontrado para o vídeo {video_id}")
-                print('\tVideos data:', elements_metadata)
-                print('\tVideo metadata:', element_metadata)
-                continue
-            element_type = element_metadata.get('type', 'video')
-            rotation = element_metadata.get('rotation', 0)
-            flipped = element_metadata.get('flipped', False)
-            opacity = element_metadata.get('opacity', 1.0)
-            border_radius = element_metadata.get('borderRadius', 0)
-            speed = element_metadata.get('speed', 1)
-            draw = element_metadata.get('draw', True)
-            st_offset = element_metadata.get('st_offset', 0)
-            start_t = element_metadata.get('start_t', 0)
-            end_t = element_metadata.get('end_t', None)
-            effects = element_metadata.get('effects', {})
-            animations = element_metadata.get('animations', [])
-            rect = Rect(
-                int(element_metadata.get('x', 0)),
-                int(element_metadata.get('y', 0)),
-                int(element_metadata.get('width', None)),
-                int(element_metadata.get('height', None))
-            )
-            
-            if element_type == 'video':
-                chromaKeyData = element_metadata.get('chromaKeyDetectionData', {})
-                stageMasks = element_metadata.get('stageMasks', None)
-                masks = decode_masks(DataSaver.get_stage(stageMasks) or {}) if stageMasks else None    
-                video_file = videos[count_video]   
-                count_video += 1                 
-                video_data[idx] = {
-                    'idx': idx,
-                    'video_id': video_id,
-                    'video_file': video_file,
-                    'effects': effects,
-                    'animations': animations,
-                    'stageMasks': stageMasks,
-                    'masks': masks,
-                    'chromaKeyData': chromaKeyData,
-                    'rect': rect,
-                    'extra_data': {},
-                    'rotation': rotation,
-                    'flipped': flipped,
-                    'draw': draw,
-                }
-                video_input = os.path.join(temp_dir, f'input_{video_id}.mp4')
-                video_file.save(video_input)
-                
-            elif element_type == 'text':
-                text = element_metadata.get('text', '')
-                style = element_metadata.get('style', {})
-                font_family = style.get('fontFamily', 'Raleway')
-                font_size = style.get('fontSize', 20)
-                color = style.get('color', '#FFFFFF')
-                bold = style.get('fontWeight', 'normal')
-                italic = style.get('fontStyle', '')
-                align = style.get('textAlign', 'left')
-                
-                video_data[idx] = {
-                    'idx': idx,
-                    'video_id': video_id,
-                    'effects': effects,
-                    'animations': animations,
-                    'rect': rect,
-                    'extra_data': {},
-                    'rotation': rotation,
-                    'flipped': flipped,
-                    'draw': draw,
-                }
-                
-                # Set the duration of the video clip based on start and end times, or default to 5 seconds if either is missing
-                duration = end_t - start_t if start_t and end_t else 5
-                
-                # Use the given fps, or default to 1 frame per second if not specified
-                text_fps = fps or 1
-                
-                # Determine if the text should be bold — either by numeric weight (>=700) or by string comparison
-                is_bold = bold == int(bold) >= 700 if isinstance(bold, int) else bold == 'bold'
-                
-                # Check if the text style includes italic formatting
-                is_italic = 'italic' in italic
-                
-                # Create a single text frame (image) with the given parameters (font, size, color, etc.)
-                text_frame = create_text_frame(text, font_family, font_size, color, is_bold, is_italic,
-                                               align, rect.width, rect.height)
-                
-                # Replicate the static frame into a video array to simulate a video at the specified FPS
-                text_frames = replicate_frame_as_video_array(text_frame, duration, text_fps)
-                
-                # Create a VideoArray object using the generated frames and FPS
-                video_input = VideoArray(text_frames, text_fps)
-              
-            # Add layer with settings
-            compositor.add_layer(LayerInfo(
-                video=video_input, # Video file or VideoArray
-                rect=rect, # Rect object with x, y, width, height
-                layer_idx=idx, # Layer index
-                st_offset=st_offset, # Start time offset in seconds
-                start_t=start_t, # Start time in seconds
-                end_t=end_t, # End time in seconds (None means until the end of the video)
-                rotation=rotation, # Rotation in degrees
-                speed=speed, # Speed multiplier
-                flipped=flipped, # Whether the video is flipped horizontally
-                draw=draw, # Whether to draw the video
-                opacity=opacity, # Opacity of the video layer (0.0 to 1.0)
-                border_radius=border_radius, # Border radius for rounded corners
-            ))
+        output_path = os.path.join(temp_dir, f'output.mp4')
         
-        def process_frame(
-            render_info: RenderInfo, 
-            frame: np.ndarray, 
-            frame_idx: int, 
-            fps: int, 
-            layer_width: int, 
-            layer_height: int, 
-            roi_info: RoiInfo,
-            render_infos: List[RenderInfo],
-            video_time: float,
-            global_time: float,
-            processing_stage: int,
-        ) -> np.ndarray:
-            """Função de callback para processar cada frame"""
-            video_idx = render_info.layer.layer_idx
-            if video_idx not in video_data:
-                return frame
-            
-            rect = video_data[video_idx].get('rect', None)
-            masks = video_data[video_idx].get('masks', None)
-            effects_config = video_data[video_idx].get('effects', {})
-            chromaKeyData = video_data[video_idx].get('chromaKeyData', {})
-            extra_data = video_data[video_idx].get('extra_data', None)
-            rotation = video_data[video_idx].get('rotation', 0)
-            flipped = video_data[video_idx].get('flipped', False)
-            animations = video_data[video_idx].get('animations', [])
-                        
-            if processing_stage == PROCESS_STAGE_POST_TRANSFORM:
-                return effectProcessor.process_post_transform(
-                    render_info, frame, masks, effects_config, 
-                    chromaKeyData, enable_transparency, frame_idx,
-                    layer_width, layer_height, roi_info,
-                    rect, video_data, extra_data, rotation, flipped, render_infos, video_time
-                )
-            else:
-                frame = animationProcessor.process_animations(frame, animations, global_time, render_info)
-                
-                return effectProcessor.process_pre_transform(
-                    render_info, frame, masks, effects_config, 
-                    chromaKeyData, enable_transparency, frame_idx,
-                    layer_width, layer_height,
-                    rect, video_data, extra_data, flipped, render_infos, video_time
-                )
-                
-        compositor.render(on_frame=process_frame)
+        # Um vídeo por elemento do tipo 'video' (ver request_project_videos)
+        video_paths = save_project_videos(video_sources, temp_dir)
+        
+        # O compositor já escreve o ficheiro final em H.264 (sem re-encode com comp_browser).
+        # Com RENDER_PROCESSES > 1 a timeline é renderizada em troços paralelos (ver project_renderer)
+        render_project(metadata, video_paths, output_path)
 
 
         # Retorna o primeiro vídeo processado
-        print("\n[RESPOSTA] Enviando vídeo processado:", compositor.output_path)
-            
-        fd, path = tempfile.mkstemp(suffix='.mp4')
-        os.close(fd)  # Fecha o file descriptor
-
-        temp_path = Path(path)
-
-        comp_browser(
-            input_path=compositor.output_path,
-            output_path=temp_path,
-            crf=23,
-            preset='fast',
-            audio_codec='aac',
-            video_codec='libx264'
-        )
+        print("\n[RESPOSTA] Enviando vídeo processado:", output_path)
 
         return send_file(
-            temp_path,
+            output_path,
             as_attachment=True,
             download_name='video_processado.mp4'
         )
@@ -649,13 +762,65 @@ def download():
     finally:
         # Limpeza dos arquivos temporários
         try:
-            os.remove(compositor.output_path)
-            os.remove(temp_path)
+            if temp_dir:
+                shutil.rmtree(temp_dir)
         except Exception as e:
             print("Erro na limpeza:", str(e))
         
         print("\n=== FIM DA REQUISIÇÃO ===")
 
+@app.route('/render/frame', methods=['POST'])
+def render_frame():
+    """
+    Renderiza um único frame composto (máscaras, chroma key, overlap, blend) no instante `time`.
+    Recebe os mesmos campos que /download, mais `time` (segundos), `format` (jpeg ou png) e `quality`.
+    """
+    try:
+        metadata = json.loads(request.form.get('metadata', '{}'))
+        if metadata.get('width') and metadata.get('height'):
+            metadata = apply_preview_options(metadata)
+        time_s = float(request.form.get('time', 0))
+        image_format = request.form.get('format', 'jpeg').lower()
+        quality = int(request.form.get('quality', 85))
+    except (TypeError, ValueError) as e:
+        return jsonify({'error': str(e)}), 400
+    
+    if image_format not in ('jpeg', 'jpg', 'png'):
+        return jsonify({'error': f'Formato inválido: {image_format}'}), 400
+    if not metadata.get('width') or not metadata.get('height'):
+        return jsonify({'error': 'Largura ou altura não especificada nos metadados'}), 400
+    
+    try:
+        video_sources = request_project_videos(metadata)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    missing = missing_media_ids(video_sources)
+    if missing:
+        return jsonify({'error': 'Vídeo não encontrado', 'missing_media_ids': missing}), 404
+    
+    try:
+        # Projetos já montados (vídeos em disco, captures abertas, máscaras) são reutilizados entre pedidos
+        # O media_id já é a hash do conteúdo
+        video_digests = [
+            source if isinstance(source, str) else file_sha256(source.stream)
+            for source in video_sources
+        ]
+        with PreviewProjects.use(metadata, video_digests, lambda folder: save_project_videos(video_sources, folder)) as project:
+            frame = project.render_frame(time_s, metadata)
+        if frame is None:
+            return jsonify({'error': f'Instante fora da timeline: {time_s}'}), 400
+        
+        if image_format == 'png':
+            _, buffer = cv2.imencode('.png', frame)
+            mimetype = 'image/png'
+        else:
+            _, buffer = cv2.imencode('.jpg', frame, [cv2.IMWRITE_JPEG_QUALITY, quality])
+            mimetype = 'image/jpeg'
+        return Response(buffer.tobytes(), mimetype=mimetype)
+    except Exception as e:
+        traceback.print_exc()
+        return jsonify({'error': str(e)}), 500
+
 # app.register_blueprint(auth_bp, url_prefix='/auth')
 
 if __name__ == '__main__':
@@ -0,0 +1,168 @@
+"""
+Clean plate: o fundo de um vídeo sem os objetos de uma track de máscaras.
+
+Para o `backgroundRemoveEffect`, em vez de ir buscar (com um seek) um frame próximo onde o
+objeto não está, o objeto é apagado com uma cópia do plate. O plate é calculado uma vez por
+track, numa passagem para a frente pelo vídeo (`IndexedVideoReader`): em cada píxel é a mediana
+temporal dos frames amostrados onde nenhum objeto (máscara dilatada) o cobre, à resolução do vídeo
+(para a cópia não ficar desfocada). É calculado quando
+o stage das máscaras é criado (o vídeo ainda está disponível) e fica guardado ao lado do stage,
+em `stages/<stage>.plate.npz`; o export só o lê.
+
+Tal como a substituição por outro frame, assume que a câmara está parada.
+"""
+import os
+import tempfile
+import threading
+from typing import *
+
+import cv2
+import numpy as np
+
+from data_saver import DataSaver
+from seek_index import IndexedVideoReader
+from utils import DecodedMasks, get_interpolated_numbers
+
+PLATE_SUFFIX = '.plate.npz'
+PLATE_VERSION = 2 # Plates sem versão eram guardados a uma resolução reduzida e não são usados
+
+class CleanPlate:
+    """Imagem do fundo (BGR) e máscara dos píxeis onde o fundo chegou a ser visto."""
+    MAX_SAMPLES = 24 # Frames amostrados para a mediana (num ficheiro temporário mapeado em memória)
+    MASK_DILATION = 15 # Como em erase_object_with_replacement: as bordas das máscaras não contam como fundo
+    CHUNK_ROWS = 64 # Linhas por bloco no cálculo da mediana
+
+    def __init__(self, image: np.ndarray, valid: np.ndarray) -> None:
+        self.image = image
+        self.valid = valid
+        self._resized: Dict[Tuple, Tuple[np.ndarray, np.ndarray]] = {}
+        self._lock = threading.Lock()
+
+    def resized(self, size: Tuple[int, int], flipped: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+        """(imagem, máscara de validade 0/255) no tamanho da layer (largura, altura), espelhadas se `flipped`"""
+        key = (size, flipped)
+        with self._lock:
+            if key not in self._resized:
+                shrinking = size[0] < self.image.shape[1] or size[1] < self.image.shape[0]
+                image = cv2.resize(self.image, size, interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_LINEAR)
+                valid = cv2.resize(self.valid.astype(np.uint8) * 255, size, interpolation=cv2.INTER_NEAREST)
+                if flipped:
+                    image, valid = cv2.flip(image, 1), cv2.flip(valid, 1)
+                self._resized[key] = (image, valid)
+            return self._resized[key]
+
+    def erase(self, frame: np.ndarray, mask: np.ndarray, flipped: bool = False) -> Optional[np.ndarray]:
+        """
+        Apaga o objeto copiando o plate para os píxeis de `mask` (binária, já dilatada, no tamanho do frame).
+
+        Returns:
+            O frame com o objeto apagado (mantém o alpha se existir), ou None se o plate não cobrir
+            toda a máscara (ex: o fundo atrás do objeto nunca foi visto).
+        """
+        height, width = frame.shape[:2]
+        image, valid = self.resized((width, height), flipped)
+        if cv2.countNonZero(cv2.bitwise_and(mask, cv2.bitwise_not(valid))):
+            return None
+
+        result = frame.copy()
+        np.copyto(result[:, :, :3], image, where=mask[:, :, None] > 0)
+        return result
+
+    @staticmethod
+    def path(stage_name: str) -> str:
+        return os.path.join(DataSaver._FOLDER_PATH, stage_name + PLATE_SUFFIX)
+
+    @staticmethod
+    def build(video_path: str, masks: Mapping) -> Optional['CleanPlate']:
+        """
+        Calcula o plate numa passagem pelo vídeo, com `MAX_SAMPLES` frames equidistantes da track.
+        O plate tem a resolução do vídeo: os frames amostrados vão para um ficheiro temporário mapeado
+        em memória e a mediana é calculada por blocos de linhas, por isso só um bloco fica em RAM.
+
+        Args:
+            masks: Máscaras da track ({frame_idx: {obj_id: máscara 2D}}, ex: DecodedMasks).
+        """
+        frame_indices = sorted(masks)
+        if not frame_indices:
+            return None
+        positions = get_interpolated_numbers(0, len(frame_indices) - 1, min(CleanPlate.MAX_SAMPLES, len(frame_indices)))
+        samples = sorted(set(frame_indices[i] for i in positions))
+
+        kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*CleanPlate.MASK_DILATION+1, 2*CleanPlate.MASK_DILATION+1))
+        with tempfile.TemporaryFile() as frames_file, tempfile.TemporaryFile() as occluded_file:
+            frames = occluded = None
+            count = 0
+            reader = IndexedVideoReader(video_path, cache_size=0)
+            try:
+                for frame_idx in samples:
+                    ret, frame = reader.read(frame_idx)
+                    if not ret:
+                        break # O nº de frames do container pode estar sobrestimado
+                    height, width = frame.shape[:2]
+                    if frames is None:
+                        frames = np.memmap(frames_file, dtype=np.uint8, mode='w+', shape=(len(samples), height, width, 3))
+                        occluded = np.memmap(occluded_file, dtype=bool, mode='w+', shape=(len(samples), height, width))
+                    objects = np.zeros((height, width), dtype=np.uint8)
+                    for mask in masks[frame_idx].values():
+                        if mask.shape[:2] != (height, width):
+                            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+                        cv2.max(objects, mask, dst=objects)
+                    frames[count] = frame[:, :, :3]
+                    occluded[count] = cv2.dilate(objects, kernel) > 0
+                    count += 1
+            finally:
+                reader.release()
+            if not count:
+                return None
+
+            frames, occluded = frames[:count], occluded[:count]
+            image = np.zeros(frames.shape[1:], dtype=np.uint8)
+            valid = np.zeros(frames.shape[1:3], dtype=bool)
+
+            # Mediana só dos frames onde o píxel é fundo: os ocultos vão para o fim da ordenação
+            for y in range(0, image.shape[0], CleanPlate.CHUNK_ROWS):
+                rows = slice(y, y + CleanPlate.CHUNK_ROWS)
+                hidden = np.asarray(occluded[:, rows])
+                values = frames[:, rows].astype(np.uint16)
+                values[hidden] = np.iinfo(np.uint16).max
+                values.sort(axis=0)
+                visible = (~hidden).sum(axis=0)
+                median_idx = np.maximum(visible - 1, 0) // 2
+                image[rows] = np.take_along_axis(values, median_idx[None, :, :, None], axis=0)[0]
+                valid[rows] = visible > 0
+            del frames, occluded
+        image[~valid] = 0
+        return CleanPlate(image, valid)
+
+    @staticmethod
+    def open(stage_name: str) -> Optional['CleanPlate']:
+        """Plate guardado ao lado do stage; None se não existir, se o stage for mais recente ou se for de outra versão"""
+        path = CleanPlate.path(stage_name)
+        try:
+            if os.path.getmtime(path) >= os.path.getmtime(os.path.join(DataSaver._FOLDER_PATH, stage_name)):
+                with np.load(path) as data:
+                    if 'version' in data.files and int(data['version']) == PLATE_VERSION:
+                        return CleanPlate(data['image'], data['valid'])
+        except (OSError, ValueError, KeyError):
+            pass
+        return None
+
+    @staticmethod
+    def create(video_path: str, stage_name: str) -> Optional['CleanPlate']:
+        """Calcula e guarda o plate de um stage de máscaras (chamado quando o stage é criado, com o vídeo do stage)"""
+        masks = DecodedMasks(DataSaver.get_stage(stage_name) or {})
+        plate = CleanPlate.build(video_path, masks)
+        if plate is None:
+            return None
+
+        temp_path = None
+        try:
+            fd, temp_path = tempfile.mkstemp(dir=DataSaver._FOLDER_PATH, suffix='.npz')
+            with os.fdopen(fd, 'wb') as file:
+                np.savez_compressed(file, image=plate.image, valid=plate.valid, version=PLATE_VERSION)
+            os.replace(temp_path, CleanPlate.path(stage_name))
+        except OSError as e:
+            print(f'[CleanPlate] Não foi possível guardar o plate de {stage_name}: {str(e)}')
+            if temp_path is not None and os.path.exists(temp_path):
+                os.remove(temp_path)
+        return plate
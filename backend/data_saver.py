@@ -1,6 +1,7 @@
 import os
 import dill
 from typing import *
+from mask_stage import MaskStage, MaskStageWriter, is_mask_stage_file
 
 class DataSaver:
     _FOLDER_PATH = 'stages'
@@ -24,10 +25,28 @@ class DataSaver:
                 os.remove(temp_path)
             raise Exception(f"Failed to save data: {str(e)}")
 
+    @staticmethod
+    def add_mask_stage(stage_name: str, frames: Mapping[int, Dict[int, Dict]]) -> None:
+        """Guarda um stage de máscaras ({frame_idx: {obj_id: mask_info}}) no formato binário indexado."""
+        with DataSaver.mask_stage_writer(stage_name) as writer:
+            for frame_idx, serialized_frame in frames.items():
+                writer.add_frame(frame_idx, serialized_frame)
+
+    @staticmethod
+    def mask_stage_writer(stage_name: str) -> MaskStageWriter:
+        """Writer para guardar as máscaras frame a frame, à medida que são geradas."""
+        return MaskStageWriter(os.path.join(DataSaver._FOLDER_PATH, stage_name))
+
     @staticmethod
     def get_stage(stage_name: str) -> Optional[object]:
+        path = os.path.join(DataSaver._FOLDER_PATH, stage_name)
+        
+        # Stages de máscaras são lidos de forma preguiçosa, sem unpickling
+        if is_mask_stage_file(path):
+            return MaskStage(path)
+        
         try:
-            with open(os.path.join(DataSaver._FOLDER_PATH, stage_name), 'rb') as file:  
+            with open(path, 'rb') as file:  
                 try:
                     return dill.load(file)
                 except EOFError:
@@ -0,0 +1,162 @@
+"""
+Formato binário dos stages de máscaras (em vez de pickles com dill).
+
+    header  : magic (8s) | versão (u32) | nº de entradas (u32) | offset do índice (u64)
+    chunks  : counts RLE (string ASCII do COCO) de cada (frame, objeto), pela ordem de escrita
+    índice  : uma entrada INDEX_DTYPE por (frame, objeto), no fim do ficheiro
+
+O índice é escrito no fim para que as máscaras possam ser acrescentadas à medida
+que são propagadas. Na leitura, o ficheiro é mapeado em memória e só os chunks
+dos frames acedidos são lidos.
+"""
+import os
+import struct
+import tempfile
+from typing import *
+from collections.abc import Mapping
+
+import numpy as np
+
+from utils import MASK_FORMAT_RLE, convert_frame_masks
+
+MAGIC = b'SAM2MSK\0'
+VERSION = 1
+HEADER = struct.Struct('<8sIIQ')
+INDEX_DTYPE = np.dtype([
+    ('frame_idx', '<i4'),
+    ('obj_id', '<i4'),
+    ('offset', '<u8'),
+    ('length', '<u4'),
+    ('ndim', '<u4'),
+    ('shape', '<u4', (3,)), # Shape original da máscara (ex: (1, H, W) vindo do SAM2)
+    ('size', '<u4', (2,)), # Altura e largura do RLE
+])
+
+def is_mask_stage_file(path: str) -> bool:
+    """Verifica se o ficheiro está no formato binário de stages de máscaras"""
+    try:
+        with open(path, 'rb') as file:
+            return file.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+class MaskStageWriter:
+    """
+    Escreve um stage de máscaras frame a frame.
+
+    Escreve para um ficheiro temporário único (mkstemp) na pasta de `path` e só substitui `path` em
+    `close()`: dois writers do mesmo stage não escrevem no mesmo ficheiro, o último a fechar fica.
+    Usado como context manager, descarta o ficheiro temporário se houver uma exceção.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        fd, self.temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', prefix=os.path.basename(path) + '.', suffix='.tmp')
+        self.entries: List[Tuple] = []
+        self.file = os.fdopen(fd, 'wb')
+        self.file.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+
+    def add_frame(self, frame_idx: int, serialized_frame: Dict[int, Dict]) -> None:
+        """Acrescenta as máscaras serializadas de um frame ({obj_id: mask_info}); PNG é convertido para RLE"""
+        for obj_id, mask_info in convert_frame_masks(serialized_frame, MASK_FORMAT_RLE).items():
+            counts = mask_info['counts'].encode('ascii')
+            shape = tuple(int(d) for d in mask_info.get('shape', mask_info['size']))
+            if len(shape) > 3:
+                raise ValueError(f'Formato de máscara não suportado: {shape}')
+
+            offset = self.file.tell()
+            self.file.write(counts)
+            padded_shape = shape + (0,) * (3 - len(shape))
+            size = tuple(int(d) for d in mask_info['size'])
+            self.entries.append((int(frame_idx), int(obj_id), offset, len(counts), len(shape), padded_shape, size))
+
+    def close(self) -> None:
+        """Escreve o índice, atualiza o header e move o ficheiro para o caminho final"""
+        if self.file is None:
+            return
+        index = np.array(self.entries, dtype=INDEX_DTYPE)
+        index_offset = self.file.tell()
+        self.file.write(index.tobytes())
+        self.file.seek(0)
+        self.file.write(HEADER.pack(MAGIC, VERSION, len(index), index_offset))
+        self.file.close()
+        self.file = None
+        os.replace(self.temp_path, self.path)
+
+    def abort(self) -> None:
+        """Descarta o que foi escrito"""
+        if self.file is None:
+            return
+        self.file.close()
+        self.file = None
+        if os.path.exists(self.temp_path):
+            os.remove(self.temp_path)
+
+    def __enter__(self) -> 'MaskStageWriter':
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback) -> None:
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+
+class MaskStage(Mapping):
+    """
+    Leitura preguiçosa de um stage de máscaras: {frame_idx: {obj_id: mask_info RLE}}.
+
+    Cada acesso a um frame lê apenas os chunks desse frame do ficheiro mapeado em memória.
+    Os dicts devolvidos têm o mesmo formato que `serialize_mask(..., MASK_FORMAT_RLE)`.
+    """
+    def __init__(self, path: str) -> None:
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode='r')
+        magic, version, num_entries, index_offset = HEADER.unpack(self.data[:HEADER.size].tobytes())
+        if magic != MAGIC:
+            raise ValueError(f'{path} não é um stage de máscaras')
+        if version != VERSION:
+            raise ValueError(f'Versão de stage não suportada: {version}')
+
+        self.index = np.frombuffer(self.data, dtype=INDEX_DTYPE, count=num_entries, offset=index_offset)
+
+        # Agrupa as entradas do índice por frame (sem ler nenhuma máscara)
+        order = np.argsort(self.index['frame_idx'], kind='stable')
+        frames, starts = np.unique(self.index['frame_idx'][order], return_index=True)
+        ends = np.append(starts[1:], len(order))
+        self._frames: Dict[int, np.ndarray] = {
+            int(frame_idx): order[start:end] for frame_idx, start, end in zip(frames, starts, ends)
+        }
+
+    def _read_entry(self, entry: np.void) -> Dict:
+        offset, length = int(entry['offset']), int(entry['length'])
+        shape = tuple(int(d) for d in entry['shape'][:int(entry['ndim'])])
+        return {
+            'shape': shape,
+            'format': MASK_FORMAT_RLE,
+            'size': [int(d) for d in entry['size']],
+            'counts': self.data[offset:offset + length].tobytes().decode('ascii'),
+        }
+
+    def object_ids(self, frame_idx: int) -> List[int]:
+        """IDs dos objetos com máscara num frame (lidos apenas do índice)"""
+        return [int(self.index[i]['obj_id']) for i in self._frames.get(frame_idx, ())]
+
+    def get_mask(self, frame_idx: int, obj_id: int) -> Optional[Dict]:
+        """Lê apenas a máscara de um objeto num frame"""
+        for i in self._frames.get(frame_idx, ()):
+            if int(self.index[i]['obj_id']) == obj_id:
+                return self._read_entry(self.index[i])
+        return None
+
+    def __getitem__(self, frame_idx: int) -> Dict[int, Dict]:
+        if frame_idx not in self._frames:
+            raise KeyError(frame_idx)
+        return {int(self.index[i]['obj_id']): self._read_entry(self.index[i]) for i in self._frames[frame_idx]}
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._frames)
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __contains__(self, frame_idx: object) -> bool:
+        return frame_idx in self._frames
@@ -0,0 +1,144 @@
+"""
+Armazenamento dos vídeos enviados, endereçado pelo conteúdo.
+
+Cada vídeo é guardado uma só vez em `media/<sha256>.mp4`, com os metadados (fps, nº de
+frames, tamanho) em `media/<sha256>.json`. Os endpoints recebem o `media_id` em vez do
+ficheiro, por isso um vídeo que já está no servidor não volta a ser enviado.
+"""
+import os
+import re
+import json
+import time
+import hashlib
+import tempfile
+from typing import *
+
+from video_processor import VideoProcessor
+from seek_index import SeekIndex
+from thumbnails import Thumbnails
+
+MEDIA_ID_PATTERN = re.compile(r'^[0-9a-f]{64}$')
+
+class MediaStore:
+    _FOLDER_PATH = 'media'
+    MEDIA_TTL = 7 * 24 * 60 * 60 # Vídeos sem acessos durante uma semana são removidos
+    CHUNK_SIZE = 1024 * 1024
+    if not os.path.exists(_FOLDER_PATH):
+        os.mkdir(_FOLDER_PATH)
+
+    @staticmethod
+    def is_media_id(media_id: str) -> bool:
+        return isinstance(media_id, str) and MEDIA_ID_PATTERN.match(media_id) is not None
+
+    @staticmethod
+    def _media_path(media_id: str) -> str:
+        return os.path.join(MediaStore._FOLDER_PATH, media_id + '.mp4')
+
+    @staticmethod
+    def _probe_path(media_id: str) -> str:
+        return os.path.join(MediaStore._FOLDER_PATH, media_id + '.json')
+
+    @staticmethod
+    def _touch(path: str) -> None:
+        """Regista um acesso para `prune` (no atime; o mtime indica quando o conteúdo mudou, ver SeekIndex)"""
+        os.utime(path, (time.time(), os.path.getmtime(path)))
+
+    @staticmethod
+    def put(stream: BinaryIO) -> str:
+        """
+        Guarda o conteúdo de `stream`, lido por blocos enquanto é calculada a hash.
+
+        Returns:
+            str: O `media_id` (SHA-256 do conteúdo). Se o vídeo já existia, o novo ficheiro é descartado.
+        """
+        MediaStore.prune()
+        digest = hashlib.sha256()
+        fd, temp_path = tempfile.mkstemp(dir=MediaStore._FOLDER_PATH, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                for chunk in iter(lambda: stream.read(MediaStore.CHUNK_SIZE), b''):
+                    digest.update(chunk)
+                    file.write(chunk)
+
+            media_id = digest.hexdigest()
+            final_path = MediaStore._media_path(media_id)
+            if os.path.exists(final_path):
+                os.remove(temp_path)
+                MediaStore._touch(final_path)
+            else:
+                os.replace(temp_path, final_path)
+            return media_id
+        except BaseException:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+
+    @staticmethod
+    def get_path(media_id: str) -> Optional[str]:
+        """Caminho do vídeo guardado, ou None se o `media_id` não existir"""
+        if not MediaStore.is_media_id(media_id):
+            return None
+        path = MediaStore._media_path(media_id)
+        if not os.path.exists(path):
+            return None
+        MediaStore._touch(path)
+        return path
+
+    @staticmethod
+    def probe(media_id: str) -> Optional[Dict[str, Any]]:
+        """Metadados do vídeo (fps, frame_count, width, height, size); calculados no primeiro pedido"""
+        path = MediaStore.get_path(media_id)
+        if path is None:
+            return None
+
+        probe_path = MediaStore._probe_path(media_id)
+        try:
+            with open(probe_path) as file:
+                return json.load(file)
+        except (FileNotFoundError, json.JSONDecodeError):
+            pass
+
+        processor = VideoProcessor(path)
+        try:
+            width, height = processor.get_size()
+            info = {
+                'media_id': media_id,
+                'fps': processor.get_fps(),
+                'frame_count': processor.get_num_frames(),
+                'width': width,
+                'height': height,
+                'size': os.path.getsize(path),
+            }
+        finally:
+            processor.release()
+
+        # Pedidos em paralelo para o mesmo vídeo escrevem cada um no seu temporário
+        fd, temp_path = tempfile.mkstemp(dir=MediaStore._FOLDER_PATH, suffix='.tmp')
+        with os.fdopen(fd, 'w') as file:
+            json.dump(info, file)
+        os.replace(temp_path, probe_path)
+        return info
+
+    @staticmethod
+    def prune() -> None:
+        """
+        Remove os vídeos (com os metadados, o índice de seek e as miniaturas) sem acessos há mais de
+        `MEDIA_TTL` segundos, e as miniaturas que também não são pedidas há esse tempo.
+        """
+        now = time.time()
+        removed = []
+        for name in os.listdir(MediaStore._FOLDER_PATH):
+            media_id, ext = os.path.splitext(name)
+            if ext != '.mp4' or not MediaStore.is_media_id(media_id):
+                continue
+            path = os.path.join(MediaStore._FOLDER_PATH, name)
+            try:
+                if now - os.path.getatime(path) > MediaStore.MEDIA_TTL:
+                    os.remove(path)
+                    removed.append(media_id)
+                    for sidecar_path in (MediaStore._probe_path(media_id), SeekIndex.index_path(path)):
+                        if os.path.exists(sidecar_path):
+                            os.remove(sidecar_path)
+            except FileNotFoundError:
+                pass # Removido por outro pedido
+        Thumbnails.prune(MediaStore.MEDIA_TTL, removed)
@@ -0,0 +1,633 @@
+"""
+Render dos projetos exportados em /download.
+
+`build_project` monta o VideoCompositor e o callback de efeitos a partir dos metadados
+do projeto. `render_project` renderiza-o num só processo ou, com `processes > 1`, divide
+a timeline em troços renderizados em processos separados (cada um com as suas captures)
+e junta-os com o concat demuxer do ffmpeg, sem voltar a codificar.
+
+Cada troço corre como `python project_renderer.py <spec.json>`, para que os processos
+não importem a app Flask nem os modelos SAM2.
+
+`preview_metadata` reduz um projeto a uma pré-visualização (resolução e fps menores, encoder
+mais rápido) escalando todas as coordenadas em píxeis da mesma forma.
+
+`PreviewProjects` mantém projetos já montados (vídeos em disco, captures abertas, máscaras
+descodificadas) para renderizar frames isolados, ex: scrubbing na timeline. Mudar só os efeitos
+de um projeto reutiliza-o (`configure_effects`).
+"""
+import os
+import sys
+import copy
+import json
+import shutil
+import subprocess
+import tempfile
+import hashlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from dataclasses import dataclass
+from typing import *
+
+import cv2
+import numpy as np
+
+from video_compositor import *
+from video_effects_processor import VideoEffectsProcessor, ColorLUT
+from video_animation_processor import VideoAnimationProcessor
+from data_saver import DataSaver
+from clean_plate import CleanPlate
+from utils import DecodedMasks, replicate_frame_as_video_array
+from text_generator import create_text_frame
+
+RENDER_PROCESSES = int(os.environ.get('RENDER_PROCESSES', 1))
+MIN_SEGMENT_SECONDS = 2.0 # Troços mais curtos não compensam o arranque de um processo
+PREVIEW_PRESET = 'ultrafast'
+PREVIEW_CRF = 28
+MIN_PREVIEW_SCALE = 0.1
+EFFECT_FIELDS = ('effects', 'animations', 'chromaKeyDetectionData') # Campos de cada elemento aplicados por configure_effects
+
+def preview_metadata(metadata: Dict, scale: float, fps: Optional[float] = None) -> Dict:
+    """
+    Cópia dos metadados para uma pré-visualização à escala `scale` (ex: 0.25 a 0.5).
+
+    Escala o canvas, o rect, o border radius e o tamanho da fonte de cada elemento, o raio do
+    blur, a posição do chroma key e os pontos das animações de movimento. O resto (máscaras,
+    frames de blend, overlap, vinheta) segue os rects das layers, por isso fica consistente.
+    Com `fps`, o vídeo é renderizado no máximo a esse fps.
+    """
+    if not MIN_PREVIEW_SCALE <= scale <= 1:
+        raise ValueError(f'Escala de pré-visualização inválida: {scale}')
+
+    def scaled(value, minimum: float = 0):
+        return max(value * scale, minimum) if isinstance(value, (int, float)) else value
+
+    metadata = copy.deepcopy(metadata)
+    metadata['width'] = int(round(scaled(metadata.get('width'), 1)))
+    metadata['height'] = int(round(scaled(metadata.get('height'), 1)))
+    if fps:
+        metadata['fps'] = min(metadata['fps'], fps) if metadata.get('fps') else fps
+    metadata['preview'] = True
+
+    for element_metadata in metadata.get('elements_data', {}).values():
+        if not element_metadata:
+            continue
+        for key in ('x', 'y'):
+            element_metadata[key] = scaled(element_metadata.get(key, 0))
+        for key in ('width', 'height'):
+            if key in element_metadata:
+                element_metadata[key] = scaled(element_metadata[key], 1)
+        if 'borderRadius' in element_metadata:
+            element_metadata['borderRadius'] = scaled(element_metadata['borderRadius'])
+
+        if element_metadata.get('type') == 'text':
+            style = element_metadata.setdefault('style', {})
+            style['fontSize'] = max(int(round(scaled(style.get('fontSize', 20)))), 1)
+
+        chroma_key_data = element_metadata.get('chromaKeyDetectionData')
+        if chroma_key_data and 'position' in chroma_key_data:
+            chroma_key_data['position'] = [scaled(float(v)) for v in chroma_key_data['position']]
+
+        for effects in (element_metadata.get('effects') or {}).values():
+            settings = (effects.get('colorEffect') or {}).get('settings') or {}
+            if 'blur' in settings:
+                settings['blur'] = scaled(settings['blur'])
+
+        for animation in element_metadata.get('animations') or []:
+            for point in (animation.get('settings') or {}).get('points', []):
+                point['x'] = scaled(point['x'])
+                point['y'] = scaled(point['y'])
+
+    return metadata
+
+def build_project(
+    metadata: Dict,
+    video_paths: List[str],
+    output_path: str,
+) -> Tuple[VideoCompositor, Callable]:
+    """
+    Cria o compositor de um projeto.
+
+    Args:
+        metadata (Dict): Metadados enviados pelo frontend (fps, width, height, elements_data, ...).
+        video_paths (List[str]): Ficheiros dos vídeos enviados, pela ordem dos elementos do tipo 'video'.
+        output_path (str): Onde o vídeo final é escrito.
+
+    Returns:
+        Tuple[VideoCompositor, Callable]: O compositor e o callback `on_frame` para `render`.
+    """
+    compositor, on_frame, _ = _build_project(metadata, video_paths, output_path)
+    return compositor, on_frame
+
+def element_geometry(element_metadata: Dict) -> Tuple[int, int, int, int]:
+    """(x, y, largura, altura) do rect de um elemento, antes de animações e efeitos"""
+    return (
+        int(element_metadata.get('x', 0)),
+        int(element_metadata.get('y', 0)),
+        int(element_metadata.get('width', None)),
+        int(element_metadata.get('height', None)),
+    )
+
+def reset_geometry(video_data: Dict, metadata: Dict) -> None:
+    """
+    Repõe os rects dos elementos de um projeto montado por `build_project` e o estado do overlapVideo.
+    As animações de movimento e o overlapVideo alteram os rects durante o render; um projeto reutilizado
+    para outro instante (ou com outras animações) tem de partir das posições dos metadados.
+    """
+    elements_metadata = metadata.get('elements_data', {})
+    for data in video_data.values():
+        element_metadata = elements_metadata.get(data['video_id']) or {}
+        rect = data['rect']
+        rect.x, rect.y, rect.width, rect.height = element_geometry(element_metadata)
+        data['extra_data'] = {}
+
+def referenced_elements(effects: Optional[Dict]) -> Set[str]:
+    """Ids dos elementos lidos pelos efeitos de um elemento (blendEffect e overlapVideo)"""
+    ids = set()
+    for effect in (effects or {}).values():
+        if not isinstance(effect, dict):
+            continue
+        blend_id = (effect.get('blendEffect') or {}).get('blendVideoId')
+        overlap_id = (effect.get('overlapVideo') or {}).get('refVideoId')
+        ids.update(ref_id for ref_id in (blend_id, overlap_id) if ref_id)
+    return ids
+
+def configure_effects(compositor: VideoCompositor, video_data: Dict, metadata: Dict) -> None:
+    """
+    Aplica os efeitos, as animações e o chroma key (`EFFECT_FIELDS`) de cada elemento a um projeto
+    montado por `build_project`. Os vídeos, as captures e as máscaras não mudam.
+    """
+    elements_metadata = metadata.get('elements_data', {})
+    layers = {layer.layer_idx: layer for layer in compositor.layers}
+    referenced = {
+        ref_id for element_metadata in elements_metadata.values() if element_metadata
+        for ref_id in referenced_elements(element_metadata.get('effects'))
+    }
+    for idx, data in video_data.items():
+        element_metadata = elements_metadata.get(data['video_id']) or {}
+        effects = element_metadata.get('effects', {})
+        animations = element_metadata.get('animations', [])
+        data.update(effects=effects, animations=animations, extra_data={})
+        # LUTs dos efeitos de cor, compiladas uma vez e usadas em todos os frames
+        data['color_luts'] = {}
+        for effect_id, effect in (effects or {}).items():
+            settings = ((effect.get('colorEffect') or {}).get('settings') or {}) if isinstance(effect, dict) else {}
+            if ColorLUT.active(settings):
+                data['color_luts'][effect_id] = ColorLUT(settings)
+
+        if 'video_path' in data:
+            data['chromaKeyData'] = element_metadata.get('chromaKeyDetectionData', {})
+            # Fundo sem os objetos da track, para apagar objetos sem ler outros frames do vídeo
+            removes_objects = any(isinstance(e, dict) and 'backgroundRemoveEffect' in e for e in (effects or {}).values())
+            if not (data['masks'] and removes_objects):
+                data['clean_plate'] = None
+            elif data.get('clean_plate') is None:
+                data['clean_plate'] = CleanPlate.open(data['stageMasks'])
+
+        # Sem efeitos nem animações, nada altera o rect nem o alpha dos frames (permite occlusion culling)
+        if idx in layers:
+            layers[idx].static = not effects and not animations and not data.get('chromaKeyData')
+            # Efeitos que leem o rect ou a capture de outra layer: render por ordem de frame (ver VideoCompositor.render)
+            layers[idx].serial = bool(referenced_elements(effects)) or data['video_id'] in referenced
+
+def _build_project(
+    metadata: Dict,
+    video_paths: List[str],
+    output_path: str,
+) -> Tuple[VideoCompositor, Callable, Dict]:
+    """Como `build_project`; devolve também os dados de cada elemento, para `configure_effects`"""
+    fps = metadata.get('fps', None)
+    width = metadata.get('width', None)
+    height = metadata.get('height', None)
+    enable_transparency = metadata.get('enable_transparency', True)
+
+    preview = metadata.get('preview', False) # Ver preview_metadata
+    compositor = VideoCompositor(
+        output_path=output_path,
+        output_width=width,
+        output_height=height,
+        fps=fps,
+        crf=PREVIEW_CRF if preview else 23,
+        preset=PREVIEW_PRESET if preview else 'fast',
+    )
+    effectProcessor = VideoEffectsProcessor()
+    animationProcessor = VideoAnimationProcessor()
+
+    elements_metadata = metadata.get('elements_data', {})
+    video_data = {}
+    stage_masks: Dict[str, DecodedMasks] = {} # Elementos com o mesmo stage partilham as máscaras (e os produtos derivados)
+    count_video = 0
+    for idx, video_id in enumerate(elements_metadata.keys()):
+        element_metadata = elements_metadata.get(video_id, {})
+        if not element_metadata:
+            print(f"\n[AVISO] Nenhum metadado encontrado para o vídeo {video_id}")
+            print('\tVideos data:', elements_metadata)
+            print('\tVideo metadata:', element_metadata)
+            continue
+        element_type = element_metadata.get('type', 'video')
+        rotation = element_metadata.get('rotation', 0)
+        flipped = element_metadata.get('flipped', False)
+        opacity = element_metadata.get('opacity', 1.0)
+        border_radius = element_metadata.get('borderRadius', 0)
+        speed = element_metadata.get('speed', 1)
+        draw = element_metadata.get('draw', True)
+        st_offset = element_metadata.get('st_offset', 0)
+        start_t = element_metadata.get('start_t', 0)
+        end_t = element_metadata.get('end_t', None)
+        rect = Rect(*element_geometry(element_metadata))
+
+        if element_type == 'video':
+            stageMasks = element_metadata.get('stageMasks', None)
+            # Máscaras descodificadas frame a frame durante o render (1 canal, cache LRU)
+            if stageMasks and stageMasks not in stage_masks:
+                stage_masks[stageMasks] = DecodedMasks(DataSaver.get_stage(stageMasks) or {})
+            masks = stage_masks.get(stageMasks) if stageMasks else None
+            video_input = video_paths[count_video]
+            count_video += 1
+            video_data[idx] = {
+                'idx': idx,
+                'video_id': video_id,
+                'video_path': video_input,
+                'stageMasks': stageMasks,
+                'masks': masks,
+                'rect': rect,
+                'rotation': rotation,
+                'flipped': flipped,
+                'draw': draw,
+            }
+
+        elif element_type == 'text':
+            text = element_metadata.get('text', '')
+            style = element_metadata.get('style', {})
+            font_family = style.get('fontFamily', 'Raleway')
+            font_size = style.get('fontSize', 20)
+            color = style.get('color', '#FFFFFF')
+            bold = style.get('fontWeight', 'normal')
+            italic = style.get('fontStyle', '')
+            align = style.get('textAlign', 'left')
+
+            video_data[idx] = {
+                'idx': idx,
+                'video_id': video_id,
+                'rect': rect,
+                'rotation': rotation,
+                'flipped': flipped,
+                'draw': draw,
+            }
+
+            # Set the duration of the video clip based on start and end times, or default to 5 seconds if either is missing
+            duration = end_t - start_t if start_t and end_t else 5
+
+            # Use the given fps, or default to 1 frame per second if not specified
+            text_fps = fps or 1
+
+            # Determine if the text should be bold — either by numeric weight (>=700) or by string comparison
+            is_bold = bold == int(bold) >= 700 if isinstance(bold, int) else bold == 'bold'
+
+            # Check if the text style includes italic formatting
+            is_italic = 'italic' in italic
+
+            # Create a single text frame (image) with the given parameters (font, size, color, etc.)
+            text_frame = create_text_frame(text, font_family, font_size, color, is_bold, is_italic,
+                                           align, rect.width, rect.height)
+
+            # Replicate the static frame into a video array to simulate a video at the specified FPS
+            text_frames = replicate_frame_as_video_array(text_frame, duration, text_fps)
+
+            # Create a VideoArray object using the generated frames and FPS
+            video_input = VideoArray(text_frames, text_fps)
+
+        # Add layer with settings
+        compositor.add_layer(LayerInfo(
+            video=video_input, # Video file or VideoArray
+            rect=rect, # Rect object with x, y, width, height
+            layer_idx=idx, # Layer index
+            st_offset=st_offset, # Start time offset in seconds
+            start_t=start_t, # Start time in seconds
+            end_t=end_t, # End time in seconds (None means until the end of the video)
+            rotation=rotation, # Rotation in degrees
+            speed=speed, # Speed multiplier
+            flipped=flipped, # Whether the video is flipped horizontally
+            draw=draw, # Whether to draw the video
+            opacity=opacity, # Opacity of the video layer (0.0 to 1.0)
+            border_radius=border_radius, # Border radius for rounded corners
+        ))
+    configure_effects(compositor, video_data, metadata) # Efeitos, animações e chroma key (e o static de cada layer)
+
+    def process_frame(
+        render_info: RenderInfo,
+        frame: np.ndarray,
+        frame_idx: int,
+        fps: int,
+        layer_width: int,
+        layer_height: int,
+        roi_info: RoiInfo,
+        render_infos: List[RenderInfo],
+        video_time: float,
+        global_time: float,
+        processing_stage: int,
+    ) -> np.ndarray:
+        """Função de callback para processar cada frame"""
+        video_idx = render_info.layer.layer_idx
+        if video_idx not in video_data:
+            return frame
+
+        rect = video_data[video_idx].get('rect', None)
+        masks = video_data[video_idx].get('masks', None)
+        effects_config = video_data[video_idx].get('effects', {})
+        chromaKeyData = video_data[video_idx].get('chromaKeyData', {})
+        extra_data = video_data[video_idx].get('extra_data', None)
+        rotation = video_data[video_idx].get('rotation', 0)
+        flipped = video_data[video_idx].get('flipped', False)
+        animations = video_data[video_idx].get('animations', [])
+
+        if processing_stage == PROCESS_STAGE_POST_TRANSFORM:
+            return effectProcessor.process_post_transform(
+                render_info, frame, masks, effects_config,
+                chromaKeyData, enable_transparency, frame_idx,
+                layer_width, layer_height, roi_info,
+                rect, video_data, extra_data, rotation, flipped, render_infos, video_time
+            )
+        else:
+            frame = animationProcessor.process_animations(frame, animations, global_time, render_info)
+
+            return effectProcessor.process_pre_transform(
+                render_info, frame, masks, effects_config,
+                chromaKeyData, enable_transparency, frame_idx,
+                layer_width, layer_height,
+                rect, video_data, extra_data, flipped, render_infos, video_time
+            )
+
+    return compositor, process_frame, video_data
+
+def render_project(
+    metadata: Dict,
+    video_paths: List[str],
+    output_path: str,
+    processes: Optional[int] = None,
+) -> None:
+    """
+    Renderiza um projeto para `output_path`.
+
+    Com `processes > 1` (por omissão `RENDER_PROCESSES`), a timeline é dividida em troços
+    contíguos renderizados em paralelo, cada um no seu processo, e juntos no fim sem re-encode.
+    """
+    processes = RENDER_PROCESSES if processes is None else processes
+    if processes > 1:
+        # Cada troço monta o projeto no seu processo: aqui só é preciso o tamanho da timeline
+        fps, total_frames = project_timeline(metadata, video_paths)
+        processes = min(processes, max(int(total_frames / (MIN_SEGMENT_SECONDS * fps)), 1))
+
+    if processes <= 1:
+        compositor, on_frame = build_project(metadata, video_paths, output_path)
+        compositor.render(on_frame=on_frame)
+        return
+
+    bounds = np.linspace(0, total_frames, processes + 1).astype(int)
+    segments_dir = tempfile.mkdtemp(dir=os.path.dirname(os.path.abspath(output_path)))
+    try:
+        segment_paths = _render_segments(metadata, video_paths, segments_dir, list(zip(bounds[:-1], bounds[1:])))
+        concat_segments(segment_paths, output_path)
+    finally:
+        shutil.rmtree(segments_dir, ignore_errors=True)
+
+def project_timeline(metadata: Dict, video_paths: List[str]) -> Tuple[float, int]:
+    """
+    FPS e número total de frames do render, como `VideoCompositor.timeline` do projeto montado por
+    `build_project`, mas sem o montar: só lê o fps e o número de frames do container de cada vídeo.
+    """
+    fps = metadata.get('fps', None)
+    layers = [] # (fps, duração do vídeo, start_t, end_t, speed, st_offset, draw)
+    count_video = 0
+    for element_metadata in metadata.get('elements_data', {}).values():
+        if not element_metadata:
+            continue
+        element_type = element_metadata.get('type', 'video')
+        start_t = element_metadata.get('start_t', 0)
+        end_t = element_metadata.get('end_t', None)
+        if element_type == 'video':
+            cap = cv2.VideoCapture(video_paths[count_video])
+            count_video += 1
+            try:
+                video_fps, frame_count = cap.get(cv2.CAP_PROP_FPS), int(cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            finally:
+                cap.release()
+        elif element_type == 'text':
+            # Como em build_project: o texto é replicado durante `duration` segundos a `fps` (ou 1)
+            video_fps = fps or 1
+            frame_count = int((end_t - start_t if start_t and end_t else 5) * video_fps)
+        else:
+            continue
+        layers.append((video_fps, frame_count / max(video_fps, 1), start_t, end_t,
+                       element_metadata.get('speed', 1), element_metadata.get('st_offset', 0),
+                       element_metadata.get('draw', True)))
+
+    fps = fps if fps is not None else (max(layer[0] for layer in layers) or 30.0)
+    max_duration = max(
+        ((end_t if end_t is not None else duration) - start_t) / speed + st_offset
+        for _, duration, start_t, end_t, speed, st_offset, draw in layers if draw
+    )
+    return fps, int(max_duration * fps)
+
+def _render_segments(
+    metadata: Dict,
+    video_paths: List[str],
+    segments_dir: str,
+    ranges: List[Tuple[int, int]],
+) -> List[str]:
+    """Renderiza cada troço [start, end) num processo e devolve os ficheiros, pela ordem da timeline."""
+    segment_paths = []
+    running = []
+    try:
+        for i, (start_frame, end_frame) in enumerate(ranges):
+            segment_path = os.path.join(segments_dir, f'segment_{i:04d}.mp4')
+            spec_path = os.path.join(segments_dir, f'segment_{i:04d}.json')
+            with open(spec_path, 'w') as file:
+                json.dump({
+                    'metadata': metadata,
+                    'video_paths': video_paths,
+                    'output_path': segment_path,
+                    'start_frame': int(start_frame),
+                    'end_frame': int(end_frame),
+                }, file)
+
+            cmd = [sys.executable, os.path.abspath(__file__), spec_path]
+            running.append((cmd, subprocess.Popen(cmd)))
+            segment_paths.append(segment_path)
+
+        for cmd, process in running:
+            returncode = process.wait()
+            if returncode != 0:
+                raise subprocess.CalledProcessError(returncode, cmd)
+    except BaseException:
+        for _, process in running:
+            process.kill()
+            process.wait()
+        raise
+
+    return segment_paths
+
+@dataclass
+class PreviewProject:
+    """Projeto montado para renderizar frames isolados; as captures ficam abertas entre pedidos."""
+    key: str
+    temp_dir: str
+    compositor: VideoCompositor
+    on_frame: Callable
+    video_data: Dict
+    effects_key: str
+    lock: threading.Lock
+    users: int = 0 # Pedidos a usar o projeto (ver PreviewProjects.use)
+    evicted: bool = False # Já saiu da cache; é libertado quando deixar de ser usado
+
+    def render_frame(self, time: float, metadata: Dict) -> Optional[np.ndarray]:
+        """Renderiza o frame com os efeitos de `metadata` (o resto do projeto é o da chave)"""
+        with self.lock: # Os efeitos e as captures do projeto não são thread-safe
+            effects_key = PreviewProjects.effects_key(metadata)
+            if effects_key != self.effects_key:
+                configure_effects(self.compositor, self.video_data, metadata)
+                self.effects_key = effects_key
+            # Os frames anteriores deixaram os rects onde as animações os puseram
+            reset_geometry(self.video_data, metadata)
+            return self.compositor.render_frame(time, on_frame=self.on_frame)
+
+    def release(self) -> None:
+        self.compositor.release()
+        shutil.rmtree(self.temp_dir, ignore_errors=True)
+
+class PreviewProjects:
+    """
+    Cache LRU de projetos para `/render/frame`, pela hash do conteúdo dos vídeos e dos metadados
+    sem os efeitos (`EFFECT_FIELDS`).
+
+    Pedidos seguidos do mesmo projeto (ex: a arrastar o cursor da timeline, ou a ajustar um efeito)
+    reutilizam os vídeos já guardados, as captures abertas, os frames de texto e a cache de máscaras
+    descodificadas; se só os efeitos mudaram, são reconfigurados com `configure_effects`.
+    """
+    MAX_PROJECTS = 4
+
+    _projects: 'OrderedDict[str, PreviewProject]' = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def project_key(metadata: Dict, video_digests: List[str]) -> str:
+        layout = dict(metadata)
+        layout['elements_data'] = {
+            video_id: {k: v for k, v in element.items() if k not in EFFECT_FIELDS} if element else element
+            for video_id, element in (metadata.get('elements_data') or {}).items()
+        }
+        digest = hashlib.sha256(json.dumps(layout, sort_keys=True).encode('utf-8'))
+        for video_digest in video_digests:
+            digest.update(video_digest.encode('ascii'))
+        return digest.hexdigest()
+
+    @staticmethod
+    def effects_key(metadata: Dict) -> str:
+        effects = {
+            video_id: {k: element.get(k) for k in EFFECT_FIELDS}
+            for video_id, element in (metadata.get('elements_data') or {}).items() if element
+        }
+        return json.dumps(effects, sort_keys=True)
+
+    @staticmethod
+    @contextmanager
+    def use(
+        metadata: Dict,
+        video_digests: List[str],
+        save_videos: Callable[[str], List[str]],
+    ) -> Iterator[PreviewProject]:
+        """
+        Projeto em cache ou montado agora; não é libertado enquanto estiver a ser usado,
+        mesmo que saia da cache.
+
+        Args:
+            metadata (Dict): Metadados do projeto, como em /download.
+            video_digests (List[str]): Hash do conteúdo do vídeo de cada elemento do tipo 'video'.
+            save_videos (Callable): Chamado só se o projeto não estiver em cache; guarda os vídeos
+                na pasta dada e devolve os caminhos, pela mesma ordem.
+        """
+        project = PreviewProjects._acquire(metadata, video_digests, save_videos)
+        try:
+            yield project
+        finally:
+            with PreviewProjects._lock:
+                project.users -= 1
+                release = project.evicted and project.users == 0
+            if release:
+                project.release()
+
+    @staticmethod
+    def _acquire(
+        metadata: Dict,
+        video_digests: List[str],
+        save_videos: Callable[[str], List[str]],
+    ) -> PreviewProject:
+        key = PreviewProjects.project_key(metadata, video_digests)
+        with PreviewProjects._lock:
+            project = PreviewProjects._projects.get(key)
+            if project is not None:
+                PreviewProjects._projects.move_to_end(key)
+                project.users += 1
+                return project
+
+        temp_dir = tempfile.mkdtemp(prefix='preview_')
+        try:
+            video_paths = save_videos(temp_dir)
+            compositor, on_frame, video_data = _build_project(metadata, video_paths, os.path.join(temp_dir, 'output.mp4'))
+        except BaseException:
+            shutil.rmtree(temp_dir, ignore_errors=True)
+            raise
+        project = PreviewProject(
+            key, temp_dir, compositor, on_frame, video_data,
+            PreviewProjects.effects_key(metadata), threading.Lock(),
+        )
+
+        evicted = []
+        with PreviewProjects._lock:
+            if key in PreviewProjects._projects: # Outro pedido montou o mesmo projeto entretanto
+                evicted.append(project)
+                project = PreviewProjects._projects[key]
+            else:
+                PreviewProjects._projects[key] = project
+                while len(PreviewProjects._projects) > PreviewProjects.MAX_PROJECTS:
+                    old_project = PreviewProjects._projects.popitem(last=False)[1]
+                    old_project.evicted = True
+                    if old_project.users == 0:
+                        evicted.append(old_project)
+            project.users += 1
+        for old_project in evicted:
+            old_project.release()
+        return project
+
+def concat_segments(segment_paths: List[str], output_path: str) -> None:
+    """Junta os troços (mesmo codec e parâmetros) com o concat demuxer do ffmpeg, sem re-encode."""
+    list_path = output_path + '.segments.txt'
+    with open(list_path, 'w') as file:
+        for segment_path in segment_paths:
+            escaped_path = os.path.abspath(segment_path).replace("'", "'\\''")
+            file.write(f"file '{escaped_path}'\n")
+
+    cmd = [
+        'ffmpeg',
+        '-y', # Overwrite output file without asking
+        '-loglevel', 'error',
+        '-f', 'concat',
+        '-safe', '0', # Caminhos absolutos na lista
+        '-i', list_path,
+        '-c', 'copy', # Sem re-encode
+        '-movflags', '+faststart', # Enables progressive streaming (start video before full download)
+        str(output_path),
+    ]
+    try:
+        subprocess.run(cmd, check=True)
+    finally:
+        os.remove(list_path)
+
+if __name__ == '__main__':
+    # Processo de um troço: python project_renderer.py <spec.json>
+    with open(sys.argv[1]) as file:
+        spec = json.load(file)
+
+    compositor, on_frame = build_project(spec['metadata'], spec['video_paths'], spec['output_path'])
+    compositor.render(on_frame=on_frame, start_frame=spec['start_frame'], end_frame=spec['end_frame'])
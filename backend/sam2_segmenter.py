@@ -1,4 +1,8 @@
 import os
+import itertools
+import tempfile
+import threading
+from contextlib import contextmanager
 
 import cv2
 import torch
@@ -13,8 +17,10 @@ from PIL import Image
 from pathlib import Path
 from supervision.assets import download_assets, VideoAssets
 from data_saver import DataSaver
+from utils import decode_serialized_mask
 from io import BytesIO
 from dataclasses import dataclass
+from collections import OrderedDict
 
 from sam2.build_sam import build_sam2
 from sam2.sam2_image_predictor import SAM2ImagePredictor
@@ -28,6 +34,87 @@ class VideoObjectData:
     ann_frame_idx: int = 0,
     ann_obj_id: int = 1,
 
+class VideoFramesFeed:
+    """
+    Decoded video frames kept in RAM (or in a memory-mapped temp file) and handed
+    to SAM2's video predictor in place of the JPEG folder read by `load_video_frames`.
+
+    Frames are stored as uint8 RGB at the model resolution and only converted to
+    normalized float tensors when the predictor asks for them.
+    """
+    # Same normalization SAM2 applies when it loads frames from disk
+    IMG_MEAN = (0.485, 0.456, 0.406)
+    IMG_STD = (0.229, 0.224, 0.225)
+    
+    def __init__(self, image_size: int, device: torch.device, max_frames: Optional[int] = None,
+                 use_memmap: bool = False, offload_to_cpu: bool = False) -> None:
+        self.image_size = image_size
+        self.device = device
+        self.offload_to_cpu = offload_to_cpu
+        self.video_height = 0
+        self.video_width = 0
+        self.img_mean = torch.tensor(VideoFramesFeed.IMG_MEAN, dtype=torch.float32)[:, None, None]
+        self.img_std = torch.tensor(VideoFramesFeed.IMG_STD, dtype=torch.float32)[:, None, None]
+        self._count = 0
+        self._memmap_file = None
+        
+        if use_memmap:
+            if not max_frames:
+                raise ValueError('max_frames is required to memory-map the frames')
+            # Anonymous temp file, removed by the OS as soon as it is closed
+            self._memmap_file = tempfile.TemporaryFile()
+            self.frames = np.memmap(self._memmap_file, dtype=np.uint8, mode='w+',
+                                    shape=(max_frames, image_size, image_size, 3))
+        else:
+            self.frames: Union[List[np.ndarray], np.memmap] = []
+
+    def append(self, frame_bgr: np.ndarray) -> None:
+        """Adds a decoded BGR frame (already scaled to the video resolution used for the masks)."""
+        if self._count == 0:
+            self.video_height, self.video_width = frame_bgr.shape[:2]
+        
+        size = (self.image_size, self.image_size)
+        shrinking = frame_bgr.shape[0] > self.image_size or frame_bgr.shape[1] > self.image_size
+        frame = cv2.resize(frame_bgr, size, interpolation=cv2.INTER_AREA if shrinking else cv2.INTER_CUBIC)
+        frame = cv2.cvtColor(frame, cv2.COLOR_BGR2RGB)
+        
+        if isinstance(self.frames, np.memmap):
+            if self._count >= len(self.frames):
+                self._grow_memmap(2 * len(self.frames))
+            self.frames[self._count] = frame
+        else:
+            self.frames.append(frame)
+        self._count += 1
+
+    def _grow_memmap(self, max_frames: int) -> None:
+        # CAP_PROP_FRAME_COUNT can underestimate the real number of frames
+        self.frames.flush()
+        shape = (max_frames, self.image_size, self.image_size, 3)
+        self._memmap_file.truncate(int(np.prod(shape)))
+        self.frames = np.memmap(self._memmap_file, dtype=np.uint8, mode='r+', shape=shape)
+
+    def get_rgb_frame(self, idx: int) -> np.ndarray:
+        """Returns frame `idx` as RGB uint8 at the video resolution (used for debugging)."""
+        return cv2.resize(np.asarray(self.frames[idx]), (self.video_width, self.video_height))
+
+    def close(self) -> None:
+        """Frees the decoded frames (and the memory-mapped file, if any)."""
+        self.frames = []
+        self._count = 0
+        if self._memmap_file is not None:
+            self._memmap_file.close()
+            self._memmap_file = None
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __getitem__(self, idx: int) -> torch.Tensor:
+        if idx < 0 or idx >= self._count:
+            raise IndexError(idx)
+        img = torch.from_numpy(np.ascontiguousarray(self.frames[idx])).permute(2, 0, 1).float() / 255.0
+        img = (img - self.img_mean) / self.img_std
+        return img if self.offload_to_cpu else img.to(self.device, non_blocking=True)
+
 class SAM2Segmenter:
     HOME = os.path.join(os.getcwd(), 'segment-anything-2')
     MODEL_SIZE_BASE = 'base_plus'
@@ -35,42 +122,128 @@ class SAM2Segmenter:
     MODEL_SIZE_SMALL = 'small'
     MODEL_SIZE_TINY = 'tiny'
     
+    # Where the video predictor reads frames from
+    FRAME_FEED_DISK = 'disk' # JPEGs written to output_dir and re-read by SAM2
+    FRAME_FEED_MEMORY = 'memory' # Decoded frames kept in RAM
+    FRAME_FEED_MEMMAP = 'memmap' # Decoded frames kept in a memory-mapped temp file
+    FRAME_FEEDS = (FRAME_FEED_DISK, FRAME_FEED_MEMORY, FRAME_FEED_MEMMAP)
+    
+    # Per-thread flags (autocast state is thread-local in torch)
+    _thread_state = threading.local()
+    
+    # Each checkpoint only loads with the config of the same Hiera backbone
+    MODEL_CONFIGS = {
+        MODEL_SIZE_TINY: 'sam2_hiera_t.yaml',
+        MODEL_SIZE_SMALL: 'sam2_hiera_s.yaml',
+        MODEL_SIZE_BASE: 'sam2_hiera_b+.yaml',
+        MODEL_SIZE_LARGE: 'sam2_hiera_l.yaml',
+    }
+    
     def __init__(self, model_size: str = MODEL_SIZE_TINY) -> None:
+        if model_size not in SAM2Segmenter.MODEL_CONFIGS:
+            raise ValueError(f'Unknown SAM2 model size: {model_size}')
+        
         # Enable autocasting for CUDA with bfloat16 precision to optimize performance
-        torch.autocast(device_type='cuda', dtype=torch.bfloat16).__enter__()
+        SAM2Segmenter._enable_autocast()
 
         # If the GPU supports TensorFloat-32 (e.g., Ampere or newer), enable it for better performance
-        if torch.cuda.get_device_properties(0).major >= 8:
+        if torch.cuda.is_available() and torch.cuda.get_device_properties(0).major >= 8:
             torch.backends.cuda.matmul.allow_tf32 = True
             torch.backends.cudnn.allow_tf32 = True
             
         # Set the device to GPU if available, otherwise fallback to CPU
         self.device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+        self.model_size = model_size
         
-        # Define the path to the SAM2 configuration file
-        self.config = os.path.join(SAM2Segmenter.HOME, 'sam2', 'configs', 'sam2', 'sam2_hiera_t.yaml')
+        # Define the path to the SAM2 configuration file matching the model size
+        config_name = SAM2Segmenter.MODEL_CONFIGS[model_size]
+        self.config = os.path.join(SAM2Segmenter.HOME, 'sam2', 'configs', 'sam2', config_name)
         
         # Define the path to the pre-trained model checkpoint based on the model size
         self.model_path = os.path.join(SAM2Segmenter.HOME, 'checkpoints', f'sam2_hiera_{model_size}.pt')
         
-        # Load the base SAM2 model with the given configuration and checkpoint
-        self.model = build_sam2('/' + os.path.abspath(self.config), self.model_path, 
-                                device=self.device, apply_postprocessing=False)
-        
-        # Load the video prediction model (used for handling temporal context in video)
-        self.video_model = build_sam2_video_predictor('/' + os.path.abspath(self.config), self.model_path)
-        
-        # Initialize the automatic mask generator using the base SAM2 model
-        self.mask_generator = SAM2AutomaticMaskGenerator(self.model)
+        # Sub-models are only built on first use (see the properties below)
+        self._model = None
+        self._video_model = None
+        self._mask_generator = None
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _enable_autocast() -> None:
+        """Enters bfloat16 autocast once per thread, since segmenters are shared between request and job threads."""
+        if not getattr(SAM2Segmenter._thread_state, 'autocast', False):
+            torch.autocast(device_type='cuda', dtype=torch.bfloat16).__enter__()
+            SAM2Segmenter._thread_state.autocast = True
+
+    @property
+    def model(self) -> torch.nn.Module:
+        """Base SAM2 model, loaded on first access."""
+        with self._lock:
+            if self._model is None:
+                self._model = build_sam2('/' + os.path.abspath(self.config), self.model_path, 
+                                         device=self.device, apply_postprocessing=False)
+            return self._model
+
+    @property
+    def video_model(self) -> torch.nn.Module:
+        """Video prediction model (temporal context across frames), loaded on first access."""
+        with self._lock:
+            if self._video_model is None:
+                self._video_model = build_sam2_video_predictor('/' + os.path.abspath(self.config), self.model_path,
+                                                               device=self.device)
+            return self._video_model
+
+    @property
+    def mask_generator(self) -> SAM2AutomaticMaskGenerator:
+        """Automatic mask generator on top of the base model, built on first access."""
+        model = self.model
+        with self._lock:
+            if self._mask_generator is None:
+                self._mask_generator = SAM2AutomaticMaskGenerator(model)
+            return self._mask_generator
+
+    def memory_usage(self) -> int:
+        """Returns the number of bytes held by the parameters and buffers of the loaded sub-models."""
+        total = 0
+        for module in (self._model, self._video_model):
+            if module is None:
+                continue
+            for tensor in itertools.chain(module.parameters(), module.buffers()):
+                total += tensor.numel() * tensor.element_size()
+        return total
+
+    def unload(self) -> None:
+        """Drops every loaded sub-model so its memory can be reclaimed."""
+        with self._lock:
+            self._model = None
+            self._video_model = None
+            self._mask_generator = None
+        if torch.cuda.is_available():
+            torch.cuda.empty_cache()
 
     def generate_mask_for_image(self, img_path: str) -> Tuple[np.ndarray, np.ndarray, List[Dict]]:
+        SAM2Segmenter._enable_autocast()
         image_bgr = cv2.imread(img_path)
         image_rgb = cv2.cvtColor(image_bgr, cv2.COLOR_BGR2RGB)
 
         sam2_result = self.mask_generator.generate(image_rgb)
         return image_bgr, image_rgb, sam2_result
     
-    def generate_masks_for_video(
+    def generate_masks_for_video(self, *args, **kwargs) -> Dict[int, Dict[int, np.ndarray]]:
+        """
+        Generates segmentation masks for a given video using point-based annotations.
+        Takes the same arguments as `iter_masks_for_video` and collects its output.
+
+        Returns:
+            Dict[int, Dict[int, np.ndarray]]: A dictionary mapping frame indices (relative to
+                start_frame) to object masks (as NumPy arrays).
+        """
+        return {
+            out_frame_idx: frame_masks
+            for out_frame_idx, frame_masks in self.iter_masks_for_video(*args, **kwargs)
+        }
+    
+    def iter_masks_for_video(
         self,
         video_path: Union[str, Path],
         video_objects_data: List[VideoObjectData],
@@ -81,9 +254,11 @@ class SAM2Segmenter:
         frame_pattern: str = "{:05d}.jpeg",
         overwrite: bool = False,
         debug_points: bool = False,
-    ) -> Tuple[Dict, Path]:        
+        frame_feed: str = FRAME_FEED_DISK,
+    ) -> Iterator[Tuple[int, Dict[int, np.ndarray]]]:
         """
-        Generates segmentation masks for a given video using point-based annotations.
+        Generates segmentation masks for a given video using point-based annotations,
+        yielding each frame's masks as soon as SAM2 propagates them.
 
         Args:
             video_path (Union[str, Path]): Path to the input video file.
@@ -102,39 +277,60 @@ class SAM2Segmenter:
                 Default is False.
             debug_points (bool, optional): If True, displays visual feedback of added points 
                 on frames for debugging. Default is False.
+            frame_feed (str, optional): How frames reach the model: FRAME_FEED_DISK writes
+                JPEGs to output_dir, FRAME_FEED_MEMORY and FRAME_FEED_MEMMAP pass the decoded
+                frames straight to the inference state. Default is FRAME_FEED_DISK.
 
-        Returns:
-            Tuple[Dict, Path]: 
-                - A dictionary mapping frame indices to object masks (as NumPy arrays).
-                - The path to the directory containing the extracted frames.
+        Yields:
+            Tuple[int, Dict[int, np.ndarray]]: The frame index (relative to start_frame) and
+                a dictionary mapping object IDs to masks (as NumPy arrays).
+                Closing the generator stops the propagation.
         """
-        video_path = Path(video_path)
-        output_dir = Path(output_dir)
-        output_dir.mkdir(parents=True, exist_ok=True)
-        
-        # Extract video frames and save them as individual images
-        frame_paths = self._extract_frames(
-            video_path,
-            output_dir,
-            scale_factor,
-            start_frame,
-            end_frame,
-            frame_pattern,
-            overwrite
-        )
+        if frame_feed not in SAM2Segmenter.FRAME_FEEDS:
+            raise ValueError(f'Unknown frame feed: {frame_feed}')
+        SAM2Segmenter._enable_autocast()
         
-        print('Output dir is:', output_dir.as_posix())
+        video_path = Path(video_path)
+        frames_feed = None
         
-        # Initialize model inference state using extracted frames
-        self.inference_state = self.video_model.init_state(video_path=output_dir.as_posix())
-        self.current_video_path = output_dir
+        if frame_feed == SAM2Segmenter.FRAME_FEED_DISK:
+            output_dir = Path(output_dir)
+            output_dir.mkdir(parents=True, exist_ok=True)
+            
+            # Extract video frames and save them as individual images
+            frame_paths = self._extract_frames(
+                video_path,
+                output_dir,
+                scale_factor,
+                start_frame,
+                end_frame,
+                frame_pattern,
+                overwrite
+            )
+            
+            print('Output dir is:', output_dir.as_posix())
+            
+            # Initialize model inference state using extracted frames
+            # (kept local: the segmenter is shared between requests by SAM2ModelRegistry)
+            inference_state = self.video_model.init_state(video_path=output_dir.as_posix())
+        else:
+            # Decode frames straight into memory, skipping the JPEG round trip
+            frames_feed = self._decode_frames(
+                video_path,
+                scale_factor,
+                start_frame,
+                end_frame,
+                use_memmap=frame_feed == SAM2Segmenter.FRAME_FEED_MEMMAP,
+            )
+            frame_paths = [frames_feed.get_rgb_frame(i) for i in range(len(frames_feed))] if debug_points else []
+            inference_state = self._init_state_from_frames(frames_feed)
         
         # Iterate through each annotated object
         for vod in video_objects_data:
             if vod.points is not None and vod.labels is not None:
                 # Add user-provided points and labels to the model
                 _, out_obj_ids, out_mask_logits = self.video_model.add_new_points_or_box(
-                    inference_state=self.inference_state,
+                    inference_state=inference_state,
                     frame_idx=vod.ann_frame_idx - start_frame,
                     obj_id=vod.ann_obj_id,
                     points=vod.points,
@@ -149,14 +345,15 @@ class SAM2Segmenter:
             print(f"Pontos adicionados no frame {vod.ann_frame_idx} com obj_id {vod.ann_obj_id}.")
         
         # Propagate the segmentation masks throughout the video frames
-        video_segments = {}
-        for out_frame_idx, out_obj_ids, out_mask_logits in self.video_model.propagate_in_video(self.inference_state):
-            video_segments[out_frame_idx] = {
-                out_obj_id: (out_mask_logits[i] > 0.0).cpu().numpy()
-                for i, out_obj_id in enumerate(out_obj_ids)
-            }
-
-        return video_segments
+        try:
+            for out_frame_idx, out_obj_ids, out_mask_logits in self.video_model.propagate_in_video(inference_state):
+                yield out_frame_idx, {
+                    out_obj_id: (out_mask_logits[i] > 0.0).cpu().numpy()
+                    for i, out_obj_id in enumerate(out_obj_ids)
+                }
+        finally:
+            if frames_feed is not None:
+                frames_feed.close()
     
     def _extract_frames(
         self,
@@ -194,6 +391,79 @@ class SAM2Segmenter:
         
         return sorted(sv.list_files_with_extensions(output_dir.as_posix(), extensions=["jpeg"]))
     
+    def _decode_frames(
+        self,
+        video_path: Path,
+        scale_factor: float,
+        start_frame: int,
+        end_frame: Optional[int],
+        use_memmap: bool = False,
+    ) -> VideoFramesFeed:
+        """Decode (and optionally rescale) frames from video straight into a VideoFramesFeed."""
+        max_frames = None
+        if use_memmap:
+            # The memory map needs an upper bound on the number of frames up front
+            total_frames = sv.VideoInfo.from_video_path(video_path.as_posix()).total_frames
+            last_frame = min(end_frame, total_frames) if end_frame is not None else total_frames
+            max_frames = max(last_frame - start_frame, 1)
+        
+        frames_feed = VideoFramesFeed(
+            image_size=self.video_model.image_size,
+            device=self.device,
+            max_frames=max_frames,
+            use_memmap=use_memmap,
+        )
+        frames_generator = sv.get_video_frames_generator(
+            video_path.as_posix(),
+            start=start_frame,
+            end=end_frame
+        )
+        
+        for frame in frames_generator:
+            # Same scaling as `_extract_frames`, so masks come out at the same resolution
+            if scale_factor != 1.0:
+                frame = sv.scale_image(frame, scale_factor)
+            frames_feed.append(frame)
+        
+        if len(frames_feed) == 0:
+            frames_feed.close()
+            raise ValueError(f'No frames could be decoded from {video_path}')
+        return frames_feed
+    
+    @torch.inference_mode()
+    def _init_state_from_frames(self, frames_feed: VideoFramesFeed, offload_state_to_cpu: bool = False) -> Dict:
+        """
+        Creates an inference state that reads frames from `frames_feed` instead of a JPEG folder.
+        
+        Builds the same state as `SAM2VideoPredictor.init_state` (sam2 1.x), with the feed as
+        its images, so SAM2's `load_video_frames` is never called (nor replaced).
+        """
+        predictor = self.video_model
+        compute_device = predictor.device
+        inference_state = {
+            'images': frames_feed,
+            'num_frames': len(frames_feed),
+            'offload_video_to_cpu': frames_feed.offload_to_cpu,
+            'offload_state_to_cpu': offload_state_to_cpu,
+            'video_height': frames_feed.video_height,
+            'video_width': frames_feed.video_width,
+            'device': compute_device,
+            'storage_device': torch.device('cpu') if offload_state_to_cpu else compute_device,
+            'point_inputs_per_obj': {},
+            'mask_inputs_per_obj': {},
+            'cached_features': {},
+            'constants': {},
+            'obj_id_to_idx': OrderedDict(),
+            'obj_idx_to_id': OrderedDict(),
+            'obj_ids': [],
+            'output_dict_per_obj': {},
+            'temp_output_dict_per_obj': {},
+            'frames_tracked_per_obj': {},
+        }
+        # Warm up the visual backbone and cache the image feature on frame 0, as init_state does
+        predictor._get_image_feature(inference_state, frame_idx=0, batch_size=1)
+        return inference_state
+    
     def show_sam_result(self, image_bgr: np.ndarray, image_sam_data: List[Dict]):
         mask_annotator = sv.MaskAnnotator(color_lookup=sv.ColorLookup.INDEX)
         detections = sv.Detections.from_sam(sam_result=image_sam_data)
@@ -210,14 +480,14 @@ class SAM2Segmenter:
         self, 
         points: np.ndarray, 
         labels: np.ndarray,
-        frame_path: str,
+        frame_path: Union[str, np.ndarray],
         ann_frame_idx: int, 
         out_obj_ids: List,
         out_mask_logits: List,
     ) -> None:
         plt.figure(figsize=(9, 6))
         plt.title(f"frame {ann_frame_idx}")
-        plt.imshow(Image.open(frame_path))
+        plt.imshow(Image.open(frame_path) if isinstance(frame_path, (str, Path)) else frame_path)
         self.show_points(points, labels, plt.gca())
         self.show_mask((out_mask_logits[0] > 0.0).cpu().numpy(), plt.gca(), obj_id=out_obj_ids[0])
         
@@ -287,22 +557,95 @@ class SAM2Segmenter:
                 if isinstance(out_mask, np.ndarray):
                     SAM2Segmenter.show_mask(out_mask, plt.gca(), obj_id=out_obj_id)
                 elif isinstance(out_mask, dict):
-                    mask_base64 = out_mask['data']
-                    
-                    # Remove o prefixo "data:image/png;base64," se existir
-                    if mask_base64.startswith('data:image'):
-                        mask_base64 = mask_base64.split(',', 1)[1]
-                    
-                    mask_bytes = base64.b64decode(mask_base64)
-                    mask_image = Image.open(BytesIO(mask_bytes)).convert('L')  # escala de cinza
-                    mask_numpy = np.array(mask_image) > 0  # máscara binária (True / False)
+                    # Máscara serializada (RLE ou PNG em base64)
+                    mask_numpy = decode_serialized_mask(out_mask) > 0  # máscara binária (True / False)
                     
                     SAM2Segmenter.show_mask(mask_numpy, plt.gca(), obj_id=out_obj_id)
             plt.show()
+
+
+class SAM2ModelRegistry:
+    """
+    Process-wide cache of SAM2Segmenter instances, one per model size.
+
+    Segmenters load their sub-models lazily, so a video-only workload never builds
+    the automatic mask generator. Whenever a segmenter is requested or returned, the
+    least recently used idle sizes are unloaded while the loaded weights exceed
+    MEMORY_BUDGET_BYTES. The segmenter being requested and the ones in use by
+    another request (see `use`) are never evicted: their weights would stay
+    referenced, and a reload would leave two copies resident.
+    """
+    MEMORY_BUDGET_BYTES = int(os.environ.get('SAM2_MEMORY_BUDGET_MB', 4096)) * 1024 * 1024
+
+    _segmenters: 'OrderedDict[str, SAM2Segmenter]' = OrderedDict()
+    _in_use: Dict[str, int] = {}
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(model_size: str = SAM2Segmenter.MODEL_SIZE_TINY) -> SAM2Segmenter:
+        """Returns the shared segmenter for `model_size`, creating it if needed (not protected from eviction)."""
+        with SAM2ModelRegistry._lock:
+            return SAM2ModelRegistry._get(model_size)
+
+    @staticmethod
+    @contextmanager
+    def use(model_size: str = SAM2Segmenter.MODEL_SIZE_TINY) -> Iterator[SAM2Segmenter]:
+        """Like `get`, but the segmenter is marked in use (and never evicted) until the block exits."""
+        with SAM2ModelRegistry._lock:
+            segmenter = SAM2ModelRegistry._get(model_size)
+            SAM2ModelRegistry._in_use[model_size] = SAM2ModelRegistry._in_use.get(model_size, 0) + 1
+        try:
+            yield segmenter
+        finally:
+            with SAM2ModelRegistry._lock:
+                SAM2ModelRegistry._in_use[model_size] -= 1
+                if not SAM2ModelRegistry._in_use[model_size]:
+                    del SAM2ModelRegistry._in_use[model_size]
+                # Evictions skipped while it was busy (the lazy loads also grow the usage)
+                SAM2ModelRegistry._evict()
+
+    @staticmethod
+    def _get(model_size: str) -> SAM2Segmenter:
+        segmenter = SAM2ModelRegistry._segmenters.get(model_size)
+        if segmenter is None:
+            segmenter = SAM2Segmenter(model_size)
+            SAM2ModelRegistry._segmenters[model_size] = segmenter
+        SAM2ModelRegistry._segmenters.move_to_end(model_size)
+        SAM2ModelRegistry._evict()
+        return segmenter
+
+    @staticmethod
+    def memory_usage() -> int:
+        """Returns the bytes held by all cached segmenters."""
+        return sum(s.memory_usage() for s in SAM2ModelRegistry._segmenters.values())
+
+    @staticmethod
+    def release(model_size: Optional[str] = None) -> None:
+        """Unloads one model size, or every cached one if `model_size` is None (sizes in use are kept)."""
+        with SAM2ModelRegistry._lock:
+            sizes = [model_size] if model_size else list(SAM2ModelRegistry._segmenters.keys())
+            for size in sizes:
+                if SAM2ModelRegistry._in_use.get(size):
+                    continue
+                segmenter = SAM2ModelRegistry._segmenters.pop(size, None)
+                if segmenter is not None:
+                    segmenter.unload()
+
+    @staticmethod
+    def _evict() -> None:
+        # Oldest entries come first in the OrderedDict; the last one is the most recently requested
+        for size in list(SAM2ModelRegistry._segmenters.keys())[:-1]:
+            if SAM2ModelRegistry.memory_usage() <= SAM2ModelRegistry.MEMORY_BUDGET_BYTES:
+                break
+            if SAM2ModelRegistry._in_use.get(size):
+                continue # Still referenced by a request: unloading would free nothing
+            segmenter = SAM2ModelRegistry._segmenters.pop(size)
+            print(f'[SAM2ModelRegistry] A libertar o modelo {size}')
+            segmenter.unload()
     
 if __name__ == '__main__':
     # Testar uma imagem
-    sam2 = SAM2Segmenter()
+    sam2 = SAM2ModelRegistry.get()
     if 0:
         img_bgr, img_rgb, sam_result = sam2.generate_mask_for_image('images\\dog-2.jpeg')
         sam2.show_sam_result(img_bgr, sam_result)    
@@ -0,0 +1,228 @@
+"""
+Índice de seek por vídeo: timestamp (pts) de cada frame e posição dos keyframes.
+
+O `CAP_PROP_POS_FRAMES` do OpenCV faz sempre um seek novo e estima o frame a partir do
+timestamp, o que é lento (e por vezes impreciso) em H.264 com GOPs longos. Com o índice,
+`IndexedVideoReader` só faz seek quando o frame pedido está noutro GOP (ou para trás),
+sempre para o keyframe anterior, e descodifica para a frente a partir daí.
+
+O seek é feito pelo timestamp do keyframe (`CAP_PROP_POS_MSEC`). O OpenCV converte-o com o
+fps médio, por isso em vídeos com frame rate variável pode cair noutro frame: o timestamp do
+primeiro frame descodificado é comparado com o índice, que dá a posição real do decoder (se
+tiver passado do frame pedido, repete o seek a partir do keyframe anterior).
+
+O índice é construído uma vez com o ffprobe (só lê os pacotes, não descodifica) e guardado
+ao lado do vídeo, em `<vídeo>.seekidx.npz`. Vídeos na pasta temporária (uploads que são
+removidos no fim do pedido) não guardam o índice.
+"""
+import os
+import bisect
+import tempfile
+import subprocess
+from collections import OrderedDict
+from typing import *
+
+import cv2
+import numpy as np
+
+INDEX_SUFFIX = '.seekidx.npz'
+
+class SeekIndex:
+    """Timestamps dos frames pela ordem de apresentação e os índices dos keyframes."""
+    def __init__(self, pts: np.ndarray, keyframes: np.ndarray) -> None:
+        self.pts = pts
+        self.keyframes = keyframes
+        self._keyframes_list: List[int] = keyframes.tolist()
+        # Segundos desde o primeiro frame, a mesma origem do CAP_PROP_POS_MSEC do OpenCV
+        self.times = pts - pts[0] if len(pts) else pts
+
+    def __len__(self) -> int:
+        return len(self.pts)
+
+    def keyframe_before(self, frame_idx: int) -> int:
+        """Último keyframe em ou antes de `frame_idx` (0 se não houver nenhum)"""
+        i = bisect.bisect_right(self._keyframes_list, frame_idx)
+        return self._keyframes_list[i - 1] if i else 0
+
+    def frame_at(self, time: float) -> int:
+        """Frame com o timestamp (segundos desde o primeiro frame) mais próximo de `time`"""
+        i = int(np.searchsorted(self.times, time))
+        if i > 0 and (i == len(self.times) or time - self.times[i - 1] <= self.times[i] - time):
+            i -= 1
+        return i
+
+    @staticmethod
+    def index_path(video_path: str) -> str:
+        return video_path + INDEX_SUFFIX
+
+    @staticmethod
+    def persists(video_path: str) -> bool:
+        """O índice é guardado ao lado do vídeo, exceto para ficheiros temporários (ficaria órfão)"""
+        return os.path.dirname(os.path.abspath(video_path)) != os.path.abspath(tempfile.gettempdir())
+
+    @staticmethod
+    def build(video_path: str) -> Optional['SeekIndex']:
+        """Lê os pacotes do stream de vídeo com o ffprobe; None se o ffprobe não estiver disponível ou falhar"""
+        cmd = [
+            'ffprobe',
+            '-v', 'error',
+            '-select_streams', 'v:0',
+            '-show_entries', 'packet=pts_time,flags',
+            '-of', 'csv=p=0',
+            video_path,
+        ]
+        try:
+            result = subprocess.run(cmd, capture_output=True, text=True, check=True)
+        except (OSError, subprocess.CalledProcessError) as e:
+            print(f'[SeekIndex] Não foi possível indexar {video_path}: {str(e)}')
+            return None
+
+        pts, is_keyframe = [], []
+        for line in result.stdout.splitlines():
+            fields = line.split(',')
+            if len(fields) < 2 or fields[0] in ('', 'N/A'):
+                continue
+            pts.append(float(fields[0]))
+            is_keyframe.append('K' in fields[-1])
+        if not pts:
+            return None
+
+        # Os pacotes vêm pela ordem de descodificação; os frames são numerados pela de apresentação
+        order = np.argsort(np.array(pts), kind='stable')
+        pts = np.array(pts)[order]
+        keyframes = np.flatnonzero(np.array(is_keyframe)[order])
+        return SeekIndex(pts, keyframes)
+
+    @staticmethod
+    def load(video_path: str) -> Optional['SeekIndex']:
+        """Índice guardado ao lado do vídeo; é construído (e guardado) se não existir ou estiver desatualizado"""
+        path = SeekIndex.index_path(video_path)
+        try:
+            if os.path.getmtime(path) >= os.path.getmtime(video_path):
+                with np.load(path) as data:
+                    return SeekIndex(data['pts'], data['keyframes'])
+        except (OSError, ValueError, KeyError):
+            pass
+
+        index = SeekIndex.build(video_path)
+        if index is not None and SeekIndex.persists(video_path):
+            temp_path = None
+            try:
+                fd, temp_path = tempfile.mkstemp(dir=os.path.dirname(path) or '.', suffix='.npz')
+                with os.fdopen(fd, 'wb') as file:
+                    np.savez(file, pts=index.pts, keyframes=index.keyframes)
+                os.replace(temp_path, path)
+            except OSError as e:
+                print(f'[SeekIndex] Não foi possível guardar o índice de {video_path}: {str(e)}')
+                if temp_path is not None and os.path.exists(temp_path):
+                    os.remove(temp_path)
+        return index
+
+class IndexedVideoReader:
+    """
+    Leitura de frames por índice sobre um cv2.VideoCapture, usando o SeekIndex do vídeo.
+
+    O índice só é carregado no primeiro acesso fora de ordem. Os frames lidos depois de um seek
+    (ex: frames de substituição ou de blend pedidos pelos efeitos) ficam numa cache LRU pequena,
+    porque costumam ser pedidos outra vez nos frames seguintes.
+    """
+    MAX_FORWARD_DECODE = 16 # Sem índice, saltos maiores (ou para trás) fazem seek
+
+    def __init__(self, video_path: str, cap: Optional[cv2.VideoCapture] = None, cache_size: int = 8) -> None:
+        self.video_path = video_path
+        self.cap = cap if cap is not None else cv2.VideoCapture(video_path)
+        self.position = 0 # Próximo frame que o decoder devolve
+        self._grabbed = False # O frame `position` já foi descodificado (grab) e falta o retrieve
+        self.cache_size = cache_size
+        self._cache: 'OrderedDict[int, np.ndarray]' = OrderedDict()
+        self._index: Optional[SeekIndex] = None
+        self._index_loaded = False
+
+    @property
+    def index(self) -> Optional[SeekIndex]:
+        if not self._index_loaded:
+            self._index = SeekIndex.load(self.video_path)
+            self._index_loaded = True
+        return self._index
+
+    def _seek(self, frame_idx: int) -> bool:
+        """
+        Posiciona o decoder em `frame_idx`. Só faz seek se for preciso recuar ou mudar de GOP;
+        caso contrário descodifica para a frente. Retorna True se fez seek.
+        """
+        index = self.index
+        if index is None:
+            # Sem índice: avanços curtos descodificam para a frente, o resto usa o seek do OpenCV
+            if not 0 <= frame_idx - self.position <= self.MAX_FORWARD_DECODE:
+                self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_idx)
+                self.position = frame_idx
+                self._grabbed = False
+                return True
+            keyframe = self.position
+        else:
+            keyframe = index.keyframe_before(frame_idx)
+
+        seeked = not keyframe <= self.position <= frame_idx
+        if seeked:
+            self._seek_keyframe(index, keyframe, frame_idx)
+        while self.position < frame_idx:
+            if self._grabbed:
+                self._grabbed = False
+            elif not self.cap.grab():
+                break
+            self.position += 1
+        return seeked
+
+    def _seek_keyframe(self, index: SeekIndex, keyframe: int, frame_idx: int) -> None:
+        """Seek pelo timestamp de `keyframe`, confirmado pelo timestamp do primeiro frame descodificado"""
+        while True:
+            self.cap.set(cv2.CAP_PROP_POS_MSEC, index.times[keyframe] * 1000)
+            self.position = keyframe
+            self._grabbed = False
+            if keyframe == 0 or not self.cap.grab():
+                return # O início do vídeo é sempre exato
+            msec = self.cap.get(cv2.CAP_PROP_POS_MSEC)
+            position = index.frame_at(msec / 1000) if msec > 0 else keyframe # Sem timestamp não há como confirmar
+            if position <= frame_idx:
+                self.position = position
+                self._grabbed = True
+                return
+            # Passou do frame pedido: tenta a partir do keyframe anterior
+            keyframe = index.keyframe_before(min(keyframe, position) - 1)
+
+    def read(self, frame_idx: int) -> Tuple[bool, Optional[np.ndarray]]:
+        cached = self._cache.get(frame_idx)
+        if cached is not None:
+            self._cache.move_to_end(frame_idx)
+            return True, cached.copy()
+
+        seeked = frame_idx != self.position and self._seek(frame_idx)
+        if self._grabbed:
+            self._grabbed = False
+            ret, frame = self.cap.retrieve()
+        else:
+            ret, frame = self.cap.read()
+        self.position += 1
+        if not ret:
+            return False, None
+
+        if seeked and self.cache_size > 0:
+            self._cache[frame_idx] = frame
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+            frame = frame.copy()
+        return True, frame
+
+    def grab(self, frame_idx: int) -> bool:
+        """Avança o decoder até depois de `frame_idx` sem converter o frame para BGR"""
+        if frame_idx != self.position:
+            self._seek(frame_idx)
+        self.position += 1
+        if self._grabbed:
+            self._grabbed = False
+            return True
+        return self.cap.grab()
+
+    def release(self) -> None:
+        self._cache.clear()
+        self.cap.release()
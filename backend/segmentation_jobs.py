@@ -0,0 +1,200 @@
+import time
+import uuid
+import threading
+from typing import *
+from dataclasses import dataclass, field
+from concurrent.futures import ThreadPoolExecutor
+
+from data_saver import DataSaver
+
+JOB_STATUS_QUEUED = 'queued'
+JOB_STATUS_RUNNING = 'running'
+JOB_STATUS_DONE = 'done'
+JOB_STATUS_FAILED = 'failed'
+JOB_STATUS_CANCELLED = 'cancelled'
+
+JOB_FINISHED_STATUSES = (JOB_STATUS_DONE, JOB_STATUS_FAILED, JOB_STATUS_CANCELLED)
+
+@dataclass
+class SegmentationJob:
+    """Estado de um job de propagação de máscaras em background."""
+    job_id: str
+    track_id: str
+    total_frames: int
+    status: str = JOB_STATUS_QUEUED
+    frames_done: int = 0
+    error: Optional[str] = None
+    created_at: float = field(default_factory=time.time)
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    key: Optional[Hashable] = field(default=None, repr=False)
+    cancel_event: threading.Event = field(default_factory=threading.Event, repr=False)
+
+    @property
+    def finished(self) -> bool:
+        return self.status in JOB_FINISHED_STATUSES
+
+    @property
+    def eta(self) -> Optional[float]:
+        """Estimated seconds until the job finishes, based on the propagation rate so far."""
+        if self.status != JOB_STATUS_RUNNING or not self.started_at or self.frames_done == 0:
+            return None
+        elapsed = time.time() - self.started_at
+        remaining = max(self.total_frames - self.frames_done, 0)
+        return remaining * elapsed / self.frames_done
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            'job_id': self.job_id,
+            'track_id': self.track_id,
+            'status': self.status,
+            'frames_done': self.frames_done,
+            'total_frames': self.total_frames,
+            'progress': self.frames_done / self.total_frames if self.total_frames else None,
+            'eta': self.eta,
+            'error': self.error,
+        }
+
+class SegmentationJobs:
+    """
+    Fila de jobs de segmentação de vídeo.
+
+    Os jobs correm um de cada vez (a GPU é partilhada) numa thread de background.
+    As máscaras de cada job são escritas com DataSaver no stage `track_id`, frame a frame.
+    """
+    MAX_WORKERS = 1
+    JOB_TTL = 60 * 60 # Jobs terminados são esquecidos ao fim de uma hora
+
+    _jobs: Dict[str, SegmentationJob] = {}
+    _lock = threading.Lock()
+    _executor = ThreadPoolExecutor(max_workers=MAX_WORKERS, thread_name_prefix='segmentation_job')
+
+    @staticmethod
+    def submit(
+        track_id: str,
+        total_frames: int,
+        frames_factory: Callable[[], Iterator[Tuple[int, Dict]]],
+        on_finish: Optional[Callable[[], None]] = None,
+        on_done: Optional[Callable[[], None]] = None,
+        key: Optional[Hashable] = None,
+    ) -> SegmentationJob:
+        """
+        Queues a new job, unless a job with the same `key` is still queued or running.
+
+        Args:
+            track_id (str): Stage where the serialized masks are written, frame by frame.
+            total_frames (int): Number of frames expected, used for progress and ETA.
+            frames_factory (Callable): Called on the worker thread; returns an iterator of
+                (frame_idx, serialized frame masks). Closing it must stop the propagation.
+            on_finish (Optional[Callable]): Cleanup called once the job ends, whatever the outcome.
+            on_done (Optional[Callable]): Called on the worker thread once the stage is written,
+                before the job is marked done (e.g. to derive data that needs the video).
+            key (Optional[Hashable]): Identifies the work (e.g. media and stage). A duplicate
+                would redo the whole propagation and write the same stage.
+
+        Returns:
+            SegmentationJob: The queued job, or the active job with the same `key`; in that case
+                nothing is queued and `on_finish` is called right away.
+        """
+        job = SegmentationJob(job_id=uuid.uuid4().hex, track_id=track_id, total_frames=total_frames, key=key)
+        with SegmentationJobs._lock:
+            SegmentationJobs._prune()
+            active = SegmentationJobs._active(key)
+            if active is None:
+                SegmentationJobs._jobs[job.job_id] = job
+        if active is not None:
+            if on_finish:
+                on_finish()
+            return active
+        SegmentationJobs._executor.submit(SegmentationJobs._run, job, frames_factory, on_finish, on_done)
+        return job
+
+    @staticmethod
+    def get(job_id: str) -> Optional[SegmentationJob]:
+        with SegmentationJobs._lock:
+            return SegmentationJobs._jobs.get(job_id)
+
+    @staticmethod
+    def active(key: Hashable) -> Optional[SegmentationJob]:
+        """The queued or running job submitted with `key`, if any."""
+        with SegmentationJobs._lock:
+            return SegmentationJobs._active(key)
+
+    @staticmethod
+    def _active(key: Optional[Hashable]) -> Optional[SegmentationJob]:
+        if key is None:
+            return None
+        return next(
+            (job for job in SegmentationJobs._jobs.values()
+             if job.key == key and not job.finished and not job.cancel_event.is_set()),
+            None,
+        )
+
+    @staticmethod
+    def cancel(job_id: str) -> Optional[SegmentationJob]:
+        """Asks a job to stop; the propagation loop stops before the next frame."""
+        job = SegmentationJobs.get(job_id)
+        if job is not None and not job.finished:
+            job.cancel_event.set()
+            if job.status == JOB_STATUS_QUEUED:
+                job.status = JOB_STATUS_CANCELLED
+                job.finished_at = time.time()
+        return job
+
+    @staticmethod
+    def _run(
+        job: SegmentationJob,
+        frames_factory: Callable[[], Iterator[Tuple[int, Dict]]],
+        on_finish: Optional[Callable[[], None]],
+        on_done: Optional[Callable[[], None]] = None,
+    ) -> None:
+        frames = None
+        try:
+            if job.cancel_event.is_set():
+                return
+
+            job.status = JOB_STATUS_RUNNING
+            job.started_at = time.time()
+
+            # Each frame goes straight to the stage file; nothing is accumulated in memory
+            writer = DataSaver.mask_stage_writer(job.track_id)
+            try:
+                frames = frames_factory()
+                for frame_idx, serialized_frame in frames:
+                    if job.cancel_event.is_set():
+                        break
+                    writer.add_frame(frame_idx, serialized_frame)
+                    job.frames_done += 1
+            except BaseException:
+                writer.abort()
+                raise
+
+            if job.cancel_event.is_set():
+                writer.abort()
+                job.status = JOB_STATUS_CANCELLED
+            else:
+                writer.close()
+                if on_done:
+                    on_done()
+                job.status = JOB_STATUS_DONE
+        except Exception as e:
+            print(f'[SegmentationJobs] Job {job.job_id} falhou: {str(e)}')
+            job.error = str(e)
+            job.status = JOB_STATUS_FAILED
+        finally:
+            # Closing the generator stops propagate_in_video if the loop was interrupted
+            if frames is not None and hasattr(frames, 'close'):
+                frames.close()
+            job.finished_at = job.finished_at or time.time()
+            if on_finish:
+                on_finish()
+
+    @staticmethod
+    def _prune() -> None:
+        now = time.time()
+        expired = [
+            job_id for job_id, job in SegmentationJobs._jobs.items()
+            if job.finished and job.finished_at and now - job.finished_at > SegmentationJobs.JOB_TTL
+        ]
+        for job_id in expired:
+            del SegmentationJobs._jobs[job_id]
@@ -0,0 +1,52 @@
+import numpy as np
+
+from video_effects_processor import ColorLUT, VideoEffectsProcessor
+
+# Compara a LUT dos efeitos de cor com a cadeia de efeitos (_apply_pixel_effects) em todas as cores
+# (uma em cada 3 do cubo RGB de 8 bits): o erro máximo, e não só o médio, tem de ficar em 3 níveis
+MAX_ERROR = 3
+levels = np.arange(256, dtype=np.uint8)
+pixels = np.stack(np.meshgrid(levels, levels, levels, indexing='ij'), axis=-1).reshape(-1, 3)[::3]
+
+SETTINGS = [
+    {'sharpen': 1},
+    {'hue': 20, 'sharpen': 0.2},
+    {'hue': 170, 'contrast': 0.8, 'sharpen': 0.1},
+    {'exposure': 0.5, 'contrast': 0.3, 'sharpen': 0.2},
+    {'exposure': 2, 'hue': 300, 'sharpen': 0.7},
+    {'exposure': -0.2, 'contrast': -0.3, 'hue': -40, 'sharpen': 0.5},
+]
+
+for settings in SETTINGS:
+    assert ColorLUT.active(settings), settings
+    expected = VideoEffectsProcessor._apply_pixel_effects(pixels.astype(np.float32) / 255.0, settings)
+    expected = np.clip(np.round(expected * 255), 0, 255)
+    result = ColorLUT(settings).apply(pixels)
+    assert result.shape == pixels.shape and result.dtype == np.uint8
+
+    error = np.abs(result.astype(np.float32) - expected)
+    print(f'{settings}: erro médio {error.mean():.2f}, máximo {error.max():.0f}')
+    assert error.max() <= MAX_ERROR, settings
+
+# Só compensa compilar a LUT com pelo menos duas conversões de espaço de cor
+assert not ColorLUT.active({})
+assert not ColorLUT.active({'saturation': 1, 'brightness': 0})
+assert not ColorLUT.active({'hue': 20, 'contrast': 0.3})
+# Brilho e saturação não são interpolados: com eles a cadeia é sempre usada
+assert not ColorLUT.active({'brightness': 0.3, 'hue': 20, 'sharpen': 0.2})
+assert not ColorLUT.active({'saturation': 1.5, 'sharpen': 0.2})
+
+# Máscaras com menos de `lut.size` píxeis usam a cadeia: o resultado é o mesmo que sem LUT
+rng = np.random.default_rng(0)
+settings = SETTINGS[-1]
+frame = rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)
+mask = np.zeros((120, 160), dtype=bool)
+mask[10:50, 20:80] = True
+lut = ColorLUT(settings)
+assert mask.sum() < lut.size
+assert np.array_equal(
+    VideoEffectsProcessor.apply_color_effects(frame, mask, settings, lut=lut),
+    VideoEffectsProcessor.apply_color_effects(frame, mask, settings),
+)
+
+print('ColorLUT: OK')
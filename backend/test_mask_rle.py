@@ -0,0 +1,47 @@
+import numpy as np
+
+from utils import (MASK_FORMAT_PNG, MASK_FORMAT_RLE, convert_frame_masks, decode_mask_rle,
+                   decode_serialized_mask, encode_mask_rle, serialize_mask)
+
+# Round-trips das máscaras em RLE (e da conversão PNG <-> RLE) com máscaras aleatórias,
+# incluindo as formas que vêm do SAM2 ((1, H, W) bool) e os casos vazios/cheios
+rng = np.random.default_rng(0)
+
+masks = [
+    np.zeros((1, 1), dtype=bool),
+    np.ones((1, 9), dtype=bool),
+    np.ones((7, 5), dtype=bool),
+    np.zeros((40, 60), dtype=bool),
+    np.ones((40, 60), dtype=bool),
+]
+for _ in range(50):
+    height, width = int(rng.integers(1, 120)), int(rng.integers(1, 120))
+    masks.append(rng.random((height, width)) > rng.random())
+
+for mask in masks:
+    expected = mask.astype(np.uint8) * 255
+
+    rle = encode_mask_rle(mask)
+    assert rle['size'] == list(mask.shape), rle['size']
+    assert isinstance(rle['counts'], str)
+    assert np.array_equal(decode_mask_rle(rle), expected)
+
+    # Forma do SAM2, (1, H, W)
+    assert np.array_equal(decode_mask_rle(encode_mask_rle(mask[None])), expected)
+
+    assert np.array_equal(decode_serialized_mask(serialize_mask(mask, MASK_FORMAT_RLE)), expected)
+
+    # O encoder PNG faz squeeze da máscara: só aceita máscaras com mais de uma linha e coluna
+    if min(mask.shape) == 1:
+        continue
+    assert np.array_equal(decode_serialized_mask(serialize_mask(mask, MASK_FORMAT_PNG)), expected)
+
+    png_frame = {1: serialize_mask(mask, MASK_FORMAT_PNG)}
+    rle_frame = convert_frame_masks(png_frame, MASK_FORMAT_RLE)
+    assert rle_frame[1]['counts'] == rle['counts']
+    assert np.array_equal(decode_serialized_mask(convert_frame_masks(rle_frame, MASK_FORMAT_PNG)[1]), expected)
+
+# Counts como lista de inteiros (formato RLE não compactado do COCO)
+assert np.array_equal(decode_mask_rle({'size': [2, 3], 'counts': [1, 4, 1]}), np.array([[0, 255, 255], [255, 255, 0]], dtype=np.uint8))
+
+print(f'RLE: {len(masks)} máscaras OK')
@@ -0,0 +1,66 @@
+import os
+import tempfile
+
+import numpy as np
+
+from data_saver import DataSaver
+from mask_stage import MaskStage, is_mask_stage_file
+from utils import MASK_FORMAT_PNG, MASK_FORMAT_RLE, DecodedMasks, decode_serialized_mask, serialize_frame_masks
+
+# Round-trip de um stage de máscaras: escrito frame a frame (com máscaras em RLE e em PNG, e na
+# forma (1, H, W) do SAM2), lido com DataSaver.get_stage e descodificado com DecodedMasks
+rng = np.random.default_rng(0)
+
+frames = {}
+for frame_idx in rng.choice(500, size=40, replace=False):
+    frames[int(frame_idx)] = {
+        obj_id: rng.random((1, 48, 64)) > rng.random()
+        for obj_id in rng.choice([1, 2, 5, 9], size=int(rng.integers(1, 4)), replace=False)
+    }
+
+with tempfile.TemporaryDirectory() as folder:
+    DataSaver._FOLDER_PATH = folder
+    with DataSaver.mask_stage_writer('track') as writer:
+        for i, (frame_idx, frame_masks) in enumerate(frames.items()):
+            mask_format = MASK_FORMAT_RLE if i % 2 else MASK_FORMAT_PNG
+            writer.add_frame(frame_idx, serialize_frame_masks(frame_masks, frame_idx, mask_format))
+    assert os.listdir(folder) == ['track'], os.listdir(folder)
+
+    stage = DataSaver.get_stage('track')
+    assert isinstance(stage, MaskStage) and is_mask_stage_file(os.path.join(folder, 'track'))
+    assert sorted(stage) == sorted(frames) and len(stage) == len(frames)
+    assert max(frames) + 1 not in stage
+
+    decoded = DecodedMasks(stage)
+    for frame_idx, frame_masks in frames.items():
+        assert sorted(stage.object_ids(frame_idx)) == sorted(frame_masks)
+        for obj_id, mask in frame_masks.items():
+            expected = mask[0].astype(np.uint8) * 255
+            mask_info = stage.get_mask(frame_idx, obj_id)
+            assert tuple(mask_info['shape']) == mask.shape
+            assert np.array_equal(decode_serialized_mask(mask_info), expected)
+            assert np.array_equal(decoded[frame_idx][obj_id], expected)
+    del stage, decoded
+
+    # Uma exceção durante a escrita não deixa o stage nem o ficheiro temporário
+    try:
+        with DataSaver.mask_stage_writer('aborted') as writer:
+            writer.add_frame(0, serialize_frame_masks(frames[next(iter(frames))], 0))
+            raise RuntimeError()
+    except RuntimeError:
+        pass
+    assert os.listdir(folder) == ['track'], os.listdir(folder)
+
+    # Dois writers do mesmo stage ao mesmo tempo: cada um tem o seu ficheiro temporário
+    first, second = DataSaver.mask_stage_writer('track'), DataSaver.mask_stage_writer('track')
+    for frame_idx, frame_masks in frames.items():
+        first.add_frame(frame_idx, serialize_frame_masks(frame_masks, frame_idx))
+        second.add_frame(frame_idx, serialize_frame_masks(frame_masks, frame_idx))
+    first.close()
+    second.close()
+    assert os.listdir(folder) == ['track'], os.listdir(folder)
+    stage = DataSaver.get_stage('track')
+    assert sum(len(stage.object_ids(frame_idx)) for frame_idx in stage) == sum(len(m) for m in frames.values())
+    del stage
+
+print(f'MaskStage: {len(frames)} frames OK')
@@ -0,0 +1,60 @@
+import cv2
+import numpy as np
+
+from utils import OccupancyIndex
+
+# Compara os candidatos do OccupancyIndex com a procura exaustiva do frame de substituição:
+# o primeiro frame (por distância) cuja máscara não sobrepõe a máscara principal
+rng = np.random.default_rng(0)
+
+def random_mask(height, width):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    if rng.random() > 0.1:
+        center = (int(rng.integers(0, width)), int(rng.integers(0, height)))
+        axes = (int(rng.integers(1, 40)), int(rng.integers(1, 40)))
+        cv2.ellipse(mask, center, axes, 0, 0, 360, 255, -1)
+    if rng.random() > 0.5:
+        mask = cv2.GaussianBlur(mask, (5, 5), 0)
+    return mask
+
+def brute_force(masks, obj_id, size, main_bin, main_frame_idx):
+    frames = [f for f in masks if obj_id in masks[f] and f != main_frame_idx]
+    for frame_idx in sorted(frames, key=lambda f: abs(f - main_frame_idx)):
+        other_bin = cv2.resize(masks[frame_idx][obj_id], size, interpolation=cv2.INTER_NEAREST) > 254
+        if not (other_bin & (main_bin > 0)).any():
+            return frame_idx
+    return None
+
+def indexed(index, masks, obj_id, size, main_bin, main_frame_idx):
+    for frame_idx, no_overlap in index.candidates(main_bin, main_frame_idx):
+        other_bin = cv2.resize(masks[frame_idx][obj_id], size, interpolation=cv2.INTER_NEAREST) > 254
+        overlaps = (other_bin & (main_bin > 0)).any()
+        assert not (no_overlap and overlaps), f'Frame {frame_idx} marcado sem sobreposição mas sobrepõe'
+        if not overlaps:
+            return frame_idx
+    return None
+
+queries = 0
+for trial in range(40):
+    num_frames = int(rng.integers(5, 60))
+    mask_height, mask_width = int(rng.integers(30, 200)), int(rng.integers(30, 200))
+    size = (int(rng.integers(20, 300)), int(rng.integers(20, 300)))
+    masks = {}
+    for frame_idx in range(num_frames):
+        mask = random_mask(mask_height, mask_width)
+        masks[frame_idx] = {1: mask, 2: mask[::-1].copy()} if rng.random() > 0.2 else {2: mask}
+
+    index = OccupancyIndex(masks, 1, size)
+    dilation = int(rng.integers(0, 20))
+    kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*dilation+1, 2*dilation+1))
+    for frame_idx in masks:
+        if 1 not in masks[frame_idx]:
+            continue
+        main = cv2.dilate(cv2.resize(masks[frame_idx][1], size, interpolation=cv2.INTER_NEAREST), kernel)
+        main_bin = (main > 254).astype(np.uint8) * 255
+        expected = brute_force(masks, 1, size, main_bin, frame_idx)
+        result = indexed(index, masks, 1, size, main_bin, frame_idx)
+        assert result == expected, f'Trial {trial}, frame {frame_idx}: índice {result}, exaustiva {expected}'
+        queries += 1
+
+print(f'OccupancyIndex: {queries} procuras iguais à procura exaustiva')
@@ -0,0 +1,216 @@
+"""
+Miniaturas da timeline (filmstrip) num único sprite sheet.
+
+Os frames são descodificados numa só passagem para a frente (`IndexedVideoReader` só faz seek
+quando o próximo frame está noutro GOP) e colocados numa grelha. O resultado (JPEG + tabela de
+posições) fica em cache em `thumbnails/`, pela hash do conteúdo do vídeo e pelos parâmetros.
+O formato antigo (um JPEG por miniatura) é codificado a partir dos frames descodificados e fica
+em cache numa tabela própria (`get_tiles`).
+As entradas sem acessos durante `MediaStore.MEDIA_TTL` são removidas com os vídeos (`prune`).
+"""
+import os
+import json
+import base64
+import math
+import time
+import tempfile
+from typing import *
+
+import cv2
+import numpy as np
+
+from seek_index import IndexedVideoReader
+from utils import get_interpolated_numbers, resize_frame
+
+class Thumbnails:
+    _FOLDER_PATH = 'thumbnails'
+    MAX_COUNT = 500
+    MAX_WIDTH = 640
+    JPEG_QUALITY = 85
+    if not os.path.exists(_FOLDER_PATH):
+        os.mkdir(_FOLDER_PATH)
+
+    @staticmethod
+    def extract(
+        video_path: str,
+        count: int,
+        width: int,
+        keyframes_only: bool = False,
+    ) -> Tuple[float, int, List[Tuple[int, np.ndarray]]]:
+        """
+        Descodifica `count` frames equidistantes numa só passagem.
+
+        Args:
+            keyframes_only (bool): Usa o keyframe anterior a cada posição (sem descodificar o resto
+                do GOP); mais rápido em vídeos longos, mas as posições deixam de ser exatas.
+
+        Returns:
+            Tuple: (fps, nº de frames, [(frame_idx, miniatura BGR)]) por ordem de frame.
+        """
+        reader = IndexedVideoReader(video_path, cache_size=0)
+        try:
+            fps = reader.cap.get(cv2.CAP_PROP_FPS)
+            num_frames = int(reader.cap.get(cv2.CAP_PROP_FRAME_COUNT))
+            if num_frames <= 0:
+                return fps, num_frames, []
+
+            frame_indices = get_interpolated_numbers(0, num_frames - 1, min(count, num_frames))
+            if keyframes_only and reader.index is not None:
+                frame_indices = [reader.index.keyframe_before(i) for i in frame_indices]
+
+            thumbnails = []
+            for frame_idx in sorted(set(frame_indices)):
+                ret, frame = reader.read(frame_idx)
+                if not ret:
+                    continue # Frame corrompido, ou o nº de frames do container está sobrestimado
+                thumbnails.append((frame_idx, resize_frame(frame, width=width)))
+            return fps, num_frames, thumbnails
+        finally:
+            reader.release()
+
+    @staticmethod
+    def sprite_sheet(
+        thumbnails: List[Tuple[int, np.ndarray]],
+        fps: float,
+        columns: int,
+    ) -> Tuple[np.ndarray, Dict[str, Any]]:
+        """Junta as miniaturas numa grelha e devolve a imagem e a tabela de posições de cada uma"""
+        if not thumbnails:
+            return np.zeros((1, 1, 3), dtype=np.uint8), {'tile_width': 0, 'tile_height': 0, 'columns': 0, 'thumbnails': []}
+
+        tile_height, tile_width = thumbnails[0][1].shape[:2]
+        columns = max(min(columns, len(thumbnails)), 1)
+        rows = math.ceil(len(thumbnails) / columns)
+        sheet = np.zeros((rows * tile_height, columns * tile_width, 3), dtype=np.uint8)
+
+        tiles = []
+        for i, (frame_idx, thumbnail) in enumerate(thumbnails):
+            x, y = (i % columns) * tile_width, (i // columns) * tile_height
+            sheet[y:y + tile_height, x:x + tile_width] = thumbnail
+            tiles.append({'frame_idx': frame_idx, 'time': frame_idx / fps if fps else None, 'x': x, 'y': y})
+
+        return sheet, {'tile_width': tile_width, 'tile_height': tile_height, 'columns': columns, 'thumbnails': tiles}
+
+    @staticmethod
+    def get(
+        video_path: str,
+        digest: str,
+        count: int = 10,
+        width: int = 100,
+        columns: int = 10,
+        keyframes_only: bool = False,
+    ) -> Tuple[bytes, Dict[str, Any]]:
+        """
+        Sprite sheet (JPEG) e tabela de posições das miniaturas de um vídeo, com cache.
+
+        Args:
+            video_path (str): Vídeo em disco.
+            digest (str): Hash do conteúdo do vídeo (ex: `media_id`), usada como chave da cache.
+
+        Returns:
+            Tuple[bytes, Dict]: O JPEG e {'fps', 'num_frames', 'tile_width', 'tile_height', 'columns',
+                'thumbnails': [{'frame_idx', 'time', 'x', 'y'}]}.
+        """
+        name = Thumbnails._name(digest, count, width, keyframes_only, f'_c{columns}')
+        image_path = os.path.join(Thumbnails._FOLDER_PATH, name + '.jpg')
+        table_path = os.path.join(Thumbnails._FOLDER_PATH, name + '.json')
+        try:
+            with open(image_path, 'rb') as image_file:
+                image = image_file.read()
+            table = Thumbnails._read_table(table_path)
+            if table is not None:
+                return image, table
+        except FileNotFoundError:
+            pass
+
+        fps, num_frames, thumbnails = Thumbnails.extract(video_path, *Thumbnails._limits(count, width), keyframes_only)
+        sheet, table = Thumbnails.sprite_sheet(thumbnails, fps, columns)
+        table = {'fps': fps, 'num_frames': num_frames, **table}
+        _, buffer = cv2.imencode('.jpg', sheet, [cv2.IMWRITE_JPEG_QUALITY, Thumbnails.JPEG_QUALITY])
+        image = buffer.tobytes()
+
+        # A tabela é escrita por último: sem ela a entrada da cache não conta
+        Thumbnails._write(image_path, image)
+        Thumbnails._write(table_path, json.dumps(table).encode('utf-8'))
+        return image, table
+
+    @staticmethod
+    def get_tiles(
+        video_path: str,
+        digest: str,
+        count: int = 10,
+        width: int = 100,
+        keyframes_only: bool = False,
+    ) -> Dict[str, Any]:
+        """
+        Miniaturas em JPEGs separados (formato antigo), com cache. Cada miniatura é codificada uma só
+        vez a partir do frame descodificado, e não recortada do JPEG do sprite sheet.
+
+        Returns:
+            Dict: {'fps', 'num_frames', 'frames': [data URL JPEG]}.
+        """
+        name = Thumbnails._name(digest, count, width, keyframes_only, '_tiles')
+        table_path = os.path.join(Thumbnails._FOLDER_PATH, name + '.json')
+        table = Thumbnails._read_table(table_path)
+        if table is not None:
+            return table
+
+        fps, num_frames, thumbnails = Thumbnails.extract(video_path, *Thumbnails._limits(count, width), keyframes_only)
+        frames = []
+        for _, thumbnail in thumbnails:
+            _, buffer = cv2.imencode('.jpg', thumbnail)
+            frames.append(f"data:image/jpeg;base64,{base64.b64encode(buffer).decode('utf-8')}")
+        table = {'fps': fps, 'num_frames': num_frames, 'frames': frames}
+        Thumbnails._write(table_path, json.dumps(table).encode('utf-8'))
+        return table
+
+    @staticmethod
+    def _limits(count: int, width: int) -> Tuple[int, int]:
+        return max(min(count, Thumbnails.MAX_COUNT), 1), max(min(width, Thumbnails.MAX_WIDTH), 1)
+
+    @staticmethod
+    def _name(digest: str, count: int, width: int, keyframes_only: bool, layout: str) -> str:
+        count, width = Thumbnails._limits(count, width)
+        return f'{digest}_{count}x{width}{layout}' + ('_kf' if keyframes_only else '')
+
+    @staticmethod
+    def _read_table(table_path: str) -> Optional[Dict[str, Any]]:
+        """Tabela em cache (marcada como acedida para `prune`), ou None"""
+        try:
+            with open(table_path) as table_file:
+                table = json.load(table_file)
+            os.utime(table_path)
+            return table
+        except (FileNotFoundError, json.JSONDecodeError):
+            return None
+
+    @staticmethod
+    def _write(path: str, data: bytes) -> None:
+        """Escreve num temporário e substitui `path` (pedidos em paralelo para o mesmo vídeo)"""
+        fd, temp_path = tempfile.mkstemp(dir=Thumbnails._FOLDER_PATH, suffix='.tmp')
+        with os.fdopen(fd, 'wb') as file:
+            file.write(data)
+        os.replace(temp_path, path)
+
+    @staticmethod
+    def prune(max_age: float, digests: Iterable[str] = ()) -> None:
+        """Remove as entradas sem acessos há mais de `max_age` segundos e as dos vídeos `digests`"""
+        now = time.time()
+        prefixes = tuple(digest + '_' for digest in digests)
+        for name in os.listdir(Thumbnails._FOLDER_PATH):
+            stem, ext = os.path.splitext(name)
+            path = os.path.join(Thumbnails._FOLDER_PATH, name)
+            try:
+                if ext == '.json':
+                    if name.startswith(prefixes) or now - os.path.getmtime(path) > max_age:
+                        # A tabela primeiro: sem ela a imagem já não é usada
+                        os.remove(path)
+                        image_path = os.path.join(Thumbnails._FOLDER_PATH, stem + '.jpg')
+                        if os.path.exists(image_path):
+                            os.remove(image_path)
+                elif ext in ('.jpg', '.tmp') and now - os.path.getmtime(path) > max_age:
+                    # Imagens sem tabela e temporários de escritas interrompidas
+                    if ext == '.tmp' or not os.path.exists(os.path.join(Thumbnails._FOLDER_PATH, stem + '.json')):
+                        os.remove(path)
+            except FileNotFoundError:
+                pass # Removido por outro pedido
@@ -1,14 +1,19 @@
 import os
+import math
 import numpy as np
 import cv2
 import base64
 import subprocess
 import base64
 import uuid
+import hashlib
+import threading
+from collections import OrderedDict
+from collections.abc import Mapping
 from PIL import Image
 from io import BytesIO
 from pathlib import Path
-from typing import List, Optional, Dict, Union, Tuple
+from typing import List, Optional, Dict, Union, Tuple, Iterator
 
 def get_interpolated_numbers(min: int, max: int, interpolation_value: int) -> List[int]:
     """Retorna uma lista de números inteiros interpolados entre min e max"""
@@ -77,6 +82,147 @@ def encode_mask(mask: np.ndarray) -> np.ndarray:
         print(f"Tipo da máscara: {type(mask)}")
         raise
     
+MASK_FORMAT_PNG = 'png' # PNG 0/255 em base64 (data URL), formato original
+MASK_FORMAT_RLE = 'rle' # Run-length encoding compatível com o COCO (pycocotools)
+MASK_FORMATS = (MASK_FORMAT_PNG, MASK_FORMAT_RLE)
+
+def _rle_counts_to_string(counts: np.ndarray) -> str:
+    """Compacta os runs no formato de string do COCO (deltas em blocos de 5 bits, ASCII a partir de '0')"""
+    chars = []
+    counts = counts.tolist()
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1f
+            x >>= 5
+            more = (x != -1) if (c & 0x10) else (x != 0)
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return ''.join(chars)
+
+def _rle_string_to_counts(s: str) -> np.ndarray:
+    """Inverso de `_rle_counts_to_string`"""
+    counts = []
+    p = 0
+    while p < len(s):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(s[p]) - 48
+            x |= (c & 0x1f) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and (c & 0x10):
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return np.array(counts, dtype=np.int64)
+
+def encode_mask_rle(mask: np.ndarray) -> Dict[str, Union[List[int], str]]:
+    """
+    Codifica uma máscara binária em RLE no formato do COCO: runs alternados de 0s e 1s
+    (começando nos 0s) em ordem column-major, compactados numa string.
+
+    Returns:
+        Dict: {'size': [altura, largura], 'counts': str}
+    """
+    binary = np.asarray(mask)
+    if binary.ndim == 3:
+        # (1,H,W) vindo do SAM2, ou (H,W,C) de uma máscara já descodificada
+        binary = binary[0] if binary.shape[0] == 1 else binary[:, :, 0]
+    binary = binary > 0
+    if binary.ndim != 2:
+        raise ValueError(f"Formato inválido pós-processamento: {binary.shape}")
+    
+    height, width = binary.shape
+    flat = binary.ravel(order='F')
+    
+    # Posições onde o valor muda delimitam os runs
+    changes = np.flatnonzero(flat[1:] != flat[:-1]) + 1
+    boundaries = np.concatenate(([0], changes, [flat.size]))
+    counts = np.diff(boundaries)
+    if flat.size and flat[0]:
+        counts = np.concatenate(([0], counts)) # O primeiro run é sempre de 0s
+    
+    return {'size': [int(height), int(width)], 'counts': _rle_counts_to_string(counts)}
+
+def decode_mask_rle(rle: Dict[str, Union[List[int], str]]) -> np.ndarray:
+    """Descodifica uma máscara RLE (ver `encode_mask_rle`) para um array 2D uint8 com 0/255"""
+    height, width = rle['size']
+    counts = rle['counts']
+    counts = _rle_string_to_counts(counts) if isinstance(counts, str) else np.asarray(counts, dtype=np.int64)
+    
+    values = np.arange(len(counts), dtype=np.uint8) % 2 * 255
+    flat = np.repeat(values, counts)
+    return flat.reshape((height, width), order='F')
+
+def serialize_mask(mask: np.ndarray, mask_format: str = MASK_FORMAT_RLE) -> Dict:
+    """Serializa uma máscara no formato pedido (MASK_FORMAT_RLE ou MASK_FORMAT_PNG)"""
+    if mask_format == MASK_FORMAT_RLE:
+        return {"shape": mask.shape, "format": MASK_FORMAT_RLE, **encode_mask_rle(mask)}
+    if mask_format == MASK_FORMAT_PNG:
+        return {"shape": mask.shape, "data": f"data:image/png;base64,{encode_mask(mask)}"}
+    raise ValueError(f"Formato de máscara desconhecido: {mask_format}")
+
+def decode_serialized_mask(mask_info: Dict) -> Optional[np.ndarray]:
+    """Descodifica uma máscara serializada (RLE ou PNG) para um array 2D uint8 com 0/255"""
+    if not isinstance(mask_info, dict):
+        return None
+    if 'counts' in mask_info:
+        return decode_mask_rle(mask_info)
+    if 'data' in mask_info:
+        mask = decode_mask(mask_info['data'])
+        return mask[:, :, 0] if mask is not None else None
+    return None
+
+def convert_frame_masks(serialized_frame: Dict[int, Dict], mask_format: str) -> Dict[int, Dict]:
+    """Converte as máscaras serializadas de um frame para `mask_format` (sem trabalho se já estiverem nesse formato)"""
+    converted = {}
+    for obj_id, mask_info in serialized_frame.items():
+        is_rle = isinstance(mask_info, dict) and 'counts' in mask_info
+        if is_rle == (mask_format == MASK_FORMAT_RLE):
+            converted[obj_id] = mask_info
+            continue
+        mask = decode_serialized_mask(mask_info)
+        if mask is None:
+            continue
+        serialized = serialize_mask(mask > 0, mask_format)
+        serialized['shape'] = mask_info.get('shape', serialized['shape'])
+        converted[obj_id] = serialized
+    return converted
+
+def serialize_frame_masks(
+    frame_data: Dict[int, np.ndarray], 
+    frame_idx: Optional[int] = None, 
+    mask_format: str = MASK_FORMAT_RLE
+) -> Dict[int, Dict]:
+    """
+    Serializa as máscaras de um frame ({obj_id: mask}) para o formato enviado por JSON e guardado nos stages.
+    Máscaras vazias ou que falhem a codificação são ignoradas.
+    """
+    serialized_frame = {}
+    for obj_id, mask in frame_data.items():
+        try:
+            # Verificação inicial
+            if mask is None or mask.size == 0:
+                print(f"Frame {frame_idx}: Máscara vazia")
+                continue
+                
+            # Conversão e codificação
+            serialized_frame[obj_id] = serialize_mask(mask, mask_format)
+                    
+        except Exception as e:
+            print(f"ERRO no frame {frame_idx}: {str(e)}")
+            continue
+    
+    return serialized_frame
+    
 def comp_browser(
     input_path,
     output_path=None,
@@ -162,15 +308,292 @@ def decode_masks(masks: Dict[int, Dict[int, Dict[str, Union[Tuple[int, int, int]
     for frame_idx, group in masks.items():
         decoded[frame_idx] = {}
         for obj_id, mask_info in group.items():
-            # Cada mask_info deve ter pelo menos a chave 'data'
-            if isinstance(mask_info, dict) and 'data' in mask_info:
+            # Cada mask_info deve ter 'counts' (RLE) ou 'data' (PNG)
+            if isinstance(mask_info, dict) and 'counts' in mask_info:
+                decoded_mask = decode_mask_rle(mask_info)
+                decoded[frame_idx][obj_id] = cv2.cvtColor(decoded_mask, cv2.COLOR_GRAY2RGB)
+            elif isinstance(mask_info, dict) and 'data' in mask_info:
                 decoded_mask = decode_mask(mask_info['data'])
                 decoded[frame_idx][obj_id] = decoded_mask
             else:
-                decoded[frame_idx][obj_id] = None  # Ou deixar sem máscara se não tiver 'data'
+                decoded[frame_idx][obj_id] = None  # Ou deixar sem máscara se não tiver dados
     
     return decoded
 
+class DecodedMasks(Mapping):
+    """
+    {frame_idx: {obj_id: máscara 2D uint8 (0/255)}} descodificado de forma preguiçosa.
+
+    As máscaras de um frame só são descodificadas quando o frame é acedido pela primeira vez,
+    com apenas um canal, e os últimos `max_frames` frames descodificados ficam numa cache LRU.
+    Aceita um dict de máscaras serializadas ou um MaskStage.
+    """
+    def __init__(self, serialized_masks: Mapping, max_frames: int = 64) -> None:
+        self.serialized_masks = serialized_masks
+        self.max_frames = max_frames
+        self._cache: 'OrderedDict[int, Dict[int, np.ndarray]]' = OrderedDict()
+        self._lock = threading.Lock()
+        self.products = MaskProducts(self) # Máscaras derivadas (redimensionadas, binarizadas, ...)
+
+    def __getitem__(self, frame_idx: int) -> Dict[int, np.ndarray]:
+        with self._lock:
+            if frame_idx in self._cache:
+                self._cache.move_to_end(frame_idx)
+                return self._cache[frame_idx]
+        
+        frame_masks = {
+            obj_id: decode_serialized_mask(mask_info)
+            for obj_id, mask_info in self.serialized_masks[frame_idx].items()
+        }
+        
+        with self._lock:
+            self._cache[frame_idx] = frame_masks
+            if len(self._cache) > self.max_frames:
+                self._cache.popitem(last=False)
+        return frame_masks
+
+    def object_ids(self, frame_idx: int) -> List[int]:
+        """IDs dos objetos com máscara num frame, sem descodificar nada"""
+        if frame_idx not in self.serialized_masks:
+            return []
+        if hasattr(self.serialized_masks, 'object_ids'):
+            return self.serialized_masks.object_ids(frame_idx)
+        return list(self.serialized_masks[frame_idx].keys())
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self.serialized_masks)
+
+    def __len__(self) -> int:
+        return len(self.serialized_masks)
+
+    def __contains__(self, frame_idx: object) -> bool:
+        return frame_idx in self.serialized_masks
+
+class ObjectFrameMasks(Mapping):
+    """
+    Vista {frame_idx: {obj_id: máscara}} apenas com o objeto `obj_id`, excluindo o frame `exclude_frame_idx`.
+    As máscaras só são obtidas (e descodificadas, no caso de DecodedMasks) quando cada frame é acedido.
+    """
+    def __init__(self, masks: Mapping, obj_id: int, exclude_frame_idx: Optional[int] = None) -> None:
+        self.masks = masks
+        self.obj_id = obj_id
+        object_ids = masks.object_ids if hasattr(masks, 'object_ids') else (lambda f: masks[f].keys())
+        self._frames = [
+            frame_idx for frame_idx in masks
+            if frame_idx != exclude_frame_idx and obj_id in object_ids(frame_idx)
+        ]
+        self._frames_set = set(self._frames)
+
+    def __getitem__(self, frame_idx: int) -> Dict[int, np.ndarray]:
+        if frame_idx not in self._frames_set:
+            raise KeyError(frame_idx)
+        return {self.obj_id: self.masks[frame_idx][self.obj_id]}
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(self._frames)
+
+    def __len__(self) -> int:
+        return len(self._frames)
+
+    def __contains__(self, frame_idx: object) -> bool:
+        return frame_idx in self._frames_set
+
+class OccupancyIndex:
+    """
+    Ocupação de um objeto em todos os frames de uma track, para a procura de frames de substituição.
+
+    Para cada frame guarda a caixa envolvente e dois bitsets de uma grelha grosseira (células com algum
+    píxel do objeto / células totalmente cobertas), calculados uma vez sobre a máscara binarizada no
+    tamanho `size` (INTER_NEAREST). A maioria dos frames fica assim aceite ou rejeitada com operações
+    bit a bit; só os restantes precisam de ser comparados em resolução completa.
+    """
+    MAX_GRID = 64 # Nº máximo de células no lado maior da grelha
+
+    def __init__(self, masks: Mapping, obj_id: int, size: Tuple[int, int]) -> None:
+        width, height = size
+        self.size = size
+        cell = max(1, math.ceil(max(width, height) / OccupancyIndex.MAX_GRID))
+        self._ys = np.r_[np.arange(0, height, cell), height] # Limites das células
+        self._xs = np.r_[np.arange(0, width, cell), width]
+        self._cell_area = np.diff(self._ys)[:, None] * np.diff(self._xs)[None, :]
+        grid_bytes = math.ceil(self._cell_area.size / 8)
+
+        object_ids = masks.object_ids if hasattr(masks, 'object_ids') else (lambda f: masks[f].keys())
+        frames, boxes, any_bits, full_bits = [], [], [], []
+        for frame_idx in masks:
+            if obj_id not in object_ids(frame_idx):
+                continue
+            mask = masks[frame_idx].get(obj_id)
+            if mask is None:
+                continue
+            binary = cv2.resize(mask, size, interpolation=cv2.INTER_NEAREST) > 254
+            any_cells, full_cells = self._cells(binary)
+            frames.append(frame_idx)
+            boxes.append(self._box(binary))
+            any_bits.append(any_cells)
+            full_bits.append(full_cells)
+
+        self.frames = np.array(frames, dtype=np.int64)
+        self.boxes = np.array(boxes, dtype=np.int64).reshape(-1, 4)
+        self.any_bits = np.array(any_bits, dtype=np.uint8).reshape(-1, grid_bytes)
+        self.full_bits = np.array(full_bits, dtype=np.uint8).reshape(-1, grid_bytes)
+
+    @property
+    def nbytes(self) -> int:
+        return self.frames.nbytes + self.boxes.nbytes + self.any_bits.nbytes + self.full_bits.nbytes
+
+    def _cells(self, binary: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """Bitsets (np.packbits) das células com algum píxel e das totalmente cobertas"""
+        # Nº de píxeis por célula a partir da imagem integral
+        integral = cv2.integral(binary.view(np.uint8))[self._ys][:, self._xs]
+        counts = integral[1:, 1:] - integral[:-1, 1:] - integral[1:, :-1] + integral[:-1, :-1]
+        return np.packbits(counts > 0), np.packbits(counts == self._cell_area)
+
+    @staticmethod
+    def _box(binary: np.ndarray) -> Tuple[int, int, int, int]:
+        """(x0, y0, x1, y1) com x1/y1 exclusivos; (0, 0, 0, 0) se estiver vazia"""
+        x, y, w, h = cv2.boundingRect(binary.astype(np.uint8))
+        return (x, y, x + w, y + h)
+
+    def candidates(self, main_bin: np.ndarray, main_frame_idx: int) -> Iterator[Tuple[int, bool]]:
+        """
+        Frames que podem não sobrepor `main_bin` (binária, no tamanho do índice), por ordem de distância
+        a `main_frame_idx` (empates pela ordem da track), sem o próprio frame e sem os que sobrepõem com certeza.
+
+        Yields:
+            Tuple[int, bool]: (frame_idx, True se não há sobreposição garantidamente).
+        """
+        main = main_bin > 0
+        main_any, main_full = self._cells(main)
+        x0, y0, x1, y1 = self._box(main)
+        boxes = self.boxes
+
+        disjoint = (boxes[:, 0] >= x1) | (boxes[:, 2] <= x0) | (boxes[:, 1] >= y1) | (boxes[:, 3] <= y0)
+        clear = disjoint | ~np.bitwise_and(self.any_bits, main_any).any(axis=1)
+        # Uma célula coberta num dos lados com algum píxel do outro é sobreposição certa
+        overlapping = (
+            np.bitwise_and(self.full_bits, main_any).any(axis=1)
+            | np.bitwise_and(self.any_bits, main_full).any(axis=1)
+        )
+
+        order = np.argsort(np.abs(self.frames - main_frame_idx), kind='stable')
+        keep = (clear | ~overlapping) & (self.frames != main_frame_idx)
+        for i in order[keep[order]]:
+            yield int(self.frames[i]), bool(clear[i])
+
+class MaskProducts:
+    """
+    Máscaras derivadas de uma track ({frame_idx: {obj_id: máscara}}), com cache LRU limitada em bytes.
+
+    Cada produto (redimensionada, espelhada, binarizada, dilatada, máscara de fundo) tem 1 canal e é
+    calculado uma vez por (frame, objeto, tamanho, flip, interpolação, dilatação), sendo partilhado
+    por todos os efeitos, pelos dois stages do render e pelas layers que usam a mesma track.
+    Os arrays devolvidos são partilhados: não devem ser alterados.
+    """
+    def __init__(self, masks: Mapping, max_bytes: int = 256 * 1024 * 1024) -> None:
+        self.masks = masks
+        self.max_bytes = max_bytes
+        self._cache: 'OrderedDict[Tuple, Optional[np.ndarray]]' = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def _cached(self, key: Tuple, build) -> Optional[np.ndarray]:
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return self._cache[key]
+
+        product = build()
+
+        with self._lock:
+            if key not in self._cache:
+                self._cache[key] = product
+                self._bytes += getattr(product, 'nbytes', 0)
+                while self._bytes > self.max_bytes and len(self._cache) > 1:
+                    _, evicted = self._cache.popitem(last=False)
+                    self._bytes -= getattr(evicted, 'nbytes', 0)
+        return product
+
+    def _mask(self, frame_idx: int, obj_id: int) -> Optional[np.ndarray]:
+        if frame_idx not in self.masks:
+            return None
+        return self.masks[frame_idx].get(obj_id)
+
+    def resized(
+        self,
+        frame_idx: int,
+        obj_id: int,
+        size: Tuple[int, int],
+        flipped: bool = False,
+        interpolation: int = cv2.INTER_LINEAR,
+    ) -> Optional[np.ndarray]:
+        """Máscara do objeto redimensionada para `size` (largura, altura) e espelhada se `flipped`"""
+        def build():
+            mask = self._mask(frame_idx, obj_id)
+            if mask is None:
+                return None
+            mask = cv2.resize(mask, size, interpolation=interpolation)
+            return cv2.flip(mask, 1) if flipped else mask
+        return self._cached(('resized', frame_idx, obj_id, size, flipped, interpolation), build)
+
+    def binary(
+        self,
+        frame_idx: int,
+        obj_id: int,
+        size: Tuple[int, int],
+        flipped: bool = False,
+        interpolation: int = cv2.INTER_LINEAR,
+        dilation: int = 0,
+    ) -> Optional[np.ndarray]:
+        """Objeto = 255 e resto = 0 (píxeis > 254 de `resized`), depois de dilatar com uma elipse de raio `dilation`"""
+        def build():
+            mask = self.resized(frame_idx, obj_id, size, flipped, interpolation)
+            if mask is None:
+                return None
+            if dilation > 0:
+                kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*dilation+1, 2*dilation+1))
+                mask = cv2.dilate(mask, kernel)
+            return cv2.threshold(mask, 254, 255, cv2.THRESH_BINARY)[1]
+        return self._cached(('binary', frame_idx, obj_id, size, flipped, interpolation, dilation), build)
+
+    def background(self, frame_idx: int, size: Tuple[int, int], flipped: bool = False) -> np.ndarray:
+        """Fundo = 255 e objetos = 0: inverso do máximo das máscaras do frame (redimensionadas com INTER_NEAREST)"""
+        def build():
+            obj_ids = self.masks.object_ids(frame_idx) if hasattr(self.masks, 'object_ids') else list(self.masks.get(frame_idx, {}))
+            combined = np.zeros((size[1], size[0]), dtype=np.uint8)
+            for obj_id in obj_ids:
+                mask = self.resized(frame_idx, obj_id, size, flipped, cv2.INTER_NEAREST)
+                if mask is not None:
+                    cv2.max(combined, mask, dst=combined)
+            return cv2.bitwise_not(combined)
+        return self._cached(('background', frame_idx, size, flipped), build)
+
+    def bbox(self, frame_idx: int, obj_id: int, size: Tuple[int, int], flipped: bool = False) -> Optional[Tuple[int, int, int, int]]:
+        """Caixa envolvente (x, y, largura, altura) dos píxeis de `binary`; largura 0 se não houver nenhum"""
+        def build():
+            binary = self.binary(frame_idx, obj_id, size, flipped)
+            return None if binary is None else cv2.boundingRect(binary)
+        return self._cached(('bbox', frame_idx, obj_id, size, flipped), build)
+
+    def occupancy(self, obj_id: int, size: Tuple[int, int]) -> OccupancyIndex:
+        """Índice de ocupação do objeto em todos os frames da track, construído uma vez por tamanho"""
+        return self._cached(('occupancy', obj_id, size), lambda: OccupancyIndex(self.masks, obj_id, size))
+
+def mask_products(masks: Optional[Mapping]) -> Optional[MaskProducts]:
+    """Cache de máscaras derivadas de uma track (partilhada se for DecodedMasks)"""
+    if not masks:
+        return None
+    return getattr(masks, 'products', None) or MaskProducts(masks)
+
+def file_sha256(file_obj, chunk_size: int = 1024 * 1024) -> str:
+    """Hash SHA-256 do conteúdo de um ficheiro aberto (lido por blocos); volta a pôr o cursor no início"""
+    digest = hashlib.sha256()
+    file_obj.seek(0)
+    for chunk in iter(lambda: file_obj.read(chunk_size), b''):
+        digest.update(chunk)
+    file_obj.seek(0)
+    return digest.hexdigest()
+
 def unique_filename(folder: str, prefix: str = "file_", ext: str = ".txt") -> str:
     """
     Gera um nome de ficheiro único que ainda não exista no diretório fornecido.
@@ -1,9 +1,17 @@
 import cv2
 import numpy as np
 import math
-from typing import List, Dict, Optional, Tuple, Callable, Union
+import queue
+import bisect
+import subprocess
+import threading
+from collections import OrderedDict, deque
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Dict, Optional, Tuple, Callable, Union, Iterable, Set
 from dataclasses import dataclass
 
+from seek_index import IndexedVideoReader
+
 PROCESS_STAGE_PRE_TRANSFORM = 0
 PROCESS_STAGE_POST_TRANSFORM = 1
 
@@ -23,6 +31,8 @@ class LayerInfo:
     fps: int = 30
     opacity: float = 1.0
     border_radius: int = 0
+    static: bool = False # Sem efeitos/animações: o rect não muda e os frames mantêm o alpha do vídeo
+    serial: bool = False # Os efeitos leem (ou são lidos por) outras layers: processada por ordem de frame, na thread da composição
     
     @property
     def x(self) -> float:
@@ -99,19 +109,39 @@ class VideoCaptureObject:
     def duration(self) -> float:
         return self.frame_count / max(self.fps, 1)
 
+    @property
+    def known_frame_count(self) -> Optional[int]:
+        """Número de frames do vídeo quando é exato (o `frame_count` do container pode estar sobrestimado), senão None."""
+        return None
+
+    @property
+    def position(self) -> int:
+        """Índice do próximo frame que `read()` devolve."""
+        raise NotImplementedError
+
     def set_frame(self, frame_idx: int) -> None:
         raise NotImplementedError
 
     def read(self) -> Tuple[bool, np.ndarray]:
         raise NotImplementedError
 
+    def grab(self) -> bool:
+        """Avança um frame sem o devolver."""
+        return self.read()[0]
+
     def release(self) -> None:
         """Libera os recursos do vídeo."""
         raise NotImplementedError
 
 class VideoCapturePath(VideoCaptureObject):
+    """
+    Vídeo em ficheiro. Os seeks usam o SeekIndex do vídeo (keyframe anterior + descodificação
+    para a frente) e só acontecem no `read()` seguinte, por isso `set_frame`/`grab` são baratos.
+    """
     def __init__(self, video_path: str):
         self.cap: cv2.VideoCapture = cv2.VideoCapture(video_path)
+        self.reader = IndexedVideoReader(video_path, self.cap)
+        self._position = 0
     
     @property
     def fps(self) -> float:
@@ -133,15 +163,31 @@ class VideoCapturePath(VideoCaptureObject):
         """Retorna o número total de frames do vídeo."""
         return int(self.cap.get(cv2.CAP_PROP_FRAME_COUNT))
     
+    @property
+    def known_frame_count(self) -> Optional[int]:
+        """Frames no SeekIndex (um pacote por frame), se o vídeo puder ser indexado."""
+        index = self.reader.index
+        return len(index) if index is not None else None
+
+    @property
+    def position(self) -> int:
+        return self._position
+    
     def set_frame(self, fram_idx: int) -> None:
         """Define a posição do frame atual."""
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, fram_idx)
+        self._position = fram_idx
     
     def read(self) -> Tuple[bool, np.ndarray]:
-        return self.cap.read()
+        self._position += 1
+        return self.reader.read(self._position - 1)
+    
+    def grab(self) -> bool:
+        """Avança um frame; o decoder só é posicionado no próximo `read()` (que deteta o fim do vídeo)."""
+        self._position += 1
+        return True
     
     def release(self):
-        self.cap.release()
+        self.reader.release()
     
 class VideoCaptureArray(VideoCaptureObject):
     def __init__(self, video: VideoArray):
@@ -164,9 +210,21 @@ class VideoCaptureArray(VideoCaptureObject):
     def frame_count(self) -> int:
         return len(self.video)
 
+    @property
+    def known_frame_count(self) -> Optional[int]:
+        return len(self.video)
+
+    @property
+    def position(self) -> int:
+        return self.index
+
     def set_frame(self, frame_idx: int) -> None:
         self.index = frame_idx
 
+    def grab(self) -> bool:
+        self.index += 1
+        return 0 < self.index <= len(self.video)
+
     def read(self) -> Tuple[bool, np.ndarray]:
         if 0 <= self.index < len(self.video):
             frame = self.video[self.index]
@@ -178,6 +236,87 @@ class VideoCaptureArray(VideoCaptureObject):
         self.index = 0
         self.video = None
 
+def read_frame_at(capture: VideoCaptureObject, frame_idx: int, max_grab_skip: int = 0) -> Tuple[bool, np.ndarray]:
+    """
+    Lê o frame `frame_idx` evitando seeks: se for o próximo frame lê sequencialmente, se estiver
+    até `max_grab_skip` frames à frente salta com `grab()`, caso contrário faz seek.
+    """
+    skip = frame_idx - capture.position
+    if skip < 0 or skip > max_grab_skip:
+        capture.set_frame(frame_idx)
+    else:
+        for _ in range(skip):
+            if not capture.grab():
+                return False, None
+    return capture.read()
+
+class FrameReadAhead:
+    """
+    Descodifica os frames de uma layer numa thread própria, à frente do render.
+
+    Recebe as posições que o render vai pedir (por ordem) e vai colocando os frames numa
+    fila limitada, de forma que a descodificação se sobrepõe aos efeitos e ao blending.
+    Usa a sua própria captura, por isso os acessos aleatórios de `get_frame_by_idx`
+    (ex: blend, remoção de objetos) não interferem com a leitura sequencial.
+    """
+    MAX_GRAB_SKIP = 30 # Saltos maiores (ou para trás) fazem seek
+    _END = object()
+
+    def __init__(self, capture: VideoCaptureObject, frame_positions: Iterable[int], queue_size: int = 8) -> None:
+        self.capture = capture
+        self.frames: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.stop_event = threading.Event()
+        self.finished = False
+        self.thread = threading.Thread(target=self._run, args=(frame_positions,), daemon=True, name='frame_read_ahead')
+        self.thread.start()
+
+    def _put(self, item) -> bool:
+        while not self.stop_event.is_set():
+            try:
+                self.frames.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def _run(self, frame_positions: Iterable[int]) -> None:
+        try:
+            last_pos = None
+            for frame_pos in frame_positions:
+                if frame_pos == last_pos:
+                    continue
+                last_pos = frame_pos
+                ret, frame = read_frame_at(self.capture, frame_pos, self.MAX_GRAB_SKIP)
+                if not self._put((frame_pos, ret, frame)) or not ret:
+                    return
+        except Exception as e:
+            print(f'[FrameReadAhead] Erro a descodificar: {str(e)}')
+        finally:
+            self._put(self._END)
+
+    def get(self, frame_idx: int) -> Optional[Tuple[bool, np.ndarray]]:
+        """
+        Devolve o frame `frame_idx` se for o próximo da fila (descartando os anteriores),
+        ou None se não estiver na sequência prevista.
+        """
+        while not self.finished:
+            item = self.frames.get()
+            if item is self._END:
+                self.finished = True
+                break
+            frame_pos, ret, frame = item
+            if frame_pos == frame_idx:
+                return ret, frame
+            if frame_pos > frame_idx:
+                # Fora da sequência prevista; este frame já não será pedido
+                return None
+        return None
+
+    def close(self) -> None:
+        self.stop_event.set()
+        self.thread.join()
+        self.capture.release()
+
 class RenderInfo:
     def __init__(self, video: Union[str, VideoArray], layer_info: LayerInfo, size: Tuple[int, int]):
         if isinstance(video, str):
@@ -187,11 +326,16 @@ class RenderInfo:
         else:
             raise ValueError('Tipo de vídeo inválido. Deve ser str ou VideoArray.')
         
+        self.video = video
+        self.read_ahead: Optional[FrameReadAhead] = None
+        self.capture_lock = threading.Lock() # Outras layers podem pedir frames desta em paralelo
+        self.max_grab_skip = 0 # Saltos curtos para a frente com grab() em vez de seek (ex: scrubbing)
         self.frame_position: int = 0
         self.layer: LayerInfo = layer_info
         self.cached_mask: Optional[np.ndarray] = None  # Máscara atual (se houver)
         self.cached_frame: Optional[np.ndarray] = None  # Frame atual
         self.cached_frame_pos: int = -1  # Posição do frame atual no cache
+        self.cached_transform: Optional[Tuple[Tuple, 'LayerTransform']] = None  # Transformação da última geometria
         self.size = size
         
         if self.layer.width == None:
@@ -200,9 +344,28 @@ class RenderInfo:
             self.layer.height = int(self.capture.height)
             
     def get_frame_by_idx(self, frame_idx: int) -> Tuple[int, np.ndarray]:
-        self.capture.set_frame(frame_idx)
-        ret, frame = self.capture.read()
-        return ret, frame
+        """Acesso aleatório; só faz seek se `frame_idx` não for o próximo frame da captura."""
+        with self.capture_lock:
+            return read_frame_at(self.capture, frame_idx, self.max_grab_skip)
+
+    def start_read_ahead(self, frame_positions: Iterable[int], queue_size: int = 8) -> None:
+        """Começa a descodificar `frame_positions` em background (só para vídeos em ficheiro)."""
+        if isinstance(self.video, str) and self.read_ahead is None:
+            self.read_ahead = FrameReadAhead(VideoCapturePath(self.video), frame_positions, queue_size)
+
+    def read_frame(self, frame_idx: int) -> Tuple[int, np.ndarray]:
+        """Frame para o render sequencial: vem do read-ahead se estiver ativo e na sequência prevista."""
+        if self.read_ahead is not None:
+            result = self.read_ahead.get(frame_idx)
+            if result is not None:
+                return result
+        return self.get_frame_by_idx(frame_idx)
+
+    def release(self) -> None:
+        if self.read_ahead is not None:
+            self.read_ahead.close()
+            self.read_ahead = None
+        self.capture.release()
     
     @property
     def fps(self) -> float:
@@ -235,13 +398,403 @@ class Rect:
     def __str__(self) -> str:
         return f"Rect(x={self.x}, y={self.y}, width={self.width}, height={self.height})"
 
+@dataclass
+class LayerTransform:
+    """Rotação + translação de uma layer para o canvas, já recortada à parte visível."""
+    matrix: Optional[np.ndarray] # Matriz afim (frame da layer -> ROI recortado); None sem rotação
+    x: int # Bounding box da layer (rodada) no canvas
+    y: int
+    width: int
+    height: int
+    x1: int # Parte visível no canvas
+    y1: int
+    x2: int
+    y2: int
+
+    @property
+    def visible(self) -> bool:
+        return self.x1 < self.x2 and self.y1 < self.y2
+
+    @staticmethod
+    def build(width: int, height: int, rotation: float, x: int, y: int, canvas_size: Tuple[int, int]) -> 'LayerTransform':
+        matrix = None
+        if rotation:
+            center = (width // 2, height // 2)
+            
+            # Calcula a nova bounding box após a rotação
+            radians = math.radians(rotation)
+            sin = math.sin(radians)
+            cos = math.cos(radians)
+            new_w = int((height * abs(sin)) + (width * abs(cos)))
+            new_h = int((height * abs(cos)) + (width * abs(sin)))
+            
+            # Ajusta a matriz de transformação para incluir a translação
+            matrix = cv2.getRotationMatrix2D(center, -rotation, 1.0)
+            matrix[0, 2] += (new_w - width) / 2
+            matrix[1, 2] += (new_h - height) / 2
+            
+            # Atualiza as coordenadas para manter o centro na mesma posição
+            x -= (new_w - width) // 2
+            y -= (new_h - height) // 2
+            width, height = new_w, new_h
+        
+        # Coordenadas visíveis no canvas
+        canvas_width, canvas_height = canvas_size
+        x1, y1 = max(0, x), max(0, y)
+        x2, y2 = min(canvas_width, x + width), min(canvas_height, y + height)
+        transform = LayerTransform(matrix, x, y, width, height, x1, y1, x2, y2)
+        
+        if matrix is not None and transform.visible:
+            # A rotação escreve diretamente na parte visível: o que fica fora do canvas nunca é amostrado
+            matrix[0, 2] -= x1 - x
+            matrix[1, 2] -= y1 - y
+        return transform
+
+    def warp(self, frame: np.ndarray) -> np.ndarray:
+        """Aplica a rotação e o recorte num só warpAffine; devolve BGRA."""
+        if frame.shape[2] == 3:
+            # O warp de 4 canais é mais rápido do que warp de 3 + alpha à parte
+            frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
+        size = (self.x2 - self.x1, self.y2 - self.y1)
+        return cv2.warpAffine(frame, self.matrix, size, flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(0,0,0,0))
+
+@dataclass
+class LayerFrame:
+    """Frame de uma layer já processado e a sua posição no frame composto."""
+    frame: np.ndarray
+    y1: int
+    y2: int
+    x1: int
+    x2: int
+    opacity: float = 1.0 # Opacidade da layer, aplicada no blend
+
+def alpha_blend(dst: np.ndarray, frame: np.ndarray, opacity: float = 1.0) -> None:
+    """
+    Mistura `frame` (BGR ou BGRA) sobre `dst` (BGR), in-place, com aritmética inteira saturada
+    do OpenCV sobre os 3 canais de uma vez (sem temporários float64 e sem segurar o GIL).
+
+    A opacidade da layer é combinada com o alpha do frame no mesmo passo. Frames totalmente
+    opacos são copiados e totalmente transparentes são ignorados, sem contas por pixel.
+    """
+    opacity = min(max(opacity, 0.0), 1.0)
+    
+    if frame.shape[2] == 3:
+        if opacity >= 1.0:
+            dst[:] = frame
+        elif opacity > 0.0:
+            # Alpha constante: uma só passagem
+            cv2.addWeighted(frame, opacity, dst, 1.0 - opacity, 0, dst=dst)
+        return
+    
+    alpha = frame[..., 3]
+    if opacity < 1.0:
+        alpha = cv2.convertScaleAbs(alpha, alpha=opacity)
+    
+    if not cv2.countNonZero(alpha):
+        return # Totalmente transparente
+    color = cv2.cvtColor(frame, cv2.COLOR_BGRA2BGR)
+    if cv2.countNonZero(cv2.bitwise_not(alpha)) == 0:
+        dst[:] = color # Totalmente opaco
+        return
+    
+    # dst = color * a / 255 + dst * (255 - a) / 255
+    alpha = cv2.merge((alpha, alpha, alpha))
+    foreground = cv2.multiply(color, alpha, scale=1 / 255)
+    background = cv2.multiply(dst, cv2.bitwise_not(alpha), scale=1 / 255)
+    cv2.add(foreground, background, dst=dst)
+
+class FFmpegVideoWriter:
+    """
+    Encoder com a mesma interface que cv2.VideoWriter (write/release), mas que envia os frames BGR
+    em bruto pelo stdin de um único processo ffmpeg, que gera logo o ficheiro final para o browser
+    (H.264 + yuv420p + faststart, as mesmas opções que `comp_browser`).
+    """
+    def __init__(
+        self,
+        output_path: str,
+        fps: float,
+        size: Tuple[int, int],
+        crf: int = 23,
+        preset: str = 'fast',
+        video_codec: str = 'libx264',
+        extra_flags: Optional[List[str]] = None,
+    ) -> None:
+        self.output_path = output_path
+        self.width, self.height = size
+        
+        cmd = [
+            'ffmpeg',
+            '-y', # Overwrite output file without asking
+            '-loglevel', 'error',
+            '-f', 'rawvideo', # Frames em bruto pelo stdin
+            '-pix_fmt', 'bgr24',
+            '-s', f'{self.width}x{self.height}',
+            '-r', str(fps),
+            '-i', '-',
+            '-an',
+            '-c:v', video_codec,
+            '-preset', preset,
+            '-crf', str(crf),
+            '-pix_fmt', 'yuv420p', # Formato suportado por todos os browsers
+            '-movflags', '+faststart', # Enables progressive streaming (start video before full download)
+        ]
+        if self.width % 2 or self.height % 2:
+            # yuv420p exige dimensões pares
+            cmd += ['-vf', 'pad=ceil(iw/2)*2:ceil(ih/2)*2']
+        if extra_flags:
+            cmd += extra_flags
+        cmd.append(str(output_path))
+        
+        self.cmd = cmd
+        self.process = subprocess.Popen(cmd, stdin=subprocess.PIPE)
+
+    def write(self, frame: np.ndarray) -> None:
+        if frame.shape[:2] != (self.height, self.width):
+            raise ValueError(f'Frame {frame.shape[1]}x{frame.shape[0]} não corresponde a {self.width}x{self.height}')
+        if frame.ndim == 3 and frame.shape[2] == 4:
+            frame = frame[..., :3]
+        try:
+            self.process.stdin.write(np.ascontiguousarray(frame, dtype=np.uint8).tobytes())
+        except BrokenPipeError:
+            # O ffmpeg terminou antes do tempo; o erro real é reportado em release()
+            self.release()
+            raise
+
+    def release(self) -> None:
+        """Fecha o stdin e espera que o ffmpeg termine de escrever o ficheiro."""
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        returncode = self.process.wait()
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, self.cmd)
+
+    def abort(self) -> None:
+        """Termina o ffmpeg sem finalizar o ficheiro (ex: erro a meio do render)."""
+        self.process.kill()
+        if self.process.stdin and not self.process.stdin.closed:
+            try:
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+        self.process.wait()
+
+class AsyncVideoWriter:
+    """
+    Envia os frames para `writer` numa thread própria, através de uma fila limitada,
+    para que a codificação se sobreponha à composição dos frames seguintes.
+    """
+    _END = object()
+
+    def __init__(self, writer: FFmpegVideoWriter, queue_size: int = 8) -> None:
+        self.writer = writer
+        self.frames: queue.Queue = queue.Queue(maxsize=queue_size)
+        self.error: Optional[BaseException] = None
+        self.thread = threading.Thread(target=self._run, daemon=True, name='video_writer')
+        self.thread.start()
+
+    def _run(self) -> None:
+        while True:
+            frame = self.frames.get()
+            if frame is self._END:
+                return
+            if self.error is None:
+                try:
+                    self.writer.write(frame)
+                except BaseException as e:
+                    self.error = e
+
+    def write(self, frame: np.ndarray) -> None:
+        if self.error is not None:
+            raise self.error
+        self.frames.put(frame)
+
+    def release(self) -> None:
+        self.frames.put(self._END)
+        self.thread.join()
+        if self.error is not None:
+            self.writer.abort()
+            raise self.error
+        self.writer.release()
+
+    def abort(self) -> None:
+        self.writer.abort() # Desbloqueia a thread se estiver presa a escrever no ffmpeg
+        self.frames.put(self._END)
+        self.thread.join()
+
+class RoundedCornersCache:
+    """
+    Máscaras de cantos arredondados já calculadas, por (largura, altura, raio), numa cache LRU limitada.
+
+    Só os cantos têm pixels transparentes, por isso guarda-se apenas um tile por canto
+    (a bounding box dos pixels a 0); o interior da layer nunca é tocado.
+    """
+    MAX_ENTRIES = 32
+
+    _tiles: 'OrderedDict[Tuple[int, int, int], List[Tuple[slice, slice, np.ndarray]]]' = OrderedDict()
+    _lock = threading.Lock()
+
+    @staticmethod
+    def get(width: int, height: int, radius: int) -> List[Tuple[slice, slice, np.ndarray]]:
+        key = (width, height, radius)
+        with RoundedCornersCache._lock:
+            tiles = RoundedCornersCache._tiles.get(key)
+            if tiles is not None:
+                RoundedCornersCache._tiles.move_to_end(key)
+                return tiles
+
+        tiles = RoundedCornersCache._build(width, height, radius)
+        with RoundedCornersCache._lock:
+            RoundedCornersCache._tiles[key] = tiles
+            if len(RoundedCornersCache._tiles) > RoundedCornersCache.MAX_ENTRIES:
+                RoundedCornersCache._tiles.popitem(last=False)
+        return tiles
+
+    @staticmethod
+    def _build(w: int, h: int, radius: int) -> List[Tuple[slice, slice, np.ndarray]]:
+        # Cria máscara de cantos arredondados para o alpha
+        mask = np.zeros((h, w), dtype=np.uint8)
+        cv2.rectangle(mask, (radius, 0), (w - radius, h), 255, -1)
+        cv2.rectangle(mask, (0, radius), (w, h - radius), 255, -1)
+        cv2.circle(mask, (radius, radius), radius, 255, -1)
+        cv2.circle(mask, (w - radius - 1, radius), radius, 255, -1)
+        cv2.circle(mask, (radius, h - radius - 1), radius, 255, -1)
+        cv2.circle(mask, (w - radius - 1, h - radius - 1), radius, 255, -1)
+
+        # Fora dos cantos (radius + 1 pixels de cada lado) a máscara é sempre 255
+        corner = radius + 1
+        tiles = []
+        for rows in (slice(0, min(corner, h)), slice(max(h - corner, 0), h)):
+            for cols in (slice(0, min(corner, w)), slice(max(w - corner, 0), w)):
+                ys, xs = np.nonzero(mask[rows, cols] == 0)
+                if len(ys) == 0:
+                    continue
+                tile_rows = slice(rows.start + ys.min(), rows.start + ys.max() + 1)
+                tile_cols = slice(cols.start + xs.min(), cols.start + xs.max() + 1)
+                tiles.append((tile_rows, tile_cols, mask[tile_rows, tile_cols].copy()))
+        return tiles
+
+@dataclass
+class TimelineSegment:
+    """Troço [start_frame, end_frame) da timeline em que o conjunto de layers ativas não muda."""
+    start_frame: int
+    end_frame: int
+    layers: List[LayerInfo] # Layers a processar, pela ordem de composição
+    culled: List[Tuple[LayerInfo, List[LayerInfo]]] # Layers tapadas e as layers que as tapam
+
+class TimelineIndex:
+    """
+    Índice das layers ativas ao longo da timeline.
+
+    Cada layer está visível num único intervalo contíguo de frames (o tempo do vídeo cresce
+    com o tempo global). Os limites dos intervalos dividem a timeline em troços, e cada troço
+    guarda as layers ativas, já sem as que estão totalmente tapadas por uma layer opaca acima.
+    Só tapam outras as layers de `occluders`: aquelas cujo intervalo é exato (dão um frame em todos
+    os frames do intervalo), porque uma layer tapada não é processada nesse troço.
+    """
+    def __init__(
+        self,
+        intervals: Dict[int, Tuple[int, int]],
+        layers: List[LayerInfo],
+        canvas_size: Tuple[int, int],
+        occluders: Optional[Set[int]] = None,
+    ) -> None:
+        self.intervals = intervals # layer_idx -> [start_frame, end_frame)
+        occluders = set() if occluders is None else occluders
+        boundaries = sorted({frame for interval in intervals.values() for frame in interval})
+        self.segments: List[TimelineSegment] = []
+        for start_frame, end_frame in zip(boundaries[:-1], boundaries[1:]):
+            active = [
+                layer for layer in layers
+                if intervals[layer.layer_idx][0] <= start_frame < intervals[layer.layer_idx][1]
+            ]
+            visible, culled = TimelineIndex._cull(active, canvas_size, occluders)
+            self.segments.append(TimelineSegment(start_frame, end_frame, visible, culled))
+        self._starts = [segment.start_frame for segment in self.segments]
+
+    def segment(self, frame_idx: int) -> Optional[TimelineSegment]:
+        i = bisect.bisect_right(self._starts, frame_idx) - 1
+        if i < 0 or frame_idx >= self.segments[i].end_frame:
+            return None
+        return self.segments[i]
+
+    def layers(self, frame_idx: int) -> List[LayerInfo]:
+        """Layers a processar no frame `frame_idx`, pela ordem de composição."""
+        segment = self.segment(frame_idx)
+        return segment.layers if segment else []
+
+    def frames(self, layer: LayerInfo, start_frame: int, end_frame: int) -> Iterable[int]:
+        """Frames em [start_frame, end_frame) em que a layer é processada."""
+        layer_start, layer_end = self.intervals[layer.layer_idx]
+        for segment in self.segments:
+            if segment.end_frame <= max(start_frame, layer_start) or segment.start_frame >= min(end_frame, layer_end):
+                continue
+            if any(active is layer for active in segment.layers):
+                yield from range(max(segment.start_frame, start_frame), min(segment.end_frame, end_frame))
+
+    @staticmethod
+    def _canvas_rect(layer: LayerInfo, canvas_size: Tuple[int, int]) -> Tuple[int, int, int, int]:
+        """Parte visível da layer no canvas (x1, y1, x2, y2), ou o canvas todo se o rect pode mudar."""
+        canvas_width, canvas_height = canvas_size
+        if not layer.static:
+            return 0, 0, canvas_width, canvas_height
+        transform = LayerTransform.build(int(layer.width), int(layer.height), layer.rotation, int(layer.x), int(layer.y), canvas_size)
+        return transform.x1, transform.y1, transform.x2, transform.y2
+
+    @staticmethod
+    def _is_opaque(layer: LayerInfo) -> bool:
+        """A layer cobre todo o seu rect com pixels opacos em todos os frames."""
+        return (
+            layer.static and isinstance(layer.video, str) # Vídeos em ficheiro são BGR, sem alpha
+            and not layer.rotation and layer.opacity >= 1.0 and layer.border_radius <= 0
+        )
+
+    @staticmethod
+    def _cull(
+        layers: List[LayerInfo],
+        canvas_size: Tuple[int, int],
+        occluder_ids: Set[int],
+    ) -> Tuple[List[LayerInfo], List[Tuple[LayerInfo, List[LayerInfo]]]]:
+        occluders = [
+            (i, layer, TimelineIndex._canvas_rect(layer, canvas_size))
+            for i, layer in enumerate(layers) if layer.layer_idx in occluder_ids and TimelineIndex._is_opaque(layer)
+        ]
+        visible, culled = [], []
+        for i, layer in enumerate(layers):
+            x1, y1, x2, y2 = TimelineIndex._canvas_rect(layer, canvas_size)
+            covering = [
+                occluder for j, occluder, (ox1, oy1, ox2, oy2) in occluders
+                if j > i and ox1 <= x1 and oy1 <= y1 and ox2 >= x2 and oy2 >= y2
+            ]
+            if covering:
+                culled.append((layer, covering))
+            else:
+                visible.append(layer)
+        return visible, culled
+
 class VideoCompositor:
-    def __init__(self, output_path: str, output_width: int, output_height: int, fps: Optional[float] = None):
+    def __init__(
+        self, 
+        output_path: str, 
+        output_width: int, 
+        output_height: int, 
+        fps: Optional[float] = None,
+        crf: int = 23,
+        preset: str = 'fast',
+        frames_in_flight: int = 4,
+    ):
         self.output_path = output_path
         self.output_width = output_width
         self.output_height = output_height
         self.fps = fps
+        self.crf = crf
+        self.preset = preset
+        self.frames_in_flight = frames_in_flight # Frames a ser processados em paralelo à frente do encoder
         self.layers: List[LayerInfo] = []
+        self._frame_render_infos: Optional[Dict[int, RenderInfo]] = None # Captures abertas por render_frame
+        self._frame_timeline: Optional[Tuple[float, int]] = None
 
     @staticmethod
     def rect_with_rounded_corners(image: np.ndarray, radius: int, thickness: int = 0, color: Tuple[int, int, int, int] = (0, 0, 0, 255)) -> np.ndarray:
@@ -249,20 +802,12 @@ class VideoCompositor:
 
         # Se thickness for zero, não desenhamos borda, apenas retornamos imagem original com cantos arredondados (via alpha)
         if thickness == 0:
-            result = image.copy()
-            if result.shape[2] == 3:
-                result = cv2.cvtColor(result, cv2.COLOR_BGR2BGRA)
+            result = cv2.cvtColor(image, cv2.COLOR_BGR2BGRA) if image.shape[2] == 3 else image.copy()
             
-            # Cria máscara de cantos arredondados para o alpha
-            mask = np.zeros((h, w), dtype=np.uint8)
-            cv2.rectangle(mask, (radius, 0), (w - radius, h), 255, -1)
-            cv2.rectangle(mask, (0, radius), (w, h - radius), 255, -1)
-            cv2.circle(mask, (radius, radius), radius, 255, -1)
-            cv2.circle(mask, (w - radius - 1, radius), radius, 255, -1)
-            cv2.circle(mask, (radius, h - radius - 1), radius, 255, -1)
-            cv2.circle(mask, (w - radius - 1, h - radius - 1), radius, 255, -1)
-
-            result[..., 3] = (result[..., 3].astype(np.float32) * (mask / 255)).astype(np.uint8)
+            # A máscara (0 ou 255) só tem zeros nos cantos: aplica-se apenas aos tiles dos cantos
+            alpha = result[..., 3]
+            for rows, cols, tile in RoundedCornersCache.get(w, h, radius):
+                alpha[rows, cols] = cv2.bitwise_and(alpha[rows, cols], tile)
             return result
 
         # Se thickness > 0, criamos imagem maior com borda
@@ -315,6 +860,65 @@ class VideoCompositor:
         effective_duration = (end_t - layer.start_t) / layer.speed
         return effective_duration + layer.st_offset
     
+    def _create_render_infos(self) -> Dict[int, RenderInfo]:
+        output_size = (int(self.output_width), int(self.output_height))
+        return { layer.layer_idx: RenderInfo(layer.video, layer, output_size) for layer in self.layers }
+
+    def _timeline(self, render_infos: Dict[int, RenderInfo]) -> Tuple[float, int]:
+        """FPS e número total de frames do vídeo composto."""
+        fps = self.fps if self.fps is not None else (max(ri.capture.fps for ri in render_infos.values()) or 30.0)
+        max_duration = max(self._get_effective_duration(layer, ri.capture) for layer, ri in zip(self.layers, render_infos.values()) if layer.draw)
+        return fps, int(max_duration * fps)
+
+    def timeline(self) -> Tuple[float, int]:
+        """FPS e número total de frames que `render` vai produzir (abre e fecha as captures)."""
+        render_infos = self._create_render_infos()
+        try:
+            return self._timeline(render_infos)
+        finally:
+            for ri in render_infos.values():
+                ri.release()
+
+    def _layer_frame_positions(self, render_info: RenderInfo, timeline: TimelineIndex, fps: float, start_frame: int, end_frame: int) -> Iterable[int]:
+        """Posições (no vídeo da layer) que `_render_layer` vai pedir ao longo do render, por ordem."""
+        layer = render_info.layer
+        for frame_idx in timeline.frames(layer, start_frame, end_frame):
+            video_time = layer.start_t + (frame_idx / fps * layer.speed) - layer.st_offset
+            yield int(video_time * render_info.fps)
+
+    def _visible_interval(self, render_info: RenderInfo, fps: float, total_frames: int) -> Tuple[int, int]:
+        """
+        Intervalo [start, end) de frames em que `_should_render_layer` é verdadeiro, limitado aos frames
+        que o vídeo tem de facto quando o número é conhecido (`known_frame_count`).
+        O tempo do vídeo cresce com o tempo global, por isso chega uma pesquisa binária em cada ponta.
+        """
+        layer = render_info.layer
+        end_time = layer.end_t if layer.end_t is not None else self._get_duration(render_info.capture)
+        known_frame_count = render_info.capture.known_frame_count
+        if known_frame_count is not None and render_info.fps > 0:
+            end_time = min(end_time, known_frame_count / render_info.fps)
+        
+        def video_time(frame_idx: int) -> float:
+            return layer.start_t + (frame_idx / fps * layer.speed) - layer.st_offset
+        
+        frames = range(total_frames)
+        start = bisect.bisect_left(frames, True, key=lambda i: i / fps >= layer.st_offset and video_time(i) >= layer.start_t)
+        end = bisect.bisect_left(frames, True, key=lambda i: video_time(i) >= end_time)
+        return start, max(start, end)
+
+    def _timeline_index(self, render_infos: Dict[int, RenderInfo], fps: float, total_frames: int) -> TimelineIndex:
+        draw_layers = [layer for layer in self.layers if layer.draw]
+        intervals = {
+            layer.layer_idx: self._visible_interval(render_infos[layer.layer_idx], fps, total_frames)
+            for layer in draw_layers
+        }
+        # Uma layer só tapa outras se se souber que tem frames até ao fim do seu intervalo
+        occluders = {
+            layer.layer_idx for layer in draw_layers
+            if render_infos[layer.layer_idx].capture.known_frame_count is not None
+        }
+        return TimelineIndex(intervals, draw_layers, (int(self.output_width), int(self.output_height)), occluders)
+
     def _should_render_layer(self, render_info: RenderInfo, current_time: float) -> bool:
         """Determina se a layer deve ser renderizada no tempo atual."""
         # Se o tempo atual é antes do offset de início
@@ -340,12 +944,30 @@ class VideoCompositor:
         Aplica uma layer ao frame composto, respeitando a máscara.
         Retorna True se o frame foi aplicado, False se o vídeo já terminou.
         """
+        if not self._should_render_layer(render_infos[layer.layer_idx], frame_idx / fps):
+            return False
+        layer_frame = self._render_layer(render_infos, layer, frame_idx, fps, on_frame)
+        if layer_frame is None:
+            return False
+        VideoCompositor._blend_layer(composite, layer_frame)
+        return True
+
+    def _render_layer(
+        self, 
+        render_infos: List[RenderInfo], 
+        layer: LayerInfo, 
+        frame_idx: int, 
+        fps: int,
+        on_frame: Optional[Callable[[RenderInfo, np.ndarray, int, int], np.ndarray]] = None
+    ) -> Optional[LayerFrame]:
+        """
+        Descodifica, aplica os efeitos e transforma o frame de uma layer, sem tocar no frame composto
+        (pode correr em paralelo com as outras layers). Retorna None se a layer não é desenhada neste frame.
+        A visibilidade da layer no tempo é verificada por quem chama (ver TimelineIndex).
+        """
         render_info = render_infos[layer.layer_idx]
         global_time = frame_idx / fps
         
-        if not self._should_render_layer(render_info, global_time):
-            return False
-        
         video_time = layer.start_t + (global_time  * layer.speed) - layer.st_offset
         target_frame_pos = int(video_time * render_info.fps)
         
@@ -353,9 +975,9 @@ class VideoCompositor:
         x, y = int(layer.x), int(layer.y)
         
         if render_info.cached_frame_pos != target_frame_pos:
-            ret, frame = render_info.get_frame_by_idx(target_frame_pos)
+            ret, frame = render_info.read_frame(target_frame_pos)
             if not ret:
-                return False
+                return None
                 
             frame = cv2.resize(frame, (width, height))
             
@@ -365,9 +987,10 @@ class VideoCompositor:
             render_info.cached_frame = frame
             render_info.cached_frame_pos = target_frame_pos
         
+        frame = render_info.cached_frame.copy()
         frame = on_frame(
             render_info, 
-            render_info.cached_frame.copy(), 
+            frame, 
             target_frame_pos, 
             fps, 
             width,
@@ -380,56 +1003,33 @@ class VideoCompositor:
         ) if on_frame else frame
         
         if frame is None:
-            return False
+            return None
                                 
         if layer.border_radius > 0:
             frame = VideoCompositor.rect_with_rounded_corners(frame, int(layer.border_radius))
-                                
-        # Aplica rotação ao frame
-        if layer.rotation:
-            if frame.shape[2] == 3:
-                frame = cv2.cvtColor(frame, cv2.COLOR_BGR2BGRA)
-                
-            h, w = frame.shape[:2]
-            center = (w // 2, h // 2)
-            
-            # Calcula a nova bounding box após a rotação
-            radians = math.radians(layer.rotation)
-            sin = math.sin(radians)
-            cos = math.cos(radians)
-            new_w = int((h * abs(sin)) + (w * abs(cos)))
-            new_h = int((h * abs(cos)) + (w * abs(sin)))
-            
-            # Ajusta a matriz de transformação para incluir a translação
-            M = cv2.getRotationMatrix2D(center, -layer.rotation, 1.0)
-            M[0, 2] += (new_w - w) / 2
-            M[1, 2] += (new_h - h) / 2
-            
-            # Aplica a rotação com as novas dimensões
-            frame = cv2.warpAffine(frame, M, (new_w, new_h), flags=cv2.INTER_LINEAR, borderMode=cv2.BORDER_CONSTANT, borderValue=(0,0,0,0))
-            
-            # Atualiza as coordenadas para manter o centro na mesma posição
-            x -= (new_w - w) // 2
-            y -= (new_h - h) // 2
-            width, height = new_w, new_h
         
-        # Coordenadas visíveis no canvas
-        x1 = max(0, x)
-        y1 = max(0, y)
-        x2 = min(composite.shape[1], x + width)
-        y2 = min(composite.shape[0], y + height)
+        # Rotação + translação + recorte ao canvas; a matriz é reutilizada enquanto a geometria não muda
+        h, w = frame.shape[:2]
+        transform_key = (w, h, layer.rotation, x, y, render_info.size)
+        if render_info.cached_transform is None or render_info.cached_transform[0] != transform_key:
+            render_info.cached_transform = (transform_key, LayerTransform.build(w, h, layer.rotation, x, y, render_info.size))
+        transform = render_info.cached_transform[1]
         
-        if x1 >= x2 or y1 >= y2:
-            return False
+        if not transform.visible:
+            return None
         
+        x, y, width, height = transform.x, transform.y, transform.width, transform.height
+        x1, y1, x2, y2 = transform.x1, transform.y1, transform.x2, transform.y2
         fx1 = x1 - x
         fy1 = y1 - y
         fx2 = fx1 + (x2 - x1)
         fy2 = fy1 + (y2 - y1)
         
-        # Região de interesse (ROI) no frame composto
-        roi = composite[y1:y2, x1:x2]
-        frame = frame[fy1:fy2, fx1:fx2]
+        # O frame composto ainda não existe aqui; os efeitos só usam as coordenadas do ROI
+        if transform.matrix is not None:
+            frame = transform.warp(frame)
+        else:
+            frame = frame[fy1:fy2, fx1:fx2]
             
         frame = on_frame(
             render_info, 
@@ -438,7 +1038,7 @@ class VideoCompositor:
             fps, 
             width,
             height,
-            RoiInfo(roi, y1, y2, x1, x2, fy1, fy2, fx1, fx2),
+            RoiInfo(None, y1, y2, x1, x2, fy1, fy2, fx1, fx2),
             render_infos,
             video_time,
             global_time,
@@ -446,69 +1046,159 @@ class VideoCompositor:
         ) if on_frame else frame
         
         if frame is None:
-            return False
+            return None
         
-        if layer.opacity < 1.0:
-            if frame.shape[2] == 4:
-                frame[..., 3] = (frame[..., 3] * layer.opacity).astype(np.uint8)
-            else:
-                # Se não tiver canal alfa, adiciona um com opacidade
-                alpha = np.full(frame.shape[:2], int(255 * layer.opacity), dtype=np.uint8)
-                frame = np.dstack((frame, alpha))
-                             
-        if frame.shape[2] == 4:  # Se tem alpha channel
-            alpha = frame[..., 3] / 255.0
-            for c in range(3):
-                roi[..., c] = (
-                    frame[..., c] * alpha +
-                    roi[..., c] * (1 - alpha)
-            ).astype(np.uint8)
-        else:
-            roi[:] = frame
-                    
-        return True
+        return LayerFrame(frame, y1, y2, x1, x2, layer.opacity)
+
+    @staticmethod
+    def _blend_layer(composite: np.ndarray, layer_frame: LayerFrame) -> None:
+        """Mistura o frame de uma layer no frame composto (na ordem das layers)."""
+        roi = composite[layer_frame.y1:layer_frame.y2, layer_frame.x1:layer_frame.x2]
+        alpha_blend(roi, layer_frame.frame, layer_frame.opacity)
+        
+    def render_frame(
+        self,
+        time: float,
+        on_frame: Optional[Callable[[RenderInfo, np.ndarray, int, int], np.ndarray]] = None,
+        max_grab_skip: int = 15,
+    ) -> Optional[np.ndarray]:
+        """
+        Compõe um único frame (BGR) no instante `time` (segundos), pelo mesmo caminho que `render`.
+
+        As captures ficam abertas entre chamadas (até `release`), por isso pedidos seguidos
+        só fazem seek quando o salto é grande; avanços curtos são lidos com grab().
+        Retorna None se `time` estiver fora da timeline.
+        """
+        if self._frame_render_infos is None:
+            self._frame_render_infos = self._create_render_infos()
+            self._frame_timeline = self._timeline(self._frame_render_infos)
+            for render_info in self._frame_render_infos.values():
+                render_info.max_grab_skip = max_grab_skip
+        render_infos = self._frame_render_infos
+        fps, total_frames = self._frame_timeline
+        
+        frame_idx = int(time * fps)
+        if not 0 <= frame_idx < total_frames:
+            return None
         
+        composite = np.zeros((int(self.output_height), int(self.output_width), 3), dtype=np.uint8)
+        for layer in self.layers:
+            if layer.draw:
+                self._apply_layer(render_infos, composite, layer, frame_idx, fps, on_frame)
+        return composite
+
+    def release(self) -> None:
+        """Fecha as captures abertas por `render_frame`."""
+        if self._frame_render_infos is not None:
+            for render_info in self._frame_render_infos.values():
+                render_info.release()
+            self._frame_render_infos = None
+            self._frame_timeline = None
+
     def render(
         self, 
         on_frame: Optional[Callable[[RenderInfo, np.ndarray, int, int], np.ndarray]] = None,
         on_progress: Callable[[float], None] = None, 
-        progress_interval: int = 30
+        progress_interval: int = 30,
+        start_frame: int = 0,
+        end_frame: Optional[int] = None,
+        warmup_frames: int = 1,
     ) -> None:
-        """Renderiza o vídeo composto e salva em `output_path`."""
+        """
+        Renderiza o vídeo composto e salva em `output_path` (já em H.264, pronto para o browser).
+
+        Com `start_frame`/`end_frame` renderiza só esse troço da timeline (ver project_renderer).
+        Os `warmup_frames` anteriores a `start_frame` são processados sem ser escritos, para que o
+        estado mutável dos efeitos e animações (ex: `previous_position`, opacidades) seja o mesmo
+        que teria num render completo.
+        """
         output_width = int(self.output_width)
         output_height = int(self.output_height)
         
-        render_infos = { layer.layer_idx: RenderInfo(layer.video, layer, (output_width, output_height)) for layer in self.layers }
-        fps = self.fps if self.fps is not None else (max(ri.capture.fps for ri in render_infos.values()) or 30.0)
-        max_duration = max(self._get_effective_duration(layer, ri.capture) for layer, ri in zip(self.layers, render_infos.values()) if layer.draw)
+        render_infos = self._create_render_infos()
+        fps, total_frames = self._timeline(render_infos)
+        end_frame = total_frames if end_frame is None else min(end_frame, total_frames)
+        warmup_start = max(start_frame - warmup_frames, 0)
         
-        total_frames = int(max_duration * fps)  
+        # Pipeline: descodificação (read-ahead) -> efeitos de cada layer (uma thread por layer, os frames
+        # de uma layer são processados por ordem) -> composição (esta thread) -> codificação (thread do writer).
+        # O OpenCV liberta o GIL, por isso as layers de um projeto usam vários cores.
+        # Só as layers ativas (e não tapadas) em cada frame são processadas. As layers `serial` (ex: blend
+        # ou overlapVideo, que leem o rect e a capture de outra layer) são processadas na composição,
+        # frame a frame e pela ordem das layers, como num render sem threads
+        timeline = self._timeline_index(render_infos, fps, total_frames)
+        draw_layers = [layer for layer in self.layers if layer.draw]
+        layer_workers = {
+            layer.layer_idx: ThreadPoolExecutor(max_workers=1, thread_name_prefix=f'render_layer_{layer.layer_idx}')
+            for layer in draw_layers if not layer.serial
+        }
+        pending: deque = deque()
         
-        fourcc = cv2.VideoWriter_fourcc(*'mp4v')
-        out = cv2.VideoWriter(
-            self.output_path,
-            fourcc,
-            fps,
-            (output_width, output_height)
-        )
-
-        for frame_idx in range(total_frames):
-            composite = np.zeros((output_height, output_width, 3), dtype=np.uint8)
+        def submit_layer(layer: LayerInfo, frame_idx: int):
+            return layer_workers[layer.layer_idx].submit(self._render_layer, render_infos, layer, frame_idx, fps, on_frame)
+        
+        def submit_frame(frame_idx: int) -> None:
+            segment = timeline.segment(frame_idx)
+            layers = segment.layers if segment else []
+            futures = {layer.layer_idx: submit_layer(layer, frame_idx) for layer in layers if not layer.serial}
+            pending.append((frame_idx, layers, futures))
+        
+        def composite_frame() -> None:
+            frame_idx, layers, futures = pending.popleft()
+            layer_frames = {layer_idx: future.result() for layer_idx, future in futures.items()}
+            for layer in layers:
+                if layer.serial:
+                    layer_frames[layer.layer_idx] = self._render_layer(render_infos, layer, frame_idx, fps, on_frame)
             
-            for layer in self.layers:
-                if layer.draw:
-                    self._apply_layer(render_infos, composite, layer, frame_idx, fps, on_frame)
+            composite = np.zeros((output_height, output_width, 3), dtype=np.uint8)
+            for layer in draw_layers:
+                layer_frame = layer_frames.get(layer.layer_idx)
+                if layer_frame is not None:
+                    VideoCompositor._blend_layer(composite, layer_frame)
             
             out.write(composite)
             
             # Mostra progresso
             if on_progress and frame_idx % progress_interval == 0:  # A cada ~1 segundo
-                on_progress(frame_idx / total_frames * 100.0)
+                on_progress((frame_idx - start_frame) / max(end_frame - start_frame, 1) * 100.0)
 
-        # Libera todos os recursos
-        out.release()
-        for ri in render_infos.values():
-            ri.capture.release()
+        # Os frames compostos vão diretamente para o ffmpeg, sem ficheiro intermédio
+        out = AsyncVideoWriter(FFmpegVideoWriter(
+            self.output_path,
+            fps,
+            (output_width, output_height),
+            crf=self.crf,
+            preset=self.preset,
+        ))
+
+        try:
+            # Cada layer visível descodifica os seus frames em background, à frente do render
+            for layer in draw_layers:
+                render_info = render_infos[layer.layer_idx]
+                render_info.start_read_ahead(self._layer_frame_positions(render_info, timeline, fps, warmup_start, end_frame))
+            
+            # Aquece o estado das layers com os frames anteriores ao troço (não são escritos)
+            for frame_idx in range(warmup_start, start_frame):
+                for layer in timeline.layers(frame_idx):
+                    self._render_layer(render_infos, layer, frame_idx, fps, on_frame)
+            
+            for frame_idx in range(start_frame, end_frame):
+                submit_frame(frame_idx)
+                if len(pending) >= max(self.frames_in_flight, 1):
+                    composite_frame()
+            while pending:
+                composite_frame()
+        except BaseException:
+            out.abort()
+            raise
+        else:
+            out.release()
+        finally:
+            # Libera todos os recursos
+            for worker in layer_workers.values():
+                worker.shutdown(wait=True, cancel_futures=True)
+            for ri in render_infos.values():
+                ri.release()
             
 if __name__ == "__main__":
     
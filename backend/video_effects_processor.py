@@ -1,10 +1,16 @@
 import cv2
 import numpy as np
-from typing import Dict, Any, Optional
+from typing import Dict, Any, Optional, Mapping
 from utils import *
 from video_compositor import RenderInfo, RoiInfo, Rect
 import math
 
+# Só dependem da cor do píxel; custo aproximado de cada um na cadeia, em conversões de espaço de cor
+COLOR_LUT_SETTINGS = {'exposure': 0, 'brightness': 1, 'contrast': 0, 'hue': 1, 'saturation': 1, 'sharpen': 2}
+# Sem LUT: o brilho (lightness em HLS, mantendo a saturação) é descontínuo perto do preto e do branco,
+# e a saturação é calculada em HLS de 8 bits (em degraus); a interpolação afastava-se da cadeia
+COLOR_LUT_EXCLUDED = ('brightness', 'saturation')
+
 class VideoEffectsProcessor:
     
     @staticmethod
@@ -238,12 +244,14 @@ class VideoEffectsProcessor:
     @staticmethod
     def find_best_replacement_mask(
         main_mask: np.ndarray,
-        other_masks: Dict[int, Dict[int, np.ndarray]],  # {frame_idx: {obj_id: mask}}
+        other_masks: Optional[Dict[int, Dict[int, np.ndarray]]],  # {frame_idx: {obj_id: mask}}
         width: int,
         height: int,
         main_frame_idx: int,
         obj_id: int,
-        dilation_radius: int = 15
+        dilation_radius: int = 15,
+        products: Optional[MaskProducts] = None,
+        flipped: bool = False,
     ) -> Optional[Tuple[int, np.ndarray]]:
         """
         Encontra a melhor máscara de substituição baseada na proximidade do frame_idx
@@ -251,16 +259,36 @@ class VideoEffectsProcessor:
         
         Args:
             main_mask: Array NumPy da máscara principal (255 = branco, 0 = preto)
-            other_masks: Dicionário de máscaras organizadas por frame_idx e obj_id
+            other_masks: Dicionário de máscaras organizadas por frame_idx e obj_id (não usado com `products`)
             width: Largura das máscaras (não usado diretamente, já que as máscaras são arrays)
             height: Altura das máscaras (idem)
             main_frame_idx: Frame index da máscara principal
             obj_id: ID do objeto para filtrar máscaras correspondentes
+            products: Máscaras derivadas da track; com elas os outros frames vêm do índice de ocupação
+                (MaskProducts.occupancy) e a dilatação e as binarizações vêm da cache
+            flipped: Se a máscara principal está espelhada (só usado com `products`)
         
         Returns:
             A máscara de substituição ideal ou None se nenhuma for adequada
         """
-        if main_mask is None or not other_masks:
+        if main_mask is None:
+            return None
+        
+        if products is not None:
+            # Dilatada e binarizada uma vez por frame (partilhada com erase_object_with_replacement)
+            main_bin = products.binary(main_frame_idx, obj_id, (width, height), flipped, dilation=dilation_radius)
+            
+            # O índice (construído uma vez por track) resolve a maioria dos frames com operações bit a bit;
+            # só os duvidosos são comparados em resolução completa
+            for frame_idx, no_overlap in products.occupancy(obj_id, (width, height)).candidates(main_bin, main_frame_idx):
+                if not no_overlap:
+                    other_bin = products.binary(frame_idx, obj_id, (width, height), interpolation=cv2.INTER_NEAREST)
+                    if cv2.countNonZero(cv2.bitwise_and(main_bin, other_bin)):
+                        continue
+                return (frame_idx, products.resized(frame_idx, obj_id, (width, height), interpolation=cv2.INTER_NEAREST))
+            return None
+        
+        if not other_masks:
             return None
         
         main_mask = cv2.resize(main_mask, (width, height), interpolation=cv2.INTER_NEAREST)
@@ -302,7 +330,8 @@ class VideoEffectsProcessor:
         replacement_frame: np.ndarray,
         width: int,
         height: int,
-        dilation_radius: int = 15
+        dilation_radius: int = 15,
+        dilated_mask: Optional[np.ndarray] = None,
     ) -> np.ndarray:
         """
         Substitui o objeto na área branca da máscara pelo conteúdo do replacement_frame.
@@ -315,18 +344,24 @@ class VideoEffectsProcessor:
             width: Largura do frame
             height: Altura do frame
             dilation_radius: Raio de dilatação para a máscara principal (default: 2)
+            dilated_mask: Máscara principal já dilatada e binarizada (ver MaskProducts.binary); evita dilatar outra vez
         Returns:
             Frame com o objeto substituído
         """
         # Redimensiona todas as entradas para garantir compatibilidade
-        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
-        replacement_mask = cv2.resize(replacement_mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        if replacement_mask.shape[:2] != (height, width):
+            replacement_mask = cv2.resize(replacement_mask, (width, height), interpolation=cv2.INTER_NEAREST)
         replacement_frame = cv2.resize(replacement_frame, (width, height))
         
-        # Aplica dilatação na máscara principal
-        if dilation_radius > 0:
-            kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*dilation_radius+1, 2*dilation_radius+1))
-            mask = cv2.dilate(mask, kernel)
+        if dilated_mask is not None:
+            mask = dilated_mask
+        else:
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+            
+            # Aplica dilatação na máscara principal
+            if dilation_radius > 0:
+                kernel = cv2.getStructuringElement(cv2.MORPH_ELLIPSE, (2*dilation_radius+1, 2*dilation_radius+1))
+                mask = cv2.dilate(mask, kernel)
         
         # Cria máscara binária (objeto = 1, fundo = 0)
         obj_mask = (mask > 254).astype(np.uint8)
@@ -337,9 +372,9 @@ class VideoEffectsProcessor:
         # Combina as condições: área do objeto E área válida na replacement_mask
         combined_mask = obj_mask * valid_replace_mask
         
-        # Aplica a substituição apenas nas áreas combinadas
+        # Aplica a substituição apenas nas áreas combinadas (mantém o alpha se existir)
         result = frame.copy()
-        result[combined_mask == 1] = replacement_frame[combined_mask == 1]
+        result[combined_mask == 1, :3] = replacement_frame[combined_mask == 1, :3]
         return result
     
     @staticmethod
@@ -358,35 +393,92 @@ class VideoEffectsProcessor:
         
         # Where the mask is white, set alpha to 0 (fully transparent)
         # Else, set alpha to 255 (fully opaque)
-        frame_bgra[:, :, 3] = np.where(mask > 254, 0, 255)
+        VideoEffectsProcessor.set_alpha_from_mask(frame_bgra, cv2.threshold(mask, 254, 255, cv2.THRESH_BINARY)[1])
         
         return frame_bgra
     
     @staticmethod
-    def change_color(frame, mask, width, height, color, settings, detection_color: int = 255):
+    def mask_roi(mask: np.ndarray, bbox: Optional[Tuple[int, int, int, int]] = None, padding: int = 0) -> Tuple[slice, slice]:
+        """
+        Slices (linhas, colunas) da caixa envolvente dos píxeis não nulos de `mask`, com `padding` píxeis
+        de margem (limitada ao frame). `bbox` (x, y, largura, altura) evita percorrer a máscara, ex: MaskProducts.bbox.
+        """
+        x, y, w, h = bbox if bbox is not None else cv2.boundingRect(mask.view(np.uint8) if mask.dtype == bool else mask)
+        if w == 0 or h == 0:
+            return slice(0, 0), slice(0, 0)
+        height, width = mask.shape[:2]
+        return (
+            slice(max(y - padding, 0), min(y + h + padding, height)),
+            slice(max(x - padding, 0), min(x + w + padding, width)),
+        )
+    
+    @staticmethod
+    def set_alpha_from_mask(frame: np.ndarray, obj_mask: np.ndarray, bbox: Optional[Tuple[int, int, int, int]] = None) -> None:
+        """Alpha (in place) = 0 onde `obj_mask` é 255 e 255 no resto; a máscara só é percorrida na sua caixa envolvente"""
+        frame[:, :, 3] = 255
+        rows, cols = VideoEffectsProcessor.mask_roi(obj_mask, bbox)
+        alpha = frame[rows, cols, 3]
+        alpha[obj_mask[rows, cols] == 255] = 0
+    
+    @staticmethod
+    def change_color(
+        frame,
+        mask,
+        width,
+        height,
+        color,
+        settings,
+        detection_color: int = 255,
+        bbox: Optional[Tuple[int, int, int, int]] = None,
+        inplace: bool = False,
+        lut: Optional['ColorLUT'] = None,
+    ):
+        """
+        Aplica o colorEffect (blur, cor e efeitos de cor) aos píxeis `detection_color` da máscara.
+
+        Só a caixa envolvente da máscara (`bbox`, ou calculada aqui) é lida e escrita, por isso o custo
+        é proporcional ao objeto e não ao frame. Com `inplace`, o resultado é escrito em `frame` (BGR ou BGRA,
+        o alpha é mantido); caso contrário é devolvida uma cópia. `lut` é a ColorLUT destes `settings`.
+        """
         if frame is None or mask is None:
             print('frame, mask, or size not set')
             return None
 
-        # 1. Redimensiona tudo de uma vez (mais eficiente)
-        frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LINEAR)
-        mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+        # 1. Redimensiona tudo de uma vez (mais eficiente); normalmente já vêm no tamanho do frame
+        if frame.shape[:2] != (height, width):
+            frame = cv2.resize(frame, (width, height), interpolation=cv2.INTER_LINEAR)
+            inplace = True # Já é uma cópia
+        if mask.shape[:2] != (height, width):
+            mask = cv2.resize(mask, (width, height), interpolation=cv2.INTER_NEAREST)
+            bbox = None # Era do tamanho antigo
 
-        # 2. Cria máscara binária
-        mask_binary = (mask[:,:,0] == detection_color) & (mask[:,:,1] == detection_color) & (mask[:,:,2] == detection_color)
+        # 2. Cria máscara binária (máscaras de objetos têm 1 canal, a de fundo tem 3)
+        if mask.ndim == 2:
+            mask_binary = mask == detection_color
+        else:
+            mask_binary = (mask[:,:,0] == detection_color) & (mask[:,:,1] == detection_color) & (mask[:,:,2] == detection_color)
         
-        # 3. Cria cópia do frame original para trabalhar
-        output = frame.copy()
+        # 3. Frame de saída e recorte da caixa envolvente da máscara (views: escrever nelas altera `output`)
+        output = frame if inplace else frame.copy()
+        rows, cols = VideoEffectsProcessor.mask_roi(mask_binary, bbox)
+        mask_binary = mask_binary[rows, cols]
+        source = frame[rows, cols][mask_binary] # Píxeis originais (o blur escreve por cima com inplace)
+        output_roi = output[rows, cols]
+        if not len(source):
+            return output
         
         # 4. Aplica blur apenas na região da máscara se necessário
         if settings.get('blur', 0) > 0:
-            blurred = VideoEffectsProcessor.apply_blur_effect(frame, settings['blur'])
-            output[mask_binary] = blurred[mask_binary]
+            # Margem do raio do kernel: dentro do recorte o resultado é igual ao do blur do frame inteiro
+            blur_rows, blur_cols = VideoEffectsProcessor.mask_roi(mask, (cols.start, rows.start, cols.stop - cols.start, rows.stop - rows.start), int(settings['blur']))
+            blurred = VideoEffectsProcessor.apply_blur_effect(frame[blur_rows, blur_cols], settings['blur'])
+            blurred = blurred[rows.start - blur_rows.start:rows.stop - blur_rows.start, cols.start - blur_cols.start:cols.stop - blur_cols.start]
+            output_roi[mask_binary] = blurred[mask_binary]
 
         # 5. Applies base color if specified 
         if color:
             # Calculates the average intensity per pixel (R+G+B)/3, normalized to [0, 1]
-            intensity = np.mean(frame[mask_binary], axis=1) / 255.0
+            intensity = np.mean(source[:, :3], axis=1) / 255.0
 
             # Converts the color to a NumPy array for vectorized operations
             solid_color = np.array([color['b'], color['g'], color['r']], dtype=np.float32)
@@ -403,44 +495,56 @@ class VideoEffectsProcessor:
                 # For RGBA output
                 output_vals = np.empty((len(result), 4), dtype=np.uint8)
                 output_vals[:, :3] = np.clip(result, 0, 255).astype(np.uint8)  # RGB channels
-                output_vals[:, 3] = output[mask_binary][:, 3]  # Preserve original alpha channel
+                output_vals[:, 3] = output_roi[mask_binary][:, 3]  # Preserve original alpha channel
             else:
                 # For RGB output
                 output_vals = np.clip(result, 0, 255).astype(np.uint8)
 
             # Apply to output
-            output[mask_binary] = output_vals
+            output_roi[mask_binary] = output_vals
 
         # 6. Aplica outros efeitos
         if any(k in settings for k in ['exposure', 'brightness', 'contrast', 'hue', 'saturation', 'sharpen', 'noise', 'vignette']):
-            output = VideoEffectsProcessor.apply_color_effects(output, mask_binary, settings)
+            output_roi[:, :, :3] = VideoEffectsProcessor.apply_color_effects(output_roi[:, :, :3], mask_binary, settings, (width, height), lut)
 
         return output
 
     @staticmethod
-    def apply_color_effects(frame: np.ndarray, mask: np.ndarray, settings: Dict):
-        """Aplica efeitos de cor de forma organizada e modular"""
+    def apply_color_effects(
+        frame: np.ndarray,
+        mask: np.ndarray,
+        settings: Dict,
+        frame_size: Optional[Tuple[int, int]] = None,
+        lut: Optional['ColorLUT'] = None,
+    ):
+        """
+        Aplica efeitos de cor de forma organizada e modular.
+        
+        `frame` pode ser o recorte da máscara; `frame_size` (largura, altura) é então o tamanho do frame
+        inteiro, de que depende o padrão do ruído. Com `lut` (compilada com estes `settings`), os efeitos
+        que só dependem da cor vêm da LUT quando a máscara tem pelo menos `lut.size` píxeis.
+        """
         output = frame.copy()
         roi = output[mask]
         
         if roi.size == 0:
             return frame
 
-        # Converter para float e processar
-        rgb = roi.astype(np.float32) / 255.0        
-        height, width = frame.shape[:2]
+        width, height = frame_size if frame_size is not None else frame.shape[1::-1]
         
-        y_indices, x_indices = np.where(mask)
-        roi_width = x_indices.max() - x_indices.min() + 1
-        roi_height = y_indices.max() - y_indices.min() + 1
+        # Exposição, brilho, contraste, hue, saturação e sharpen só dependem da cor de cada píxel:
+        # com uma LUT do efeito (e píxeis que cheguem para compensar a interpolação) vêm dela
+        if lut is not None and len(roi) >= lut.size:
+            pixels = lut.apply(roi[:, :3])
+            if not settings.get('noise', 0) > 0 and not settings.get('vignette', 0) > 0:
+                roi[:, :3] = pixels
+                output[mask] = roi
+                return output
+            rgb = pixels.astype(np.float32) / 255.0
+        else:
+            rgb = VideoEffectsProcessor._apply_pixel_effects(roi[:, :3].astype(np.float32) / 255.0, settings)
         
-        # Pipeline de processamento
-        rgb = VideoEffectsProcessor._apply_exposure(rgb, settings)
-        rgb = VideoEffectsProcessor._apply_brightness(rgb, settings)
-        rgb = VideoEffectsProcessor._apply_contrast(rgb, settings)
-        rgb = VideoEffectsProcessor._apply_hue(rgb, settings)
-        rgb = VideoEffectsProcessor._apply_saturation(rgb, settings)
-        rgb = VideoEffectsProcessor._apply_sharpen(rgb, settings)
+        # Efeitos que dependem da posição
         rgb = VideoEffectsProcessor._apply_noise(rgb, height, width, mask, settings)
         #rgb = VideoEffectsProcessor._apply_vignette(rgb, height, width, settings)
 
@@ -478,6 +582,17 @@ class VideoEffectsProcessor:
         output[mask] = roi
         return output
     
+    @staticmethod
+    def _apply_pixel_effects(rgb: np.ndarray, settings: Dict[str, Any]) -> np.ndarray:
+        """Efeitos que só dependem da cor do píxel, pela ordem do frontend"""
+        rgb = VideoEffectsProcessor._apply_exposure(rgb, settings)
+        rgb = VideoEffectsProcessor._apply_brightness(rgb, settings)
+        rgb = VideoEffectsProcessor._apply_contrast(rgb, settings)
+        rgb = VideoEffectsProcessor._apply_hue(rgb, settings)
+        rgb = VideoEffectsProcessor._apply_saturation(rgb, settings)
+        rgb = VideoEffectsProcessor._apply_sharpen(rgb, settings)
+        return rgb
+    
     @staticmethod
     def _apply_exposure(rgb: np.ndarray, settings: Dict[str, Any]):
         """Apply exposure adjustment to the RGB array."""
@@ -689,16 +804,9 @@ class VideoEffectsProcessor:
         return blurred
 
     @staticmethod
-    def other_frame_masks(frame_idx: int, obj_id: int, masks: Dict[int, Dict]) -> Dict[int, Dict[int, np.ndarray]]:
-        result = {}
-        for other_frame_idx, objs in masks.items():
-            if frame_idx != other_frame_idx:
-                for other_obj_id, mask in objs.items():
-                    if obj_id == other_obj_id:
-                        if other_frame_idx not in result:
-                            result[other_frame_idx] = {}
-                        result[other_frame_idx][other_obj_id] = mask
-        return result
+    def other_frame_masks(frame_idx: int, obj_id: int, masks: Mapping) -> Mapping[int, Dict[int, np.ndarray]]:
+        """Máscaras do objeto `obj_id` nos outros frames; cada frame só é descodificado quando é acedido"""
+        return ObjectFrameMasks(masks, obj_id, exclude_frame_idx=frame_idx)
 
     @staticmethod
     def process_pre_transform(
@@ -725,6 +833,9 @@ class VideoEffectsProcessor:
 
 
         current_frame_masks = masks.get(frame_idx, {}) if masks else {}
+        products = mask_products(masks) # Máscaras derivadas, partilhadas entre efeitos, stages e layers
+        clean_plate = video_data.get(render_info.layer.layer_idx, {}).get('clean_plate')
+        color_luts = video_data.get(render_info.layer.layer_idx, {}).get('color_luts', {}) # ColorLUT por efeito (ver ColorLUT)
         processed_frame = frame
         
         width = frame.shape[1]
@@ -736,10 +847,11 @@ class VideoEffectsProcessor:
         for back_id in ['-1', '-3']:
             effects = effects_config.get(back_id, {})
             if effects:
-                other_masks = [m for m in current_frame_masks.values()] if back_id == '-1' else []
-                background_mask = VideoEffectsProcessor.get_background_mask(other_masks, layer_width, layer_height)
-                background_mask = cv2.resize(background_mask, (layer_width, layer_height))
-                background_mask = cv2.flip(background_mask, 1) if flipped else background_mask
+                # Fundo = 255 (1 canal); sem máscaras (ou '-3') é o frame todo
+                if back_id == '-1' and products is not None:
+                    background_mask = products.background(frame_idx, (layer_width, layer_height), flipped)
+                else:
+                    background_mask = np.full((layer_height, layer_width), 255, dtype=np.uint8)
                 if background_mask is not None:
                     if enable_transparency:
                         if 'cutObjectEffect' in effects:
@@ -761,9 +873,7 @@ class VideoEffectsProcessor:
                                 processed_frame = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2BGRA)
                             
                             # 4. Aplica transparência - método mais robusto
-                            alpha_channel = np.ones((height, width), dtype=np.uint8) * 255
-                            alpha_channel[obj_mask == 255] = 0
-                            processed_frame[:, :, 3] = alpha_channel
+                            VideoEffectsProcessor.set_alpha_from_mask(processed_frame, obj_mask)
 
                     # Processa fundo se necessário
                     background_effect = effects.get('colorEffect', None)
@@ -771,13 +881,8 @@ class VideoEffectsProcessor:
                         settings = background_effect.get('settings', {})
                         color = hexToRgb(background_effect.get('color'))
                         
-                        original_alpha = None
-
-                        # Verifica se a imagem tem 4 canais (RGBA)
-                        if processed_frame.shape[2] == 4:
-                            original_alpha = processed_frame[:, :, 3].copy()  # guarda o canal alfa
-                            processed_frame = processed_frame[:, :, :3]       # usa apenas os 3 canais RGB
-                        
+                        # Só a caixa envolvente do fundo é alterada (o alpha, se existir, fica intacto);
+                        # o frame de entrada não é alterado
                         result = VideoEffectsProcessor.change_color(
                             processed_frame,
                             background_mask,
@@ -785,14 +890,12 @@ class VideoEffectsProcessor:
                             frame.shape[0],
                             color,
                             settings,
+                            inplace=processed_frame is not frame,
+                            lut=color_luts.get(back_id),
                         )
                         
                         if result is not None:
                             processed_frame = result
-                            
-                            # Recoloca o canal alfa se ele existia
-                            if original_alpha is not None and processed_frame.shape[2] == 3:
-                                processed_frame = np.dstack((processed_frame, original_alpha)) 
 
                     effect = effects.get('blendEffect', None)
                     if effect:
@@ -810,56 +913,58 @@ class VideoEffectsProcessor:
                                     processed_frame = VideoEffectsProcessor.apply_blend(frame, ref_video_frame, background_mask)
 
         # Processa máscaras de objetos
-        for obj_id, mask in current_frame_masks.items():
+        for obj_id in current_frame_masks:
             effects = effects_config.get(str(obj_id), {})
             
             # Corta a máscara para o ROI atual
-            mask = cv2.resize(mask, (layer_width, layer_height))
-            mask = cv2.flip(mask, 1) if flipped else mask
+            mask = products.resized(frame_idx, obj_id, (layer_width, layer_height), flipped)
             
             # Remove object with background replacement effect
             if 'backgroundRemoveEffect' in effects:
-                # Retrieve masks from other frames that contain the same object
-                other_masks = VideoEffectsProcessor.other_frame_masks(frame_idx, obj_id, masks) 
+                dilated_mask = products.binary(frame_idx, obj_id, (width, height), flipped, dilation=15)
                 
-                # Attempt to find the best replacement mask from nearby frames
-                replacement_mask_info = VideoEffectsProcessor.find_best_replacement_mask(
-                    mask, 
-                    other_masks, 
-                    width, 
-                    height,
-                    frame_idx,
-                    obj_id,
-                )
+                # With the track's clean plate this is a single masked copy (no other frame is decoded)
+                erased_frame = clean_plate.erase(processed_frame, dilated_mask, flipped) if clean_plate is not None else None
+                if erased_frame is not None:
+                    processed_frame = erased_frame
+                else:
+                    # Otherwise, attempt to find the best replacement mask from nearby frames
+                    # (the other frames of the same object come from the track's occupancy index)
+                    replacement_mask_info = VideoEffectsProcessor.find_best_replacement_mask(
+                        mask, 
+                        None, 
+                        width, 
+                        height,
+                        frame_idx,
+                        obj_id,
+                        products=products,
+                        flipped=flipped,
+                    )
                 
-                # If a suitable replacement mask was found
-                if replacement_mask_info:
-                    other_frame_idx, replacement_mask = replacement_mask_info
+                    # If a suitable replacement mask was found
+                    if replacement_mask_info:
+                        other_frame_idx, replacement_mask = replacement_mask_info
                     
-                    # Retrieve the frame that corresponds to the selected replacement mask
-                    ret, replacement_frame = render_info.get_frame_by_idx(other_frame_idx)
+                        # Retrieve the frame that corresponds to the selected replacement mask
+                        ret, replacement_frame = render_info.get_frame_by_idx(other_frame_idx)
                     
-                    if ret:
-                        # Use the replacement frame and mask to erase the object from the current frame
-                        processed_frame = VideoEffectsProcessor.erase_object_with_replacement(
-                            frame=processed_frame,
-                            mask=mask,
-                            replacement_mask=replacement_mask,
-                            replacement_frame=replacement_frame,
-                            width=width,
-                            height=height
-                        )
+                        if ret:
+                            # Use the replacement frame and mask to erase the object from the current frame
+                            processed_frame = VideoEffectsProcessor.erase_object_with_replacement(
+                                frame=processed_frame,
+                                mask=mask,
+                                replacement_mask=replacement_mask,
+                                replacement_frame=replacement_frame,
+                                width=width,
+                                height=height,
+                                dilated_mask=dilated_mask,
+                            )
 
             if enable_transparency:
                 if 'cutObjectEffect' in effects:
                     detection = effects.get('cutObjectEffect', 255)
-                    # 1. Garante que a máscara tem apenas 1 canal
-                    _mask = mask
-                    if _mask.ndim == 3:
-                        _mask = cv2.cvtColor(mask, cv2.COLOR_BGR2GRAY)
-                    
-                    # 2. Cria máscara binária (objeto = 255, fundo = 0)
-                    _, obj_mask = cv2.threshold(_mask, 254, 255, cv2.THRESH_BINARY)
+                    # 1-2. Máscara binária de 1 canal (objeto = 255, fundo = 0), da cache
+                    obj_mask = products.binary(frame_idx, obj_id, (layer_width, layer_height), flipped)
                     
                     if detection == 0:
                         obj_mask = cv2.bitwise_not(obj_mask) # Black turns white and white turns black
@@ -869,9 +974,8 @@ class VideoEffectsProcessor:
                         processed_frame = cv2.cvtColor(processed_frame, cv2.COLOR_BGR2BGRA)
                     
                     # 4. Aplica transparência - método mais robusto
-                    alpha_channel = np.ones((height, width), dtype=np.uint8) * 255
-                    alpha_channel[obj_mask == 255] = 0
-                    processed_frame[:, :, 3] = alpha_channel
+                    bbox = products.bbox(frame_idx, obj_id, (layer_width, layer_height), flipped) if detection != 0 else None
+                    VideoEffectsProcessor.set_alpha_from_mask(processed_frame, obj_mask, bbox)
 
             # Color effects
             effect = effects.get('colorEffect', None)
@@ -880,13 +984,7 @@ class VideoEffectsProcessor:
                 settings = effect.get('settings', {})
                 
                 if mask is not None:
-                    original_alpha = None
-
-                    # Verifica se a imagem tem 4 canais (RGBA)
-                    if processed_frame.shape[2] == 4:
-                        original_alpha = processed_frame[:, :, 3].copy()  # guarda o canal alfa
-                        processed_frame = processed_frame[:, :, :3]       # usa apenas os 3 canais RGB
-
+                    # Só a caixa envolvente do objeto (guardada com a track) é alterada; o alpha fica intacto
                     result = VideoEffectsProcessor.change_color(
                         processed_frame,
                         mask,
@@ -894,15 +992,14 @@ class VideoEffectsProcessor:
                         height,
                         color,
                         settings,
+                        bbox=products.bbox(frame_idx, obj_id, (layer_width, layer_height), flipped),
+                        inplace=processed_frame is not frame,
+                        lut=color_luts.get(str(obj_id)),
                     )
 
                     if result is not None:
                         processed_frame = result
 
-                        # Recoloca o canal alfa se ele existia
-                        if original_alpha is not None and processed_frame.shape[2] == 3:
-                            processed_frame = np.dstack((processed_frame, original_alpha)) 
-
             effect = effects.get('blendEffect', None)
             if effect:
                 ref_video_id = effect.get('blendVideoId')
@@ -941,12 +1038,12 @@ class VideoEffectsProcessor:
                 if not ref_frame_masks:
                     return None
                 
-                ref_mask = ref_frame_masks.get(int(mask_obj_id), None)
-                if ref_mask is None:
+                if int(mask_obj_id) not in ref_frame_masks:
                     return None
                 
-                ref_mask = cv2.resize(ref_mask, (int(ref_video_rect.width), int(ref_video_rect.height)))
-                ref_mask = cv2.flip(ref_mask, 1) if ref_video_flipped else ref_mask
+                ref_mask = mask_products(ref_video_masks).resized(
+                    ref_frame_idx, int(mask_obj_id), (int(ref_video_rect.width), int(ref_video_rect.height)), ref_video_flipped
+                )
                 
                 # Get the center of the binary mask
                 center_xy = VideoEffectsProcessor.get_center_of_binary_mask(ref_mask)
@@ -1030,12 +1127,12 @@ class VideoEffectsProcessor:
                 if not ref_frame_masks:
                     return None
                 
-                ref_mask = ref_frame_masks.get(int(mask_obj_id), None)
-                if ref_mask is None:
+                if int(mask_obj_id) not in ref_frame_masks:
                     return None
                 
-                ref_mask = cv2.resize(ref_mask, (int(ref_video_rect.width), int(ref_video_rect.height)))
-                ref_mask = cv2.flip(ref_mask, 1) if ref_video_flipped else ref_mask
+                ref_mask = mask_products(ref_video_masks).resized(
+                    ref_frame_idx, int(mask_obj_id), (int(ref_video_rect.width), int(ref_video_rect.height)), ref_video_flipped
+                )
                 processed_frame = VideoEffectsProcessor.apply_overlap(
                     processed_frame, 
                     ref_mask, 
@@ -1047,3 +1144,82 @@ class VideoEffectsProcessor:
                 )
         
         return processed_frame
+
+class ColorLUT:
+    """
+    Os efeitos que só dependem da cor (`_apply_pixel_effects`) avaliados numa grelha de GRID³ cores
+    e interpolados (trilinear) para cada píxel.
+
+    É compilada uma vez por efeito quando o projeto é montado (ver project_renderer.configure_effects).
+    Compilar custa o mesmo que aplicar a cadeia de efeitos a `size` píxeis, por isso máscaras mais
+    pequenas usam a cadeia diretamente.
+    """
+    GRID = 65 # Com 33 o erro máximo em relação à cadeia chegava a 6 níveis; com 65 é de 3
+    ROW_WIDTH = 4096 # Os píxeis são dispostos em linhas para o cv2.remap (no máximo SHRT_MAX colunas)
+    REMAP_TAB_SIZE = 32 # Frações do cv2.remap com mapas inteiros (INTER_TAB_SIZE)
+    CURVE_SETTINGS = ('exposure', 'contrast') # Aplicados antes dos outros e canal a canal
+    _CELLS_TO_MAP = np.array([[0, 1, 1], [1, 0, 0]], dtype=np.float32)
+    _FRACS_TO_MAP = np.array([[1, 0, 1]], dtype=np.float32)
+
+    def __init__(self, settings: Dict[str, Any]) -> None:
+        n = ColorLUT.GRID
+        # Exposição e contraste são uma curva por canal (com clipping): são avaliados exatamente para os
+        # 256 valores e a grelha fica no espaço depois da curva, onde só a parte suave é interpolada
+        curve = np.repeat(np.linspace(0, 1, 256, dtype=np.float32)[:, None], 3, axis=1)
+        curve = VideoEffectsProcessor._apply_contrast(VideoEffectsProcessor._apply_exposure(curve, settings), settings)[:, 0]
+        rest = {name: value for name, value in settings.items() if name not in ColorLUT.CURVE_SETTINGS}
+
+        levels = np.linspace(0, 1, n, dtype=np.float32)
+        c0, c1, c2 = np.meshgrid(levels, levels, levels, indexing='ij')
+        rgb = VideoEffectsProcessor._apply_pixel_effects(np.stack([c0.ravel(), c1.ravel(), c2.ravel()], axis=1), rest)
+        # Imagem para o cv2.remap: a linha é o canal 0 e a coluna é canal 1 * GRID + canal 2
+        self.image = np.clip(np.round(rgb * 255), 0, 255).astype(np.uint8).reshape(n, n * n, 3)
+
+        # Célula da grelha e fração (em 1/REMAP_TAB_SIZE) de cada valor uint8, depois da curva
+        tab = ColorLUT.REMAP_TAB_SIZE
+        scaled = curve.astype(np.float64) * (n - 1)
+        cell = np.floor(scaled).astype(np.int64)
+        frac = np.round((scaled - cell) * tab).astype(np.int64)
+        cell, frac = cell + frac // tab, frac % tab
+        # cv2.LUT aplica uma tabela por canal: célula (linha, fatia, coluna) e fração para o mapa do remap
+        self._cells = np.stack([cell, cell * n, cell], axis=1).astype(np.int16).reshape(1, 256, 3)
+        self._fracs = np.stack([frac * tab, np.zeros(256), frac], axis=1).astype(np.uint16).reshape(1, 256, 3)
+        self._weights = (frac / tab).astype(np.float32).reshape(1, 256)
+
+    @property
+    def size(self) -> int:
+        return ColorLUT.GRID ** 3
+
+    MIN_COST = 2 # Aplicar a LUT custa cerca de duas conversões de espaço de cor
+
+    @staticmethod
+    def active(settings: Dict[str, Any]) -> bool:
+        """
+        Se a LUT pode e compensa ser usada: nenhum dos efeitos que alteram a cor (saturation = 1 e os
+        outros a 0 não alteram) está em COLOR_LUT_EXCLUDED, e custam na cadeia pelo menos o mesmo que a LUT.
+        """
+        changed = [
+            name for name in COLOR_LUT_SETTINGS
+            if name in settings and settings[name] != (1 if name == 'saturation' else 0)
+        ]
+        if any(name in COLOR_LUT_EXCLUDED for name in changed):
+            return False
+        return sum(COLOR_LUT_SETTINGS[name] for name in changed) >= ColorLUT.MIN_COST
+
+    def apply(self, pixels: np.ndarray) -> np.ndarray:
+        """Píxeis (N, 3) uint8 -> (N, 3) uint8"""
+        count = len(pixels)
+        rows = -(-count // ColorLUT.ROW_WIDTH)
+        pixels = np.concatenate([pixels, np.zeros((rows * ColorLUT.ROW_WIDTH - count, 3), dtype=np.uint8)])
+        pixels = pixels.reshape(rows, ColorLUT.ROW_WIDTH, 3)
+
+        # Bilinear nos canais 0 e 2 com o cv2.remap, em cada uma das duas fatias do canal 1; linear entre elas
+        # (linha, fatia, coluna) -> mapa (x = fatia + coluna, y = linha) e fração y * TAB + x
+        cells = cv2.transform(cv2.LUT(pixels, self._cells), ColorLUT._CELLS_TO_MAP)
+        fracs = cv2.transform(cv2.LUT(pixels, self._fracs), ColorLUT._FRACS_TO_MAP)
+        weight = cv2.LUT(np.ascontiguousarray(pixels[:, :, 1]), self._weights)
+
+        lower = cv2.remap(self.image, cells, fracs, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        cells[:, :, 0] += ColorLUT.GRID
+        upper = cv2.remap(self.image, cells, fracs, cv2.INTER_LINEAR, borderMode=cv2.BORDER_REPLICATE)
+        return cv2.blendLinear(lower, upper, 1 - weight, weight).reshape(-1, 3)[:count]
@@ -1,11 +1,13 @@
 import cv2
 from typing import *
 import numpy as np
+from seek_index import IndexedVideoReader
 
 class VideoProcessor:
     def __init__(self, video_path: str):
         self.video_path = video_path
         self.cap = cv2.VideoCapture(video_path)
+        self.reader = IndexedVideoReader(video_path, self.cap)
 
     def get_num_frames(self) -> int:
         """Retorna o numero de frames do vídeo"""
@@ -16,9 +18,8 @@ class VideoProcessor:
         return self.cap.get(cv2.CAP_PROP_FPS)
 
     def get_frame(self, frame_number: int) -> np.ndarray:
-        """Retorna um frame específico em formato numpy array"""
-        self.cap.set(cv2.CAP_PROP_POS_FRAMES, frame_number)
-        ret, frame = self.cap.read()
+        """Retorna um frame específico em formato numpy array (seek pelo keyframe anterior, ver SeekIndex)"""
+        ret, frame = self.reader.read(frame_number)
         return frame if ret else None
     
     def release(self) -> None: